@@ -10,14 +10,132 @@ from __future__ import absolute_import
 from future import standard_library
 standard_library.install_aliases()
 
+from logging import getLogger
+from time import monotonic
 from urllib.parse import urljoin  # pylint:disable=import-error
 
 from django.conf import settings
+from django.contrib.auth.models import Permission
 from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
 
+from openid.consumer.discover import OpenIDServiceEndpoint, discover
+from requests import RequestException
 from social_core.backends import open_id
+
+from ixprofile_client import webservice
+from ixprofile_client.cache import LRUCache, SharedCache
+from ixprofile_client.exceptions import ProfileServerException
+from ixprofile_client.openid_store import CacheOpenIDStore
+from ixprofile_client.signals import profile_user_changed
 # pylint:enable=wrong-import-position
 
+LOG = getLogger(__name__)
+
+DEFAULT_GROUPS_CACHE_SIZE = 1000
+DEFAULT_GROUPS_TTL = 60
+
+DEFAULT_DISCOVERY_CACHE_SIZE = 100
+DEFAULT_DISCOVERY_TTL = 300
+
+# The attributes of a discovered OpenID service
+SERVICE_ATTRIBUTES = ('claimed_id', 'server_url', 'type_uris', 'local_id',
+                      'canonicalID', 'used_yadis', 'display_identifier')
+
+
+class DiscoveryCache:
+    """
+    A cache of OpenID discovery results, kept in-process and, optionally, in
+    a SharedCache, for ttl seconds.
+
+    Results are cached as plain records, so every login gets its own
+    service objects to consume.
+    """
+
+    def __init__(self, ttl, shared_cache=None,
+                 maxsize=DEFAULT_DISCOVERY_CACHE_SIZE, timer=monotonic):
+        self.records = LRUCache(maxsize, ttl, timer=timer)
+        self.shared_cache = shared_cache
+
+    @classmethod
+    def from_settings(cls):
+        """
+        The cache configured in the settings, or None if disabled.
+        """
+
+        ttl = getattr(settings, 'PROFILE_SERVER_DISCOVERY_TTL',
+                      DEFAULT_DISCOVERY_TTL)
+        if not ttl:
+            return None
+
+        shared_cache = None
+        alias = getattr(settings, 'PROFILE_SERVER_SHARED_CACHE', None)
+        if alias is not None:
+            shared_cache = SharedCache(alias, ttl)
+
+        return cls(ttl, shared_cache)
+
+    @staticmethod
+    def _dumps(claimed_id, services):
+        """
+        The record of a discovery result.
+        """
+        return {
+            'claimed_id': claimed_id,
+            'services': [
+                {name: getattr(service, name) for name in SERVICE_ATTRIBUTES}
+                for service in services
+            ],
+        }
+
+    @staticmethod
+    def _loads(record):
+        """
+        The discovery result of a record.
+        """
+
+        services = []
+        for attributes in record['services']:
+            service = OpenIDServiceEndpoint()
+            for name, value in attributes.items():
+                setattr(service, name, value)
+            services.append(service)
+
+        return record['claimed_id'], services
+
+    def discover(self, url):
+        """
+        Discover the OpenID services for the URL, as
+        openid.consumer.discover.discover. Results without any services are
+        not cached.
+        """
+
+        record = self.records.get(url)
+        if record is not None:
+            return self._loads(record)
+
+        result = []
+
+        def fetch():
+            """
+            Discover the services, returning a record to cache, if any.
+            """
+            result.append(discover(url))
+            if not result[0][1]:
+                return None
+            return self._dumps(*result[0])
+
+        if self.shared_cache is None:
+            record = fetch()
+        else:
+            record = self.shared_cache.get_or_fetch('openid_discovery', url,
+                                                    fetch)
+        if record is None:
+            return result[0]
+
+        self.records.set(url, record)
+        return self._loads(record)
+
 
 class IXProfile(open_id.OpenIdAuth):
     """
@@ -41,3 +159,162 @@ class IXProfile(open_id.OpenIdAuth):
             )
 
         return urljoin(profile_server, '/id/xrds/')
+
+    discovery_cache = None
+
+    @classmethod
+    def _discovery_cache(cls):
+        """
+        The cache of the OpenID discovery results, or None if disabled.
+        """
+
+        if cls.discovery_cache is None:
+            cls.discovery_cache = DiscoveryCache.from_settings()
+        return cls.discovery_cache
+
+    def create_consumer(self, store=None):
+        """
+        Create an OpenID consumer discovering the profile server through the
+        discovery cache, if enabled, and keeping the associations and nonces
+        in the cache set in PROFILE_SERVER_OPENID_STORE_CACHE, if any.
+        """
+
+        store = CacheOpenIDStore.from_settings() or store
+        consumer = super(IXProfile, self).create_consumer(store)
+
+        cache = self._discovery_cache()
+        if cache is not None:
+            # pylint:disable=protected-access
+            consumer._discover = cache.discover
+            consumer.consumer._discover = cache.discover
+
+        return consumer
+
+
+class ProfileGroupBackend:
+    """
+    An authorization backend granting Django permissions to users by their
+    profile server groups.
+
+    PROFILE_SERVER_GROUP_PERMISSIONS maps profile server groups to lists of
+    permissions ('app_label.codename'); PROFILE_SERVER_GROUP_DJANGO_GROUPS
+    maps them to lists of Django group names, whose permissions are granted.
+
+    The profile server groups of each user are cached in-process for
+    PROFILE_SERVER_GROUPS_TTL seconds (default 60), and the resulting
+    permissions on the user object, so that permission checks while
+    handling a request don't call the profile server.
+    """
+
+    groups_cache = None
+
+    @classmethod
+    def _groups_cache(cls):
+        """
+        The cache of the profile server groups of users.
+        """
+
+        if cls.groups_cache is None:
+            cls.groups_cache = LRUCache(
+                getattr(settings, 'PROFILE_SERVER_GROUPS_CACHE_SIZE',
+                        DEFAULT_GROUPS_CACHE_SIZE),
+                getattr(settings, 'PROFILE_SERVER_GROUPS_TTL',
+                        DEFAULT_GROUPS_TTL))
+        return cls.groups_cache
+
+    # pylint:disable=unused-argument
+    def authenticate(self, request, **credentials):
+        """
+        This backend doesn't authenticate users.
+        """
+        return None
+
+    def profile_groups(self, user_obj):
+        """
+        The profile server groups of the user.
+
+        If the profile server fails, the user has no groups, and the failure
+        is not cached.
+        """
+
+        cache = self._groups_cache()
+        groups = cache.get(user_obj.username)
+        if groups is None:
+            try:
+                groups = webservice.profile_server.groups_for(user_obj)
+            except (ProfileServerException, RequestException) as error:
+                LOG.warning("Failed to get the profile server groups of "
+                            "'%s': %s", user_obj.username, error)
+                return frozenset()
+            cache.set(user_obj.username, groups)
+
+        return groups
+
+    @staticmethod
+    def _django_group_permissions(names):
+        """
+        The permissions of the named Django groups.
+        """
+
+        if not names:
+            return set()
+
+        # pylint:disable=no-member
+        permissions = Permission.objects.filter(group__name__in=names) \
+            .values_list('content_type__app_label', 'codename')
+        return set('%s.%s' % permission for permission in permissions)
+
+    def get_all_permissions(self, user_obj, obj=None):
+        """
+        The permissions granted to the user by their profile server groups.
+        """
+
+        if not user_obj.is_active or user_obj.is_anonymous or \
+                obj is not None:
+            return set()
+
+        if not hasattr(user_obj, '_ixprofile_perm_cache'):
+            group_permissions = getattr(
+                settings, 'PROFILE_SERVER_GROUP_PERMISSIONS', {})
+            django_groups = getattr(
+                settings, 'PROFILE_SERVER_GROUP_DJANGO_GROUPS', {})
+
+            permissions = set()
+            names = set()
+            for group in self.profile_groups(user_obj):
+                permissions.update(group_permissions.get(group, ()))
+                names.update(django_groups.get(group, ()))
+            permissions |= self._django_group_permissions(names)
+
+            # pylint:disable=protected-access
+            user_obj._ixprofile_perm_cache = permissions
+
+        # pylint:disable=protected-access
+        return user_obj._ixprofile_perm_cache
+
+    get_group_permissions = get_all_permissions
+
+    def has_perm(self, user_obj, perm, obj=None):
+        """
+        Whether the user is granted the permission.
+        """
+        return perm in self.get_all_permissions(user_obj, obj)
+
+    def has_module_perms(self, user_obj, app_label):
+        """
+        Whether the user is granted any permission in the application.
+        """
+        return any(permission.startswith(app_label + '.')
+                   for permission in self.get_all_permissions(user_obj))
+
+
+# pylint:disable=unused-argument
+@receiver(profile_user_changed)
+def forget_profile_groups(sender, username, **kwargs):
+    """
+    Forget the profile server groups of a user changed through the client.
+    """
+
+    cache = ProfileGroupBackend.groups_cache
+    if cache is not None:
+        cache.pop(username)
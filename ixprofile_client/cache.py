@@ -0,0 +1,235 @@
+"""
+Caching of profile server records
+"""
+
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from hashlib import sha1
+from time import monotonic
+
+from django.core.cache import caches
+
+COMPRESSED = b'z'
+UNCOMPRESSED = b'j'
+
+
+class LRUCache:
+    """
+    A thread-safe in-process cache with a maximum size and entry lifetime.
+
+    When full, the least recently used entry is evicted. The hit, miss and
+    eviction counters are available from stats() for sizing the cache.
+    """
+
+    def __init__(self, maxsize, ttl, timer=monotonic):
+        """
+        Create a cache of at most maxsize entries, each living ttl seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        The value cached for the key, or default if it is missing or expired.
+        """
+
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= self.timer():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Cache the value for the key.
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.timer() + self.ttl, value)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        Remove the key from the cache, returning the value cached for it,
+        expired or not.
+        """
+
+        with self._lock:
+            try:
+                return self._entries.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        """
+        Remove all the entries from the cache.
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        The cache counters.
+        """
+
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SharedCache:
+    """
+    A cache of profile server records shared by all the processes, stored in
+    a Django cache.
+
+    Records belong to a subject in a namespace (e.g. the user 'bob' in
+    'user'), and a subject can have several records (e.g. the user data for
+    different keys). Every subject and namespace has a version number, stored
+    along the records; invalidating a subject or a whole namespace changes its
+    version, so the old records are ignored by all the processes, even those
+    still fetching them from the profile server.
+
+    Records are serialised as compact JSON and compressed when larger than
+    compress_threshold bytes, to fit the value size limits of caches like
+    memcached.
+    """
+
+    def __init__(self, alias='default', ttl=300, prefix='ixprofile',
+                 compress_threshold=1024):
+        """
+        Create a cache storing records in the Django cache with the given
+        alias for ttl seconds.
+        """
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+        self.compress_threshold = compress_threshold
+
+    def _key(self, *parts):
+        """
+        A Django cache key safe for any backend.
+        """
+        digest = sha1(json.dumps(parts).encode()).hexdigest()
+        return '%s:%s:%s' % (self.prefix, parts[0], digest)
+
+    def _version_keys(self, namespace, subject):
+        """
+        The keys of the version numbers for the namespace and the subject.
+        """
+        return (self._key(namespace, 'version'),
+                self._key(namespace, 'version', subject))
+
+    def versions(self, namespace, subject):
+        """
+        The version numbers for the namespace and the subject; invalidating
+        either changes them.
+        """
+        keys = self._version_keys(namespace, subject)
+        values = self.cache.get_many(keys)
+        return tuple(values.get(key, 0) for key in keys)
+
+    def dumps(self, value):
+        """
+        Serialise a record.
+        """
+        data = json.dumps(value, separators=(',', ':')).encode()
+        if len(data) > self.compress_threshold:
+            return COMPRESSED + zlib.compress(data)
+        return UNCOMPRESSED + data
+
+    @staticmethod
+    def loads(data):
+        """
+        Deserialise a record.
+        """
+        if data[:1] == COMPRESSED:
+            return json.loads(zlib.decompress(data[1:]).decode())
+        return json.loads(data[1:].decode())
+
+    def get_or_fetch(self, namespace, subject, fetch, variant=None):
+        """
+        The record cached for the subject; if there is none or it has been
+        invalidated, the result of fetch(), which is cached unless it is
+        None.
+        """
+
+        keys = self._version_keys(namespace, subject)
+        data_key = self._key(namespace, subject, variant)
+        values = self.cache.get_many(keys + (data_key,))
+
+        # Read the versions before fetching, so a record invalidated while it
+        # is being fetched is cached under the old versions and ignored
+        versions = tuple(values.get(key, 0) for key in keys)
+        try:
+            cached_versions, data = values[data_key]
+            if tuple(cached_versions) == versions:
+                return self.loads(data)
+        except KeyError:
+            pass
+
+        value = fetch()
+        if value is not None:
+            self.cache.set(data_key, (versions, self.dumps(value)), self.ttl)
+
+        return value
+
+    def _increment(self, key):
+        """
+        Increment a version number.
+        """
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            if not self.cache.add(key, 1, None):
+                self.cache.incr(key)
+
+    def invalidate(self, namespace, subject, variant=None):
+        """
+        Invalidate all the records of the subject.
+
+        The record for the variant is deleted as well, in case the version
+        number is evicted from the cache.
+        """
+        self._increment(self._version_keys(namespace, subject)[1])
+        self.cache.delete(self._key(namespace, subject, variant))
+
+    def invalidate_namespace(self, namespace):
+        """
+        Invalidate all the records in the namespace.
+        """
+        self._increment(self._key(namespace, 'version'))
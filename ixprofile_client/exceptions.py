@@ -27,8 +27,11 @@ class ProfileServerException(Exception):
         Unicode representation of the exception
         """
         try:
+            # requests has 'reason', httpx has 'reason_phrase'
             return "Profile server failure: %d %s." % (
-                self.response.status_code, self.response.reason)
+                self.response.status_code,
+                getattr(self.response, 'reason',
+                        getattr(self.response, 'reason_phrase', None)))
         except (AttributeError, KeyError):
             return "Profile server failure: %s." % self.response
 
@@ -64,3 +67,17 @@ class EmailNotUnique(ProfileServerException):
 
 
 ProfileServerFailure = ProfileServerException
+
+
+class ProfileServerUnavailable(ProfileServerException):
+    """
+    The profile server has been failing and requests to it are not being sent
+    for a while
+    """
+
+
+class ProfileServerTimeout(ProfileServerException):
+    """
+    The profile server did not respond in time, or the deadline for the
+    calls to it has expired
+    """
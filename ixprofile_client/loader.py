@@ -0,0 +1,115 @@
+"""
+Batched loading of profile server user details
+"""
+
+import threading
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping  # pylint:disable=deprecated-class
+
+from ixprofile_client import webservice
+
+_LOCAL = threading.local()
+
+
+class LazyProfile(Mapping):
+    """
+    The profile server details of a user, loaded when first accessed.
+
+    Accessing any of the details loads all the profiles requested from the
+    same loader so far in a single batch. A user that doesn't exist on the
+    profile server has no details (and is falsy).
+    """
+
+    def __init__(self, loader, username):
+        self.loader = loader
+        self.username = username
+
+    @property
+    def details(self):
+        """
+        The user details, or None if the user is not found.
+        """
+        return self.loader.resolve(self.username)
+
+    def __getitem__(self, key):
+        if self.details is None:
+            raise KeyError(key)
+        return self.details[key]
+
+    def __iter__(self):
+        return iter(self.details or {})
+
+    def __len__(self):
+        return len(self.details or {})
+
+    def __repr__(self):
+        return 'LazyProfile(%r)' % self.username
+
+
+class ProfileLoader:
+    """
+    Load user details from the profile server in batches.
+
+    find_by_username() returns a LazyProfile immediately; the users are
+    fetched with find_by_usernames() when the first of them is accessed.
+    """
+
+    def __init__(self, profile_server=None):
+        """
+        Create a loader using the given profile server, or the current
+        webservice.profile_server.
+        """
+        self.profile_server = profile_server
+        self.pending = set()
+        self.loaded = {}
+
+    def find_by_username(self, username):
+        """
+        A lazily loaded user details by username.
+        """
+
+        if username not in self.loaded:
+            self.pending.add(username)
+
+        return LazyProfile(self, username)
+
+    def resolve(self, username):
+        """
+        The details of the user, loading all the pending users if needed.
+        """
+
+        if username not in self.loaded:
+            self.pending.add(username)
+            self.load_pending()
+
+        return self.loaded[username]
+
+    def load_pending(self):
+        """
+        Load all the pending users in a batch.
+        """
+
+        if not self.pending:
+            return
+
+        profile_server = self.profile_server or webservice.profile_server
+
+        pending, self.pending = self.pending, set()
+        self.loaded.update(profile_server.find_by_usernames(pending))
+
+
+def current_loader():
+    """
+    The profile loader of the request being handled by this thread, if any.
+    """
+    return getattr(_LOCAL, 'loader', None)
+
+
+def set_current_loader(loader):
+    """
+    Set the profile loader of the request being handled by this thread.
+    """
+    _LOCAL.loader = loader
@@ -0,0 +1,116 @@
+"""
+A management command to compare the speed of the OpenID stores.
+"""
+
+import os
+from binascii import hexlify
+from time import monotonic, time
+from types import SimpleNamespace
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from openid.association import Association
+from social_core.store import OpenIdStore
+
+from ixprofile_client.openid_store import CacheOpenIDStore
+
+# The OpenID server the logins are simulated against
+SERVER_URL = 'https://profile.test/id/endpoint/'
+
+
+class Command(BaseCommand):
+    """
+    The command to compare the speed of the OpenID stores.
+    """
+
+    help = ("Simulate OpenID logins against the database store of "
+            "social_django and the cache store of ixprofile_client, and "
+            "report their speed. The database store writes to the database "
+            "configured; use a test database.")
+
+    def add_arguments(self, parser):
+        """
+        Add the arguments for the command.
+        """
+        parser.add_argument('--logins', type=int, default=1000,
+                            help='The number of logins to simulate.')
+        parser.add_argument('--stores', default='db,cache',
+                            help='A comma-separated list of the stores to '
+                                 'compare: db and cache.')
+        parser.add_argument('--cache', default=None,
+                            help='The alias of the Django cache for the '
+                                 'cache store; a local-memory cache by '
+                                 'default.')
+
+    @staticmethod
+    def db_store():
+        """
+        The database store of social_django.
+        """
+
+        # pylint:disable=import-outside-toplevel
+        from social_django.models import DjangoStorage
+
+        return OpenIdStore(SimpleNamespace(storage=DjangoStorage))
+
+    @staticmethod
+    def cache_store(alias):
+        """
+        The cache store.
+        """
+
+        if alias is not None:
+            return CacheOpenIDStore(alias)
+
+        store = CacheOpenIDStore()
+        store.cache = LocMemCache('ixprofile-openid-benchmark', {})
+        return store
+
+    @staticmethod
+    def simulate(store, logins):
+        """
+        Simulate logins with the store, as the OpenID consumer uses it:
+        looking up the association with the server when a login starts, and
+        checking it and using the nonce when it completes. Returns the
+        seconds taken.
+        """
+
+        started = monotonic()
+
+        for login in range(logins):
+            association = store.getAssociation(SERVER_URL)
+            if association is None:
+                association = Association.fromExpiresIn(
+                    3600, hexlify(os.urandom(8)).decode(), os.urandom(20),
+                    'HMAC-SHA1')
+                store.storeAssociation(SERVER_URL, association)
+
+            store.getAssociation(SERVER_URL, association.handle)
+            salt = '%d-%s' % (login, hexlify(os.urandom(4)).decode())
+            if not store.useNonce(SERVER_URL, int(time()), salt):
+                raise CommandError("A fresh nonce was rejected.")
+
+        return monotonic() - started
+
+    def handle(self, *args, **options):
+        logins = options['logins']
+
+        stores = {}
+        for name in options['stores'].split(','):
+            name = name.strip()
+            if name == 'db':
+                stores[name] = self.db_store()
+            elif name == 'cache':
+                stores[name] = self.cache_store(options['cache'])
+            else:
+                raise CommandError("Unknown store: %s" % name)
+
+        for name, store in stores.items():
+            elapsed = self.simulate(store, logins)
+            self.stdout.write(
+                "%s: %d logins in %.3f s (%.0f logins/s, %.3f ms/login)" % (
+                    name, logins, elapsed,
+                    logins / elapsed if elapsed else 0,
+                    elapsed * 1000 / logins if logins else 0,
+                ))
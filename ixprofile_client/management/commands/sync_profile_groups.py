@@ -0,0 +1,147 @@
+"""
+A management command to synchronise the groups of users on the profile server
+from a file.
+"""
+
+import csv
+import json
+import sys
+from time import monotonic
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ixprofile_client import webservice
+from ixprofile_client.webservice import DEFAULT_LOOKUPS_IN_FLIGHT
+
+# How often to report the progress, in users
+PROGRESS_INTERVAL = 100
+
+
+class Command(BaseCommand):
+    """
+    The command to synchronise the groups of users on the profile server.
+    """
+
+    help = ("Set the groups of users on the profile server from a JSON "
+            "object of lists of groups keyed by username, or CSV rows of a "
+            "username followed by the groups.")
+
+    def add_arguments(self, parser):
+        """
+        Add the arguments for the command.
+        """
+        parser.add_argument('file',
+                            help='The file with the groups of the users, '
+                                 'or - for the standard input.')
+        parser.add_argument('--format', choices=('json', 'csv'),
+                            default=None,
+                            help='The format of the file; guessed from the '
+                                 'extension by default.')
+        parser.add_argument('--managed-groups', default=None,
+                            help='A comma-separated list of the only groups '
+                                 'to add or remove users from.')
+        parser.add_argument('--concurrency', type=int,
+                            default=DEFAULT_LOOKUPS_IN_FLIGHT,
+                            help='The number of users to synchronise at the '
+                                 'same time.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the users whose groups would '
+                                 'change.')
+
+    @staticmethod
+    def read_mapping(stream, format_):
+        """
+        Read the groups of the users, keyed by username.
+        """
+
+        if format_ == 'json':
+            try:
+                mapping = json.load(stream)
+            except ValueError as error:
+                raise CommandError("Invalid JSON: %s" % error) from error
+            if not isinstance(mapping, dict):
+                raise CommandError("Expected a JSON object.")
+            return mapping
+
+        mapping = {}
+        for row in csv.reader(stream):
+            row = [value.strip() for value in row]
+            if row and row[0]:
+                mapping.setdefault(row[0], []).extend(
+                    group for group in row[1:] if group)
+        return mapping
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        format_ = options['format']
+        if format_ is None:
+            format_ = 'csv' if options['file'].endswith('.csv') else 'json'
+
+        if options['file'] == '-':
+            mapping = self.read_mapping(sys.stdin, format_)
+        else:
+            try:
+                with open(options['file'], newline='',
+                          encoding='utf-8') as stream:
+                    mapping = self.read_mapping(stream, format_)
+            except OSError as error:
+                raise CommandError(str(error)) from error
+
+        managed_groups = None
+        if options['managed_groups'] is not None:
+            managed_groups = [group.strip() for group
+                              in options['managed_groups'].split(',')
+                              if group.strip()]
+
+        started = monotonic()
+
+        def progress(done, total):
+            """
+            Report the progress.
+            """
+            if verbosity >= 2 and (done % PROGRESS_INTERVAL == 0 or
+                                   done == total):
+                elapsed = monotonic() - started
+                self.stdout.write("%d/%d users (%.1f users/s)" % (
+                    done, total, done / elapsed if elapsed else 0))
+
+        try:
+            result = webservice.profile_server.sync_group_memberships(
+                mapping,
+                managed_groups=managed_groups,
+                lookups_in_flight=options['concurrency'],
+                dry_run=options['dry_run'],
+                progress=progress,
+            )
+        except ValueError as error:
+            raise CommandError(str(error)) from error
+
+        elapsed = monotonic() - started
+
+        if verbosity >= 1:
+            for username, error in sorted(result['failed'].items()):
+                self.stderr.write("Failed: %s: %s" % (username, error))
+            for username in sorted(result['missing']):
+                self.stderr.write("Not found: %s" % username)
+            if options['dry_run'] and verbosity >= 2:
+                for username in sorted(result['changed']):
+                    self.stdout.write("Would change: %s" % username)
+
+            self.stdout.write(
+                "%s %d users in %.1f s (%.1f users/s): %d %s, "
+                "%d unchanged, %d not found, %d failed." % (
+                    "Checked" if options['dry_run'] else "Synchronised",
+                    len(mapping),
+                    elapsed,
+                    len(mapping) / elapsed if elapsed else 0,
+                    len(result['changed']),
+                    "to change" if options['dry_run'] else "changed",
+                    len(result['unchanged']),
+                    len(result['missing']),
+                    len(result['failed']),
+                ))
+
+        if result['failed']:
+            raise CommandError("Failed to synchronise %d users." %
+                               len(result['failed']))
@@ -0,0 +1,262 @@
+"""
+Metrics of the requests to the profile server
+"""
+
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+# Request durations in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_LOCAL = threading.local()
+# Recorders of the calls from all the threads
+_GLOBAL_RECORDERS = []
+
+
+class MetricsSink:
+    """
+    A destination for the metrics of the requests to the profile server.
+
+    Subclass this to send the metrics elsewhere, e.g. to statsd, and set
+    PROFILE_SERVER_METRICS_SINK to the dotted path of an instance.
+    """
+
+    # pylint:disable=too-many-arguments
+    def record(self, operation, status, duration, bytes_sent,
+               bytes_received, retries):
+        """
+        Record a completed request made for the operation (e.g.
+        'find_by_username').
+
+        status is the HTTP status of the final response, or 'error' or
+        'timeout' if there was none. The duration in seconds and the
+        retries include all the attempts; the byte counts are for the
+        final one.
+        """
+        raise NotImplementedError
+
+
+class PrometheusMetrics(MetricsSink):
+    """
+    Metrics kept in memory, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._bytes_sent = defaultdict(int)
+        self._bytes_received = defaultdict(int)
+        self._retries = defaultdict(int)
+        self._durations = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self._duration_sums = defaultdict(float)
+
+    # pylint:disable=too-many-arguments
+    def record(self, operation, status, duration, bytes_sent,
+               bytes_received, retries):
+        with self._lock:
+            self._requests[(operation, str(status))] += 1
+            self._bytes_sent[operation] += bytes_sent
+            self._bytes_received[operation] += bytes_received
+            self._retries[operation] += retries
+            self._durations[operation][
+                bisect_left(self.buckets, duration)] += 1
+            self._duration_sums[operation] += duration
+
+    def clear(self):
+        """
+        Reset all the metrics.
+        """
+
+        with self._lock:
+            for metric in (self._requests, self._bytes_sent,
+                           self._bytes_received, self._retries,
+                           self._durations, self._duration_sums):
+                metric.clear()
+
+    @staticmethod
+    def _labels(**labels):
+        """
+        Format the labels of a sample.
+        """
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in sorted(labels.items()))
+
+    def _counter(self, name, help_text, values, label_names):
+        """
+        The lines of a counter.
+        """
+
+        yield '# HELP %s %s' % (name, help_text)
+        yield '# TYPE %s counter' % name
+        for labels, value in sorted(values.items()):
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield '%s%s %s' % (name,
+                               self._labels(**dict(zip(label_names, labels))),
+                               value)
+
+    def _histogram(self, name, help_text):
+        """
+        The lines of the request duration histogram.
+        """
+
+        yield '# HELP %s %s' % (name, help_text)
+        yield '# TYPE %s histogram' % name
+        for operation, counts in sorted(self._durations.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '%s_bucket%s %d' % (
+                    name, self._labels(operation=operation, le=bound), total)
+            labels = self._labels(operation=operation)
+            yield '%s_sum%s %s' % (name, labels,
+                                   self._duration_sums[operation])
+            yield '%s_count%s %d' % (name, labels, total)
+
+    def render(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+
+        with self._lock:
+            lines = []
+            lines.extend(self._histogram(
+                'ixprofile_request_duration_seconds',
+                "Duration of the profile server requests, with retries."))
+            lines.extend(self._counter(
+                'ixprofile_requests_total',
+                "Profile server requests by final status.",
+                self._requests, ('operation', 'status')))
+            lines.extend(self._counter(
+                'ixprofile_request_bytes_total',
+                "Bytes sent in profile server request bodies.",
+                self._bytes_sent, ('operation',)))
+            lines.extend(self._counter(
+                'ixprofile_response_bytes_total',
+                "Bytes received in profile server response bodies.",
+                self._bytes_received, ('operation',)))
+            lines.extend(self._counter(
+                'ixprofile_retries_total',
+                "Retried profile server requests.",
+                self._retries, ('operation',)))
+
+        return '\n'.join(lines) + '\n'
+
+
+# The default sink, rendered by ixprofile_client.views.metrics
+REGISTRY = PrometheusMetrics()
+
+
+class CallRecorder:
+    """
+    Record the profile server calls made by a thread, e.g. while handling a
+    request.
+
+    Recording starts when the recorder is entered as a context manager (or
+    started) and stops when it is exited (or stopped); recorders can be
+    nested. If all_threads is True, the calls made by all the threads are
+    recorded, e.g. for a test using a live server.
+    """
+
+    def __init__(self, all_threads=False):
+        self.all_threads = all_threads
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def record(self, operation, duration):
+        """
+        Record a call made for the operation, taking duration seconds.
+        """
+        with self._lock:
+            self.calls.append((operation, duration))
+
+    @property
+    def count(self):
+        """
+        The number of calls recorded.
+        """
+        return len(self.calls)
+
+    @property
+    def duration(self):
+        """
+        The total duration of the calls recorded, in seconds.
+        """
+        return sum(duration for _, duration in self.calls)
+
+    def operations(self):
+        """
+        The number of calls recorded for each operation.
+        """
+        return Counter(operation for operation, _ in self.calls)
+
+    def start(self):
+        """
+        Start recording the calls.
+        """
+        if self.all_threads:
+            _GLOBAL_RECORDERS.append(self)
+        else:
+            _LOCAL.recorders = current_recorders() + (self,)
+
+    def stop(self):
+        """
+        Stop recording the calls.
+        """
+        if self.all_threads:
+            if self in _GLOBAL_RECORDERS:
+                _GLOBAL_RECORDERS.remove(self)
+        else:
+            _LOCAL.recorders = tuple(
+                recorder for recorder in current_recorders()
+                if recorder is not self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def current_recorders():
+    """
+    The call recorders active in this thread.
+    """
+    return getattr(_LOCAL, 'recorders', ())
+
+
+def record_call(operation, duration):
+    """
+    Record a profile server call in the recorders active in this thread and
+    those recording all the threads.
+    """
+    for recorder in current_recorders() + tuple(_GLOBAL_RECORDERS):
+        recorder.record(operation, duration)
+
+
+def with_current_recorders(function):
+    """
+    Wrap the function to record its calls in the recorders active in the
+    calling thread, for running it in another thread.
+    """
+
+    recorders = current_recorders()
+
+    def wrapper(*args, **kwargs):
+        """
+        Run the function with the recorders active.
+        """
+        previous = current_recorders()
+        _LOCAL.recorders = recorders
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _LOCAL.recorders = previous
+
+    return wrapper
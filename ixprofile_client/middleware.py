@@ -3,10 +3,17 @@ Middleware specific to ixprofile_client
 """
 from __future__ import absolute_import, unicode_literals
 
+from logging import INFO, WARNING, getLogger
+
+from django.conf import settings
 from django.template.response import SimpleTemplateResponse
 from django.utils.deprecation import MiddlewareMixin
 
 from .exceptions import EmailNotUnique
+from .loader import ProfileLoader, set_current_loader
+from .metrics import CallRecorder
+
+LOG = getLogger(__name__)
 
 
 class PrintEmailNotUniqueMessage(MiddlewareMixin):
@@ -27,3 +34,86 @@ class PrintEmailNotUniqueMessage(MiddlewareMixin):
         if isinstance(exception, EmailNotUnique):
             return SimpleTemplateResponse('email_not_unique.html')
         return None
+
+
+class ProfileLoaderMiddleware(MiddlewareMixin):
+    """
+    Middleware class which gives every request a ProfileLoader, as
+    request.profile_loader, to batch the profile server user lookups
+    made while handling it.
+
+    The loader is also available from ixprofile_client.loader.current_loader()
+    for code without access to the request.
+    """
+    def process_request(self, request):
+        """
+        Create the loader for the request.
+        """
+        request.profile_loader = ProfileLoader()
+        set_current_loader(request.profile_loader)
+
+    def process_response(self, request, response):
+        """
+        Forget the loader once the response is ready.
+
+        Template responses are rendered before this is called, so the users
+        needed by the templates are loaded by then.
+        """
+        set_current_loader(None)
+        return response
+
+
+class ProfileServerTimingMiddleware(MiddlewareMixin):
+    """
+    Middleware class which counts the profile server calls made while
+    handling every request and the time spent in them.
+
+    Both are reported in a Server-Timing header and logged. If more calls
+    than PROFILE_SERVER_CALL_BUDGET were made, a warning is logged instead,
+    to catch N+1 calls.
+    """
+    def process_request(self, request):
+        """
+        Start recording the profile server calls.
+        """
+        request.profile_server_calls = CallRecorder()
+        request.profile_server_calls.start()
+
+    def process_response(self, request, response):
+        """
+        Report the profile server calls made.
+        """
+
+        recorder = getattr(request, 'profile_server_calls', None)
+        if recorder is None:
+            return response
+        recorder.stop()
+
+        duration = recorder.duration * 1000
+        timing = 'profile-server;dur=%.1f;desc="%d calls"' % (
+            duration, recorder.count)
+        if response.has_header('Server-Timing'):
+            timing = '%s, %s' % (response['Server-Timing'], timing)
+        response['Server-Timing'] = timing
+
+        budget = getattr(settings, 'PROFILE_SERVER_CALL_BUDGET', None)
+        over_budget = budget is not None and recorder.count > budget
+
+        LOG.log(
+            WARNING if over_budget else INFO,
+            "%s %s made %d profile server calls in %.1f ms%s",
+            request.method,
+            request.path,
+            recorder.count,
+            duration,
+            " (budget %d)" % budget if over_budget else "",
+            extra={
+                'path': request.path,
+                'profile_server_calls': recorder.count,
+                'profile_server_duration_ms': duration,
+                'profile_server_operations': dict(recorder.operations()),
+                'profile_server_call_budget': budget,
+            },
+        )
+
+        return response
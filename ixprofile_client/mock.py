@@ -3,16 +3,31 @@ Utilities for testing applications using the profile server.
 """
 
 import json
-
-from hashlib import sha256
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import sha1, sha256
+from http.client import responses
+from types import SimpleNamespace
+# pylint:disable=import-error
+from urllib.parse import parse_qsl, unquote, urlparse
+# pylint:enable=import-error
 
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import urlencode
 from django.utils.timezone import now
 
 import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
 
 from ixprofile_client import webservice
 from ixprofile_client.exceptions import EmailNotUnique, ProfileServerFailure
+from ixprofile_client.metrics import CallRecorder, record_call
+from ixprofile_client.signals import profile_user_changed
 
 from .util import multi_key_sort, sort_case_insensitive
 
@@ -22,7 +37,34 @@ SORT_RULES = {
     'last_name': sort_case_insensitive,
 }
 
-RealProfileServer = webservice.profile_server  # pylint:disable=invalid-name
+# pylint:disable=invalid-name
+RealProfileServer = webservice.profile_server
+RealAsyncProfileServer = webservice.async_profile_server
+# pylint:enable=invalid-name
+
+# Whether this thread is serving a request through MockProfileAdapter
+_SERVING = threading.local()
+
+
+def _profile_server_call(method):
+    """
+    Record the calls to a mock profile server method as profile server
+    calls, like UserWebService does for the requests it sends.
+
+    Calls made by MockProfileAdapter are not recorded, as the requests
+    served are recorded by UserWebService.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        """
+        Record the call and call the method.
+        """
+        if not getattr(_SERVING, 'active', False):
+            record_call(method.__name__, 0)
+        return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class MockProfileServer(webservice.UserWebService):
@@ -92,6 +134,7 @@ class MockProfileServer(webservice.UserWebService):
 
         return super(MockProfileServer, self).find_by_email(email)
 
+    @_profile_server_call
     def find_by_username(self, username):
         """
         Find a user's details by username.
@@ -99,6 +142,33 @@ class MockProfileServer(webservice.UserWebService):
 
         return self._user_details(self.users.get(username, None))
 
+    def _fetch_user(self, username):
+        """
+        Find a user's details by username, for the subscription cache.
+        """
+        return self.find_by_username(username)
+
+    def find_by_usernames(self, usernames, lookups_in_flight=None):
+        """
+        Find the details of several users by username.
+        """
+
+        return {
+            username: self.find_by_username(username)
+            for username in usernames
+        }
+
+    def find_by_emails(self, emails, lookups_in_flight=None):
+        """
+        Find the details of several users by email.
+        Raise an error on duplicate emails.
+        """
+
+        return {
+            email: self.find_by_email(email)
+            for email in emails
+        }
+
     def _visible_apps(self):
         """
         All the applications visible by this key.
@@ -189,6 +259,7 @@ class MockProfileServer(webservice.UserWebService):
         raise ProfileServerFailure(
             self._dummy_response(json.dumps(error_json)))
 
+    @_profile_server_call
     def list(self, **kwargs):
         """
         List all the users subscribed to the application.
@@ -282,14 +353,28 @@ class MockProfileServer(webservice.UserWebService):
         return {
             'meta': {
                 'limit': limit,
-                'next': None,
+                'next': self._page_uri(offset + limit, limit)
+                if 0 < limit and offset + limit < total_count else None,
                 'offset': offset,
-                'previous': None,
+                'previous': self._page_uri(max(offset - limit, 0), limit)
+                if 0 < limit and offset > 0 else None,
                 'total_count': total_count,
             },
             'objects': user_list,
         }
 
+    def _page_uri(self, offset, limit):
+        """
+        The URI of a page of the last user list, as given in the list
+        metadata.
+        """
+
+        kwargs = self.last_list_kwargs.copy()
+        kwargs['offset'] = offset
+        kwargs['limit'] = limit
+
+        return self.USER_LIST_URI + '?' + urlencode(kwargs, doseq=True)
+
     @staticmethod
     def _generate_username(user):
         """
@@ -299,6 +384,7 @@ class MockProfileServer(webservice.UserWebService):
         hash_base = user['email'].lower().encode()
         return 'sha256:' + sha256(hash_base).hexdigest()[:23]
 
+    @_profile_server_call
     def register(self, user):
         """
         Register a new user
@@ -327,13 +413,16 @@ class MockProfileServer(webservice.UserWebService):
         username = self._user_to_dict(user)['username']
 
         self.users[username]['subscriptions'][self.app] = state
+        profile_user_changed.send(sender=self.__class__, username=username)
 
+    @_profile_server_call
     def unsubscribe(self, user):
         """
         Register an unsubscription request
         """
         self._set_subscription(user, False)
 
+    @_profile_server_call
     def subscribe(self, user):
         """
         Register a subscription request
@@ -341,6 +430,7 @@ class MockProfileServer(webservice.UserWebService):
 
         self._set_subscription(user, True)
 
+    @_profile_server_call
     def reset_password(self, user):
         """
         Mock sending the user a password reset email.
@@ -359,6 +449,7 @@ class MockProfileServer(webservice.UserWebService):
         """
         return self.add_groups(user, [group])
 
+    @_profile_server_call
     def add_groups(self, user, groups):
         """
         Add a user to a list of groups
@@ -368,6 +459,7 @@ class MockProfileServer(webservice.UserWebService):
 
         user = self.users.setdefault(username, details)
         user['groups'] = list(set(user['groups'] + groups))
+        profile_user_changed.send(sender=self.__class__, username=username)
 
         return user['groups']
 
@@ -377,6 +469,7 @@ class MockProfileServer(webservice.UserWebService):
         """
         return self.remove_groups(user, [group])
 
+    @_profile_server_call
     def remove_groups(self, user, groups):
         """
         Remove a user from multiple groups
@@ -386,18 +479,90 @@ class MockProfileServer(webservice.UserWebService):
 
         user = self.users[username]
         user['groups'] = list(set(user.get('groups', [])) - set(groups))
+        profile_user_changed.send(sender=self.__class__, username=username)
 
         return user['groups']
 
+    @_profile_server_call
+    def update_groups(self, user, add=(), remove=()):
+        """
+        Add a user to some groups and remove them from others
+        """
+        details = self._user_to_dict(user)
+        username = details['username']
+
+        if username not in self.users:
+            self._raise_failure("User could not be found.")
+
+        user = self.users[username]
+        user['groups'] = sorted((set(user.get('groups', [])) | set(add)) -
+                                set(remove))
+        profile_user_changed.send(sender=self.__class__, username=username)
+
+        return user['groups']
+
+    # pylint:disable=too-many-arguments
+    def sync_group_memberships(self, mapping, managed_groups=None,
+                               lookups_in_flight=None, dry_run=False,
+                               progress=None):
+        """
+        Change the groups of many users to the ones given in a dict keyed by
+        username
+        """
+
+        self._check_group_mapping(mapping)
+        result = {
+            'changed': [],
+            'unchanged': [],
+            'missing': [],
+            'failed': {},
+        }
+
+        for done, (username, groups) in enumerate(mapping.items(), 1):
+            details = self.find_by_username(username)
+            if details is None:
+                result['missing'].append(username)
+            else:
+                add, remove = self._groups_diff(details['groups'], groups,
+                                                managed_groups)
+                if add or remove:
+                    if not dry_run:
+                        self.update_groups(details, add, remove)
+                    result['changed'].append(username)
+                else:
+                    result['unchanged'].append(username)
+
+            if progress is not None:
+                progress(done, len(mapping))
+
+        return result
+
+    @_profile_server_call
     def get_group(self, group, **kwargs):
         """
         Get the users for the groups
 
-        FIXME: Kwargs are ignored
+        Only the offset and limit kwargs are supported.
+        """
+
+        users = [user for user in self.users.values()
+                 if group in user['groups']]
+
+        offset = int(kwargs.get('offset', 0))
+        # As on the profile server, a limit of 0 means no limit
+        limit = int(kwargs.get('limit') or 0)
+        if not limit:
+            return users[offset:]
+
+        return users[offset:offset + limit]
+
+    def _get_group(self, group, cached, **kwargs):
         """
-        return [user for user in self.users.values()
-                if group in user['groups']]
+        Get the users for the groups, for iter_group()
+        """
+        return self.get_group(group, **kwargs)
 
+    @_profile_server_call
     def set_details(self, user, **kwargs):
         """
         Set details for the user
@@ -431,9 +596,11 @@ class MockProfileServer(webservice.UserWebService):
         self._check_username(kwargs)
 
         self.users[username].update(kwargs)
+        profile_user_changed.send(sender=self.__class__, username=username)
 
         return self.users[username]
 
+    @_profile_server_call
     def set_user_data(self, user, key, value):
         """
         Set user data for user
@@ -448,6 +615,7 @@ class MockProfileServer(webservice.UserWebService):
         details = self._user_to_dict(user)
         self.user_data.setdefault(details['username'], []).append(data)
 
+    @_profile_server_call
     def delete_user_data(self, id_):
         """
         Delete user data by id
@@ -458,6 +626,7 @@ class MockProfileServer(webservice.UserWebService):
                 if data['id'] == id_:
                     user_data.remove(data)
 
+    @_profile_server_call
     def get_user_data(self, user, key=None):
         """
         Get user data for the user
@@ -478,12 +647,334 @@ class MockProfileServer(webservice.UserWebService):
             return []
 
 
+def _async_delegate(name):
+    """
+    A coroutine method calling the named method of the wrapped mock.
+    """
+
+    async def method(self, *args, **kwargs):
+        return getattr(self.server, name)(*args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = "Coroutine version of MockProfileServer.%s" % name
+    return method
+
+
+def _delegate_to_server(cls):
+    """
+    Add coroutine versions of the listed methods of the wrapped mock to the
+    class.
+    """
+
+    for name in cls.METHODS:
+        setattr(cls, name, _async_delegate(name))
+
+    return cls
+
+
+@_delegate_to_server
+class AsyncMockProfileServer(webservice.AsyncUserWebService):
+    """
+    A mock asynchronous profile server
+
+    The data is kept in a MockProfileServer, which can be shared with the
+    blocking mock to set up and check the same users.
+    """
+
+    METHODS = (
+        'subscribe',
+        'unsubscribe',
+        'details',
+        'find_by_username',
+        'find_by_email',
+        'find_by_usernames',
+        'find_by_emails',
+        'list',
+        'register',
+        'connect',
+        'reset_password',
+        'get_group',
+        'add_group',
+        'add_groups',
+        'remove_group',
+        'remove_groups',
+        'update_groups',
+        'set_details',
+        'get_user_data',
+        'set_user_data',
+        'delete_user_data',
+    )
+
+    # pylint:disable=super-init-not-called
+    def __init__(self, server=None):
+        if server is None:
+            server = MockProfileServer()
+        self.server = server
+
+    async def aclose(self):
+        """
+        Nothing to close.
+        """
+
+
+class MockProfileAdapter(BaseAdapter):
+    """
+    A requests transport adapter serving the profile server API from a
+    MockProfileServer, to test a real UserWebService offline:
+
+        adapter = MockProfileAdapter()
+        webservice = UserWebService(adapter=adapter)
+        adapter.server.register(...)
+
+    User details and group listings have ETags, and conditional requests
+    (If-None-Match, If-Match) are answered with 304 and 412 responses like
+    the real server does. All the requests received are recorded in
+    `requests'; failures (error statuses or exceptions such as
+    requests.ConnectionError) can be queued with fail_next().
+    """
+
+    ROUTES = (
+        ('GET', r'^/api/v2/user/$', 'list_users'),
+        ('POST', r'^/api/v2/user/$', 'register'),
+        ('GET', r'^/api/v2/user/([^/]+)/$', 'user'),
+        ('PATCH', r'^/api/v2/user/([^/]+)/$', 'set_details'),
+        ('POST', r'^/api/v2/user/([^/]+)/reset-password/$',
+         'reset_password'),
+        ('GET', r'^/api/v2/user/([^/]+)/preferences/$', 'get_user_data'),
+        ('POST', r'^/api/v2/user-preference/$', 'set_user_data'),
+        ('DELETE', r'^/api/v2/user-preference/(\d+)/$', 'delete_user_data'),
+        ('GET', r'^/api/v2/group/(.+)/$', 'group'),
+    )
+
+    def __init__(self, server=None):
+        super(MockProfileAdapter, self).__init__()
+        if server is None:
+            server = MockProfileServer()
+        self.server = server
+        self.requests = []
+        self.failures = deque()
+
+    def fail_next(self, failure, count=1):
+        """
+        Fail the next count requests with the given error status or
+        exception.
+        """
+        self.failures.extend([failure] * count)
+
+    @staticmethod
+    def etag(data):
+        """
+        The ETag of a resource.
+        """
+        return '"%s"' % sha1(json.dumps(
+            data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+    @staticmethod
+    def _response(request, status_code, data=None, headers=None):
+        """
+        Make a response with the given status and JSON data.
+        """
+
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = responses.get(status_code)
+        response.headers = CaseInsensitiveDict(headers or {})
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+
+        if data is not None:
+            response.headers['Content-Type'] = 'application/json'
+            # pylint:disable=protected-access
+            response._content = json.dumps(
+                data, cls=DjangoJSONEncoder).encode()
+        else:
+            response._content = b''  # pylint:disable=protected-access
+
+        return response
+
+    def _resource(self, request, data):
+        """
+        Respond with a resource, honouring conditional requests.
+        """
+
+        etag = self.etag(data)
+        if request.headers.get('If-None-Match') == etag:
+            return self._response(request, 304, headers={'ETag': etag})
+
+        return self._response(request, 200, data, headers={'ETag': etag})
+
+    def _route(self, method, path):
+        """
+        The name of the handler for a request and the arguments taken from
+        its path, or None if there is none.
+        """
+
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                return handler, [unquote(arg) for arg in match.groups()]
+
+        return None
+
+    @staticmethod
+    def _query(query_string):
+        """
+        The parameters in a query string; repeated ones as lists.
+        """
+
+        query = {}
+        for key, value in parse_qsl(query_string):
+            if key in query:
+                if not isinstance(query[key], list):
+                    query[key] = [query[key]]
+                query[key].append(value)
+            else:
+                query[key] = value
+
+        return query
+
+    @staticmethod
+    def _data(body):
+        """
+        The JSON data in a request body.
+        """
+
+        if isinstance(body, bytes):
+            body = body.decode()
+        return json.loads(body) if body else {}
+
+    # pylint:disable=too-many-arguments
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        """
+        Respond to a request from the mock profile server.
+        """
+
+        self.requests.append(request)
+
+        if self.failures:
+            failure = self.failures.popleft()
+            if isinstance(failure, Exception):
+                raise failure
+            return self._response(request, failure, {})
+
+        url = urlparse(request.url)
+        route = self._route(request.method, url.path)
+        if route is None:
+            return self._response(request, 404, {})
+
+        handler, args = route
+
+        _SERVING.active = True
+        try:
+            return getattr(self, handler)(request, self._query(url.query),
+                                          self._data(request.body), *args)
+        except ProfileServerFailure as failure:
+            return failure.response
+        except ValueError as error:
+            return self._response(request, 400, {'error': str(error)})
+        except KeyError:
+            return self._response(request, 404, {})
+        finally:
+            _SERVING.active = False
+
+    def list_users(self, request, query, data):
+        """
+        List the users.
+        """
+        return self._response(request, 200, self.server.list(**query))
+
+    def register(self, request, query, data):
+        """
+        Register a user.
+        """
+        return self._response(request, 201, self.server.register(data))
+
+    def user(self, request, query, data, username):
+        """
+        Get the user details.
+        """
+
+        details = self.server.find_by_username(username)
+        if details is None:
+            return self._response(request, 404, {})
+
+        return self._resource(request, details)
+
+    def set_details(self, request, query, data, username):
+        """
+        Update the user details.
+        """
+
+        details = self.server.find_by_username(username)
+        if details is None:
+            return self._response(request, 404, {})
+
+        if 'If-Match' in request.headers and \
+                request.headers['If-Match'] != self.etag(details):
+            return self._response(request, 412, {})
+
+        self.server.set_details({'username': username}, **data)
+
+        details = self.server.find_by_username(username)
+        return self._response(request, 202, details,
+                              headers={'ETag': self.etag(details)})
+
+    def reset_password(self, request, query, data, username):
+        """
+        Request a password reset email.
+        """
+        self.server.reset_password(SimpleNamespace(username=username))
+        return self._response(request, 202, {})
+
+    def get_user_data(self, request, query, data, username):
+        """
+        Get the user data.
+        """
+        return self._response(request, 200, {
+            'objects': self.server.get_user_data({'username': username},
+                                                 query.get('type')),
+        })
+
+    def set_user_data(self, request, query, data):
+        """
+        Set user data.
+        """
+        username = data['user'].rstrip('/').split('/')[-1]
+        self.server.set_user_data({'username': username},
+                                  data['type'], data['data'])
+        return self._response(request, 201, data)
+
+    def delete_user_data(self, request, query, data, id_):
+        """
+        Delete user data.
+        """
+        self.server.delete_user_data(int(id_))
+        return self._response(request, 204)
+
+    def group(self, request, query, data, group):
+        """
+        List the users in a group.
+        """
+        return self._resource(request, {
+            'users': self.server.get_group(group, **query),
+        })
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+
+
 def mock_profile_server():
     """
     Switch the profile server to the mocked one.
     """
 
     webservice.profile_server = MockProfileServer()
+    webservice.async_profile_server = \
+        AsyncMockProfileServer(webservice.profile_server)
 
 
 def unmock_profile_server():
@@ -492,3 +983,55 @@ def unmock_profile_server():
     """
 
     webservice.profile_server = RealProfileServer
+    webservice.async_profile_server = RealAsyncProfileServer
+
+
+@contextmanager
+def assert_num_profile_server_calls(num, all_threads=False):
+    """
+    A context manager failing if the number of profile server calls made in
+    the block is not num, listing the number of calls for each operation.
+
+    The requests sent by UserWebService are counted, as well as the calls
+    to the MockProfileServer methods corresponding to a request. If
+    all_threads is True, the calls made by all the threads are counted.
+    """
+
+    with CallRecorder(all_threads=all_threads) as recorder:
+        yield recorder
+
+    check_num_profile_server_calls(recorder, num)
+
+
+def check_num_profile_server_calls(recorder, num):
+    """
+    Fail if the number of calls recorded is not num, listing the number of
+    calls for each operation.
+    """
+
+    if recorder.count != num:
+        raise AssertionError(
+            "%d profile server calls were made, %d expected:\n%s" % (
+                recorder.count, num, '\n'.join(
+                    '  %s: %d' % item
+                    for item in sorted(recorder.operations().items()))))
+
+
+class ProfileServerCallsMixin:
+    """
+    A test case mixin to check the number of profile server calls.
+    """
+
+    # pylint:disable=invalid-name,keyword-arg-before-vararg
+    def assertNumProfileServerCalls(self, num, func=None, *args, **kwargs):
+        """
+        Check the number of profile server calls made by func, called with
+        the given arguments, or in the block if used as a context manager.
+        """
+
+        context = assert_num_profile_server_calls(num)
+        if func is None:
+            return context
+
+        with context:
+            return func(*args, **kwargs)
@@ -0,0 +1,136 @@
+"""
+An OpenID store keeping associations and nonces in a Django cache
+"""
+
+import json
+from hashlib import sha1
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store.nonce import SKEW
+
+
+class CacheOpenIDStore(OpenIDStore):
+    """
+    An OpenID store keeping associations and nonces in the Django cache with
+    the given alias, instead of the database.
+
+    Associations are kept until they expire, the latest one of each server
+    also under its own key; nonces are kept for as long as their timestamps
+    are within the allowed clock skew. The cache must be shared by all the
+    processes handling logins, e.g. memcached or Redis, and its add() must
+    be atomic to reject a replayed nonce.
+    """
+
+    # pylint:disable=invalid-name
+    # The method names are a part of the OpenID store API
+
+    def __init__(self, alias='default', prefix='ixprofile:openid'):
+        self.cache = caches[alias]
+        self.prefix = prefix
+
+    @classmethod
+    def from_settings(cls):
+        """
+        The store configured in the settings, or None to use the database.
+        """
+
+        alias = getattr(settings, 'PROFILE_SERVER_OPENID_STORE_CACHE', None)
+        if alias is None:
+            return None
+
+        return cls(alias)
+
+    def _key(self, *parts):
+        """
+        A Django cache key safe for any backend.
+        """
+        digest = sha1(json.dumps(parts).encode()).hexdigest()
+        return '%s:%s:%s' % (self.prefix, parts[0], digest)
+
+    @staticmethod
+    def _expires_in(association):
+        """
+        The seconds until the association expires.
+        """
+        if hasattr(association, 'getExpiresIn'):
+            return association.getExpiresIn()
+        return association.expiresIn
+
+    def storeAssociation(self, server_url, association):
+        """
+        Keep the association until it expires.
+        """
+
+        timeout = self._expires_in(association)
+        if timeout <= 0:
+            return
+
+        data = association.serialize()
+        self.cache.set_many({
+            self._key('association', server_url, association.handle): data,
+            self._key('association', server_url): data,
+        }, timeout)
+
+    def getAssociation(self, server_url, handle=None):
+        """
+        The association with the handle, or the latest one with the server,
+        if any and not expired.
+        """
+
+        data = self.cache.get(self._key('association', server_url, handle)
+                              if handle is not None
+                              else self._key('association', server_url))
+        if data is None:
+            return None
+
+        association = Association.deserialize(data)
+        if self._expires_in(association) <= 0:
+            return None
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        """
+        Remove the association with the handle, returning whether there was
+        one.
+        """
+
+        key = self._key('association', server_url, handle)
+        latest_key = self._key('association', server_url)
+        values = self.cache.get_many((key, latest_key))
+
+        latest = values.get(latest_key)
+        if latest is not None and \
+                Association.deserialize(latest).handle == handle:
+            self.cache.delete(latest_key)
+
+        self.cache.delete(key)
+        return key in values
+
+    def useNonce(self, server_url, timestamp, salt):
+        """
+        Whether the nonce is valid and wasn't used before.
+        """
+
+        now = time()
+        if abs(timestamp - now) > SKEW:
+            return False
+
+        return self.cache.add(self._key('nonce', server_url, timestamp, salt),
+                              True, max(int(timestamp + SKEW - now) + 1, 1))
+
+    def cleanupNonces(self):
+        """
+        Nothing to clean up: the nonces expire from the cache.
+        """
+        return 0
+
+    def cleanupAssociations(self):
+        """
+        Nothing to clean up: the associations expire from the cache.
+        """
+        return 0
@@ -10,17 +10,237 @@ from future.builtins import *
 # pylint:enable=redefined-builtin,unused-wildcard-import
 
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import monotonic, time
 from urllib.parse import unquote, urlparse  # pylint:disable=import-error
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.dispatch import receiver
 from django.http import HttpResponseRedirect
 
 from social_core.exceptions import AuthFailed
 
 import ixprofile_client.webservice
+from ixprofile_client.cache import LRUCache
+from ixprofile_client.metrics import with_current_recorders
+from ixprofile_client.resilience import with_current_deadline
+from ixprofile_client.signals import profile_user_changed
 # pylint:enable=wrong-import-position
 
+LOG = getLogger(__name__)
+
+DEFAULT_SUBSCRIPTION_CACHE_SIZE = 1000
+DEFAULT_MAX_STALENESS = 300
+DEFAULT_LOGIN_THREADS = 32
+# Threads refreshing stale subscription statuses in the background
+REFRESH_THREADS = 2
+
+# The session key of the profile details of the logged in user
+PROFILE_DETAILS_SESSION_KEY = 'ixprofile_details'
+# The profile details kept in the session
+DEFAULT_SESSION_DETAILS_FIELDS = ('username', 'email', 'first_name',
+                                  'last_name', 'subscribed', 'groups')
+DEFAULT_SESSION_DETAILS_TTL = 300
+
+
+class SubscriptionCache:
+    """
+    The details of users logging in, for checking their subscription, served
+    stale while they're revalidated.
+
+    A status younger than PROFILE_SERVER_SUBSCRIPTION_TTL seconds (default 0,
+    disabled) is served as is. An older one, up to
+    PROFILE_SERVER_SUBSCRIPTION_MAX_STALENESS seconds (default 300), is served
+    and refreshed in the background. Older than that, the profile server is
+    asked before the login proceeds, in the lookup executor if given, or
+    else in the calling thread.
+
+    The status of a user changed through the client of this process is
+    forgotten straight away.
+    """
+
+    # pylint:disable=too-many-arguments
+    def __init__(self, ttl, max_staleness, lookup_executor=None,
+                 maxsize=DEFAULT_SUBSCRIPTION_CACHE_SIZE, timer=monotonic):
+        self.ttl = ttl
+        self.max_staleness = max(max_staleness, ttl)
+        self.timer = timer
+        self._statuses = LRUCache(maxsize, self.max_staleness, timer=timer)
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        # Bumped on every invalidation, so that the statuses being fetched
+        # meanwhile aren't kept
+        self._generation = 0
+        self.lookup_executor = lookup_executor
+        self.refresh_executor = ThreadPoolExecutor(
+            max_workers=REFRESH_THREADS)
+
+    @classmethod
+    def from_settings(cls):
+        """
+        The cache configured in the settings, or None if disabled.
+        """
+
+        ttl = getattr(settings, 'PROFILE_SERVER_SUBSCRIPTION_TTL', 0)
+        if not ttl:
+            return None
+
+        return cls(ttl,
+                   getattr(settings,
+                           'PROFILE_SERVER_SUBSCRIPTION_MAX_STALENESS',
+                           DEFAULT_MAX_STALENESS),
+                   lookup_executor=login_executor())
+
+    @staticmethod
+    def fetch(username):
+        """
+        Get the details of the user from the profile server, bypassing the
+        caches of the client, so the statuses are never older than
+        max_staleness.
+        """
+
+        webservice = ixprofile_client.webservice.profile_server
+        # pylint:disable=protected-access
+        return webservice._fetch_user(username)
+
+    def _fetch_and_keep(self, username):
+        """
+        Get the details of the user from the profile server, and keep them
+        unless the user was changed meanwhile.
+        """
+
+        generation = self._generation
+        details = self.fetch(username)
+        with self._lock:
+            if generation == self._generation:
+                self._statuses.set(username, (details, self.timer()))
+        return details
+
+    def _refresh(self, username):
+        """
+        Refresh the status of the user in the background, unless it already
+        is being refreshed.
+        """
+
+        with self._lock:
+            if username in self._refreshing:
+                return
+            self._refreshing.add(username)
+
+        def refresh():
+            """
+            Refresh the status, keeping the stale one if it fails.
+            """
+            try:
+                self._fetch_and_keep(username)
+            except Exception:  # pylint:disable=broad-except
+                LOG.warning("Failed to refresh the subscription of '%s'",
+                            username, exc_info=True)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(username)
+
+        self.refresh_executor.submit(with_current_recorders(refresh))
+
+    def details(self, username):
+        """
+        A future of the details of the user, None if not found.
+        """
+
+        cached = self._statuses.get(username)
+        if cached is not None:
+            details, fetched = cached
+            if self.timer() - fetched >= self.ttl:
+                self._refresh(username)
+            return _Done(details)
+
+        if self.lookup_executor is None:
+            return _Done(self._fetch_and_keep(username))
+
+        return self.lookup_executor.submit(with_current_deadline(
+            with_current_recorders(self._fetch_and_keep)), username)
+
+    def invalidate(self, username):
+        """
+        Forget the status of the user, e.g. after they are unsubscribed.
+        """
+
+        with self._lock:
+            self._generation += 1
+            self._statuses.pop(username)
+
+
+class _Done:
+    """
+    A future already holding its result.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        """
+        The result.
+        """
+        return self.value
+
+
+_LOCK = threading.RLock()
+_LOGIN_EXECUTORS = {}
+_SUBSCRIPTIONS = {}
+
+
+def login_executor():
+    """
+    The executor asking the profile server about the users logging in, while
+    their accounts are looked up in the database.
+
+    It has PROFILE_SERVER_LOGIN_THREADS threads (default 32), which should be
+    at least the number of requests a process handles at the same time, so
+    that logins don't queue for it.
+    """
+
+    threads = getattr(settings, 'PROFILE_SERVER_LOGIN_THREADS',
+                      DEFAULT_LOGIN_THREADS)
+    with _LOCK:
+        if threads not in _LOGIN_EXECUTORS:
+            _LOGIN_EXECUTORS[threads] = ThreadPoolExecutor(
+                max_workers=threads)
+        return _LOGIN_EXECUTORS[threads]
+
+
+def subscription_cache():
+    """
+    The subscription cache for the current settings, or None if disabled.
+    """
+
+    key = (
+        getattr(settings, 'PROFILE_SERVER_SUBSCRIPTION_TTL', 0),
+        getattr(settings, 'PROFILE_SERVER_SUBSCRIPTION_MAX_STALENESS',
+                DEFAULT_MAX_STALENESS),
+        getattr(settings, 'PROFILE_SERVER_LOGIN_THREADS',
+                DEFAULT_LOGIN_THREADS),
+    )
+    with _LOCK:
+        if key not in _SUBSCRIPTIONS:
+            _SUBSCRIPTIONS[key] = SubscriptionCache.from_settings()
+        return _SUBSCRIPTIONS[key]
+
+
+# pylint:disable=unused-argument
+@receiver(profile_user_changed)
+def forget_subscription(sender, username, **kwargs):
+    """
+    Forget the subscription status of a user changed through the client.
+    """
+
+    for cache in list(_SUBSCRIPTIONS.values()):
+        if cache is not None:
+            cache.invalidate(username)
+
 
 # pylint:disable=unused-argument
 # Unused arguments are a part of the API
@@ -43,26 +263,159 @@ def match_user(strategy, details, response, uid, *args, **kwargs):
     if match:
         username = unquote(match.group(1))
 
-        webservice = ixprofile_client.webservice.profile_server
-        ws_details = webservice.find_by_username(username)
+        cache = subscription_cache()
+        if cache is None:
+            future = login_executor().submit(
+                with_current_deadline(
+                    with_current_recorders(SubscriptionCache.fetch)),
+                username)
+        else:
+            future = cache.details(username)
+
+        # Look the user up while the profile server is asked
+        user = _find_user(username)
+        ws_details = future.result()
+        subscribed = bool(ws_details and ws_details['subscribed'])
 
         # check the user's subscription status
-        if not ws_details['subscribed']:
+        if not subscribed:
             return HttpResponseRedirect("/no-user")
 
-        try:
+        # keep the details for the rest of the pipeline and the session
+        keep_profile_details(strategy, ws_details)
+
+        if user is not None:
             # user is known to us
-            # pylint:disable=no-member
-            user = User.objects.get(username=username)
             return {
                 'username': username,
                 'user': user,
+                'profile_details': ws_details,
             }
-        except User.DoesNotExist:
-            # there is no user account, but the user is subscribed,
-            # pass to create_user to create one
-            return {
-                'username': username,
-            }
+
+        # there is no user account, but the user is subscribed,
+        # pass to create_user to create one
+        return {
+            'username': username,
+            'profile_details': ws_details,
+        }
     else:
         raise AuthFailed("Could not determine username")
+
+
+def _trim_details(details):
+    """
+    The profile details to keep in the session, and their expiry.
+    """
+
+    fields = getattr(settings, 'PROFILE_SERVER_SESSION_DETAILS_FIELDS',
+                     DEFAULT_SESSION_DETAILS_FIELDS)
+    return {
+        'details': {field: details[field]
+                    for field in fields if field in details},
+        'expires': time() + getattr(settings,
+                                    'PROFILE_SERVER_SESSION_DETAILS_TTL',
+                                    DEFAULT_SESSION_DETAILS_TTL),
+    }
+
+
+def keep_profile_details(strategy, details):
+    """
+    Keep a trimmed copy of the profile details of the user logging in, in
+    the session, for profile_details().
+    """
+
+    if getattr(settings, 'PROFILE_SERVER_SESSION_DETAILS_TTL',
+               DEFAULT_SESSION_DETAILS_TTL):
+        strategy.session_set(PROFILE_DETAILS_SESSION_KEY,
+                             _trim_details(details))
+
+
+def profile_details(request):
+    """
+    The profile details of the logged in user, from the copy kept in the
+    session at login while it hasn't expired, or else from the profile
+    server. Only the PROFILE_SERVER_SESSION_DETAILS_FIELDS are returned.
+
+    The lookups of the profile server client don't use the copy; call this
+    instead of find_by_username() for the logged in user.
+    """
+
+    username = request.user.username
+    kept = request.session.get(PROFILE_DETAILS_SESSION_KEY)
+    if kept and kept['details'].get('username') == username and \
+            kept['expires'] > time():
+        return kept['details']
+
+    details = ixprofile_client.webservice.profile_server.find_by_username(
+        username)
+    if details is None:
+        request.session.pop(PROFILE_DETAILS_SESSION_KEY, None)
+        return None
+
+    kept = _trim_details(details)
+    if getattr(settings, 'PROFILE_SERVER_SESSION_DETAILS_TTL',
+               DEFAULT_SESSION_DETAILS_TTL):
+        request.session[PROFILE_DETAILS_SESSION_KEY] = kept
+    return kept['details']
+
+
+# Fields never updated from the details, as in social_core
+DEFAULT_PROTECTED_USER_FIELDS = ('username', 'id', 'pk', 'email', 'password',
+                                 'is_active', 'is_staff', 'is_superuser')
+
+
+# pylint:disable=keyword-arg-before-vararg
+# The signature is that of social_core.pipeline.user.user_details
+def user_details(strategy, details, backend, user=None, *args, **kwargs):
+    """
+    Update the user with the details from the profile server, saving only
+    the fields that changed, if any.
+
+    This replaces social_core.pipeline.user.user_details, honouring the same
+    settings, which saves the whole user whenever anything changed. The user
+    is saved directly rather than through strategy.storage.user.changed(),
+    which takes no fields to save; in social_django it only calls
+    user.save().
+    """
+
+    if not user:
+        return
+
+    if strategy.setting('NO_DEFAULT_PROTECTED_USER_FIELDS') is True:
+        protected = ()
+    else:
+        protected = DEFAULT_PROTECTED_USER_FIELDS
+    protected += tuple(strategy.setting('PROTECTED_USER_FIELDS', []))
+    immutable = tuple(strategy.setting('IMMUTABLE_USER_FIELDS', []))
+    field_mapping = strategy.setting('USER_FIELD_MAPPING', {}, backend)
+    # pylint:disable=protected-access
+    fields = set(field.attname for field in user._meta.concrete_fields)
+
+    changed = []
+    for name, value in details.items():
+        name = field_mapping.get(name, name)
+        if value is None or name not in fields or name in protected:
+            continue
+
+        current = getattr(user, name)
+        if current == value or (name in immutable and current):
+            continue
+
+        setattr(user, name, value)
+        if name not in changed:
+            changed.append(name)
+
+    if changed:
+        user.save(update_fields=changed)
+
+
+def _find_user(username):
+    """
+    The user with the username, or None.
+    """
+
+    try:
+        # pylint:disable=no-member
+        return User.objects.get(username=username)
+    except User.DoesNotExist:
+        return None
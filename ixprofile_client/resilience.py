@@ -0,0 +1,231 @@
+"""
+Retries, circuit breaking and deadlines for requests to the profile server
+"""
+
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+_LOCAL = threading.local()
+
+
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a failed request.
+
+    Only idempotent requests are retried, on connection errors, timeouts and
+    server errors. The delay grows exponentially from backoff up to
+    max_backoff seconds, with full jitter so that the clients of a struggling
+    server don't retry in lockstep.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT',
+                                    'DELETE'))
+    RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+    def __init__(self, retries=2, backoff=0.1, max_backoff=2.0,
+                 sleep_function=sleep):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep_function
+
+    def should_retry(self, method, attempt, response=None):
+        """
+        Whether to retry a request after the given attempt (counting from 0)
+        failed with an error, or the response, if any.
+        """
+
+        if attempt >= self.retries or method not in self.IDEMPOTENT_METHODS:
+            return False
+
+        return response is None or \
+            response.status_code in self.RETRY_STATUSES
+
+    def delay(self, attempt):
+        """
+        How long to wait before retrying after the given attempt.
+        """
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests to a failing server for a while.
+
+    The breaker is 'closed' while the server works. Once at least
+    minimum_calls were made in the last window seconds and the ratio of
+    failures among them reaches failure_threshold, it becomes 'open': all the
+    requests fail immediately for reset_timeout seconds. Then it becomes
+    'half-open' and lets a single request through; if it succeeds, the
+    breaker is closed again, otherwise it is open for another reset_timeout.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # pylint:disable=too-many-arguments
+    def __init__(self, failure_threshold=0.5, minimum_calls=20, window=30,
+                 reset_timeout=30, timer=monotonic):
+        self.failure_threshold = failure_threshold
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._state = self.CLOSED
+        self._opened_at = None
+        self.rejected = 0
+
+    @property
+    def state(self):
+        """
+        The state of the breaker: 'closed', 'open' or 'half-open'.
+        """
+
+        with self._lock:
+            if self._state == self.OPEN and \
+                    self.timer() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        Whether a request can be sent now.
+        """
+
+        with self._lock:
+            if self._state == self.OPEN and \
+                    self.timer() - self._opened_at >= self.reset_timeout:
+                # Let a single request through to probe the server
+                self._state = self.HALF_OPEN
+                return True
+
+            if self._state != self.CLOSED:
+                # Open, or half-open with the probe in flight
+                self.rejected += 1
+                return False
+
+            return True
+
+    def _open(self, now):
+        """
+        Open the breaker.
+        """
+        self._state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+
+    def record(self, success):
+        """
+        Record the outcome of a request.
+        """
+
+        with self._lock:
+            now = self.timer()
+
+            if self._state == self.HALF_OPEN:
+                if success:
+                    self._state = self.CLOSED
+                else:
+                    self._open(now)
+                return
+
+            self._calls.append((now, success))
+            while self._calls[0][0] <= now - self.window:
+                self._calls.popleft()
+
+            failures = sum(1 for _, ok in self._calls if not ok)
+            if len(self._calls) >= self.minimum_calls and \
+                    failures >= self.failure_threshold * len(self._calls):
+                self._open(now)
+
+    def stats(self):
+        """
+        The breaker state and counters.
+        """
+
+        state = self.state
+        with self._lock:
+            return {
+                'state': state,
+                'calls': len(self._calls),
+                'failures': sum(1 for _, ok in self._calls if not ok),
+                'rejected': self.rejected,
+            }
+
+
+def current_deadline():
+    """
+    The time, on the monotonic clock, by which the profile server calls made
+    by this thread must complete, if any.
+    """
+    return getattr(_LOCAL, 'deadline', None)
+
+
+def remaining_time():
+    """
+    The number of seconds left until the deadline of this thread, if any.
+    """
+
+    expires = current_deadline()
+    if expires is None:
+        return None
+
+    return expires - monotonic()
+
+
+@contextmanager
+def _deadline_at(expires):
+    """
+    Set the deadline of this thread for the duration of the block.
+    """
+
+    previous = current_deadline()
+    _LOCAL.deadline = expires
+    try:
+        yield
+    finally:
+        _LOCAL.deadline = previous
+
+
+def deadline(seconds):
+    """
+    A context manager limiting the time all the profile server calls made in
+    the block can take, including retries and operations making several
+    calls.
+
+    Nested deadlines can only shorten the time available. Once the deadline
+    has expired, the calls raise ProfileServerTimeout.
+    """
+
+    expires = monotonic() + seconds
+    previous = current_deadline()
+    if previous is not None:
+        expires = min(expires, previous)
+
+    return _deadline_at(expires)
+
+
+def with_current_deadline(function):
+    """
+    Wrap the function to run under the deadline of the calling thread, for
+    running it in another thread.
+    """
+
+    expires = current_deadline()
+
+    def wrapper(*args, **kwargs):
+        """
+        Run the function under the deadline.
+        """
+        with _deadline_at(expires):
+            return function(*args, **kwargs)
+
+    return wrapper
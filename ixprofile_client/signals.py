@@ -0,0 +1,10 @@
+"""
+Signals sent by the profile server client
+"""
+
+from django.dispatch import Signal
+
+# Sent with the username when a user is changed on the profile server through
+# this client, e.g. unsubscribed, so that the copies of its details kept
+# elsewhere in the process can be forgotten
+profile_user_changed = Signal()  # pylint:disable=invalid-name
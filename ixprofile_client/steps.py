@@ -31,7 +31,7 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import reverse
 from django.utils.timezone import now
 
-from aloe import before, step, world
+from aloe import after, before, step, world
 from aloe.tools import guess_types
 
 # pylint:disable=no-name-in-module
@@ -42,7 +42,9 @@ from social_core.exceptions import AuthException
 import social_django.views
 
 from ixprofile_client import webservice
+from ixprofile_client.metrics import CallRecorder
 from ixprofile_client.mock import (
+    check_num_profile_server_calls,
     mock_profile_server,
     MockProfileServer,
     unmock_profile_server,
@@ -498,6 +500,46 @@ def initialise_profile_server(scenario, *args):
         auth_handler.use_auth = auth_handler.fake_no_auth
 
 
+@step(r'I start counting the profile server calls')
+def start_counting_calls(_):
+    """
+    Start counting the profile server calls made by the application, from
+    any thread.
+    """
+
+    stop_counting_calls()
+    world.profile_server_calls = CallRecorder(all_threads=True)
+    world.profile_server_calls.start()
+
+
+@step(r'(\d+) profile server calls? (?:was|were) made')
+def check_calls(_, num):
+    """
+    Check the number of profile server calls made since counting started,
+    and start counting again.
+    """
+
+    recorder = world.profile_server_calls
+    recorder.stop()
+    world.profile_server_calls = CallRecorder(all_threads=True)
+    world.profile_server_calls.start()
+
+    check_num_profile_server_calls(recorder, int(num))
+
+
+@after.each_example  # pylint:disable=no-member
+# pylint:disable= unused-argument
+def stop_counting_calls(*args):
+    """
+    Stop counting the profile server calls, if started.
+    """
+
+    recorder = getattr(world, 'profile_server_calls', None)
+    if recorder is not None:
+        recorder.stop()
+        world.profile_server_calls = None
+
+
 @step(r'I have last invoked the profile server list '
       'with the following kwargs?:')
 def verify_last_list_call(self):
@@ -6,3 +6,6 @@ Feature: Test fake profile server
       | hmcdoogal@px.ea | false      | Hattie     | McDoogal  |            |                       |
       | acalculon@px.ea | true       | Antonio    | Calculon  | 0292538800 |                       |
       | mendoza@mcog.fr | true       | Mendoza    | Unknown   |            | golden-condor,solaris |
+    When I start counting the profile server calls
+    Then the email "zoidberg@px.ea" exists in the fake profile server
+    And 1 profile server call was made
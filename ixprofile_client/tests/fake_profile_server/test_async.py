@@ -0,0 +1,40 @@
+"""
+Test the asynchronous fake profile server.
+"""
+
+from __future__ import absolute_import
+
+from ...mock import AsyncMockProfileServer
+from ..test_webservice import run
+from . import FakeProfileServerTestCase
+
+
+class AsyncMockTestCase(FakeProfileServerTestCase):
+    """
+    Test the asynchronous fake profile server.
+    """
+
+    def setUp(self):
+        """
+        Wrap the mock in an asynchronous one.
+        """
+
+        super(AsyncMockTestCase, self).setUp()
+        self.async_mock_ps = AsyncMockProfileServer(self.mock_ps)
+
+    def test_shared_users(self):
+        """
+        Test users registered in the blocking mock are visible to the
+        asynchronous one and vice versa.
+        """
+
+        self.mock_ps.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+        })
+        run(self.async_mock_ps.add_groups({'username': 'bob'}, ['group1']))
+
+        details = run(self.async_mock_ps.find_by_email('bob@gov.gl'))
+        self.assertEqual(details['username'], 'bob')
+        self.assertEqual(self.mock_ps.find_by_username('bob')['groups'],
+                         ['group1'])
@@ -112,6 +112,21 @@ class UserDetailsTestCase(FakeProfileServerTestCase):
             None
         )
 
+    def test_find_many(self):
+        """
+        Test finding details of several users at once.
+        """
+
+        users = self.mock_ps.find_by_usernames(['corvax', 'sylvia'])
+        self.assertEqual(set(users), {'corvax', 'sylvia'})
+        self.assertEqual(users['corvax']['email'], 'corvax@gov.gl')
+        self.assertIsNone(users['sylvia'])
+
+        users = self.mock_ps.find_by_emails(['bob@gov.gl', 'sylvia@gov.gl'])
+        self.assertEqual(set(users), {'bob@gov.gl', 'sylvia@gov.gl'})
+        self.assertEqual(users['bob@gov.gl']['username'], self.bob_username)
+        self.assertIsNone(users['sylvia@gov.gl'])
+
     def test_set_details(self):
         """
         Test setting a user's details.
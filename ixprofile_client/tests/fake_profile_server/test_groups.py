@@ -0,0 +1,45 @@
+"""
+Test listing the users in groups in the fake profile server.
+"""
+
+from . import FakeProfileServerTestCase
+
+
+class GroupsTestCase(FakeProfileServerTestCase):
+    """
+    Test listing the users in groups.
+    """
+
+    def setUp(self):
+        """
+        Register users in a group
+        """
+        super(GroupsTestCase, self).setUp()
+
+        for index in range(5):
+            self.mock_ps.register({
+                'email': 'user%d@gov.gl' % index,
+                'username': 'user%d' % index,
+                'groups': ['group1'],
+            })
+
+    def test_iter_group(self):
+        """
+        Test iterating over a group a page at a time
+        """
+
+        self.assertEqual(
+            [user['username']
+             for user in self.mock_ps.iter_group('group1', page_size=2)],
+            ['user0', 'user1', 'user2', 'user3', 'user4'])
+        self.assertEqual(list(self.mock_ps.iter_group('group2')), [])
+
+    def test_get_groups(self):
+        """
+        Test getting several groups at once
+        """
+
+        self.assertEqual(
+            {group: len(users) for group, users
+             in self.mock_ps.get_groups(['group1', 'group2']).items()},
+            {'group1': 5, 'group2': 0})
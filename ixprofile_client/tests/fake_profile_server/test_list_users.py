@@ -6,7 +6,9 @@ from __future__ import absolute_import
 
 from operator import itemgetter
 
+from ...mock import AsyncMockProfileServer
 from ...util import leave_only_keys
+from ..test_webservice import run
 from . import FakeProfileServerTestCase
 
 
@@ -106,3 +108,76 @@ class ListUserTestCase(FakeProfileServerTestCase):
                 ]
             },
         ])
+
+    def test_pagination(self):
+        """
+        Test the links to the next and previous pages.
+        """
+
+        users = self.mock_ps.list(include_adminable=True, limit=1, offset=1)
+
+        self.assertEqual(users['meta']['total_count'], 3)
+        self.assertEqual(
+            users['meta']['next'],
+            '/api/v2/user/?include_adminable=True&limit=1&offset=2')
+        self.assertEqual(
+            users['meta']['previous'],
+            '/api/v2/user/?include_adminable=True&limit=1&offset=0')
+
+        users = self.mock_ps.list(include_adminable=True, limit=1, offset=2)
+
+        self.assertIsNone(users['meta']['next'])
+
+    def test_iter_users(self):
+        """
+        Test iterating over all the users a page at a time.
+        """
+
+        users = self.mock_ps.iter_users(page_size=1, include_adminable=True)
+
+        self.assertEqual([user['email'] for user in users], [
+            'bob@gov.gl',
+            'corvax@gov.gl',
+            'muzzy@stell.ar',
+        ])
+        self.assertEqual(self.mock_ps.last_list_kwargs, {
+            'include_adminable': True,
+            'limit': 1,
+            'offset': 2,
+        })
+
+    def test_iter_users_concurrently(self):
+        """
+        Test iterating over all the users fetching pages concurrently.
+        """
+
+        users = self.mock_ps.iter_users(page_size=1, pages_in_flight=2,
+                                        include_adminable=True)
+
+        self.assertEqual([user['email'] for user in users], [
+            'bob@gov.gl',
+            'corvax@gov.gl',
+            'muzzy@stell.ar',
+        ])
+
+    def test_iter_users_async(self):
+        """
+        Test iterating over all the users with the asynchronous client.
+        """
+
+        async def emails():
+            """
+            Collect the emails of all the users.
+            """
+            result = []
+            async for user in AsyncMockProfileServer(self.mock_ps) \
+                    .iter_users(page_size=1, pages_in_flight=2,
+                                include_adminable=True):
+                result.append(user['email'])
+            return result
+
+        self.assertEqual(run(emails()), [
+            'bob@gov.gl',
+            'corvax@gov.gl',
+            'muzzy@stell.ar',
+        ])
@@ -7,6 +7,8 @@ from __future__ import absolute_import
 # pylint:disable=no-name-in-module
 from nose.tools import assert_not_in
 
+from ixprofile_client.exceptions import ProfileServerFailure
+
 from . import FakeProfileServerTestCase
 
 
@@ -41,3 +43,22 @@ class RemoveGroupsTestCase(FakeProfileServerTestCase):
         users = self.mock_ps.get_group('group2')
         assert_not_in('philip.j.fry@planet.express',
                       [user['email'] for user in users])
+
+    def test_update_groups(self):
+        """
+        Test adding and removing groups at once
+        """
+
+        calculon = {
+            'email': 'acalculon@all.my.circuits',
+            'username': 'calculon',
+        }
+        self.mock_ps.add_groups(calculon, ['group1', 'group2'])
+
+        self.assertEqual(
+            self.mock_ps.update_groups(calculon,
+                                       add=['group3'], remove=['group1']),
+            ['group2', 'group3'])
+
+        with self.assertRaises(ProfileServerFailure):
+            self.mock_ps.update_groups({'username': 'fry'}, add=['group1'])
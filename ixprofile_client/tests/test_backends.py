@@ -0,0 +1,228 @@
+"""
+Tests for the authentication and authorization backends
+"""
+from types import SimpleNamespace
+from unittest import TestCase
+
+from django.core.cache import cache as django_cache
+from django.test import override_settings
+from mock import patch
+from openid.consumer.discover import OpenIDServiceEndpoint
+
+from ixprofile_client import webservice
+from ixprofile_client.backends import (
+    DiscoveryCache,
+    IXProfile,
+    ProfileGroupBackend,
+)
+from ixprofile_client.cache import LRUCache, SharedCache
+from ixprofile_client.exceptions import ProfileServerUnavailable
+from ixprofile_client.mock import (
+    ProfileServerCallsMixin,
+    mock_profile_server,
+    unmock_profile_server,
+)
+from ixprofile_client.tests.test_cache import FakeTimer
+
+
+class ProfileGroupBackendTestCase(ProfileServerCallsMixin, TestCase):
+    """
+    Test granting permissions by the profile server groups.
+    """
+
+    def setUp(self):
+        """
+        Configure the groups and mock the profile server
+        """
+        settings = override_settings(
+            PROFILE_SERVER_GROUP_PERMISSIONS={
+                'staff': ['news.add_article', 'news.change_article'],
+                'volunteer': ['events.add_event'],
+            },
+            PROFILE_SERVER_GROUP_DJANGO_GROUPS={
+                'admin': ['Editors'],
+            },
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        mock_profile_server()
+        webservice.profile_server.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+            'groups': ['staff', 'admin'],
+        })
+        self.backend = ProfileGroupBackend()
+        ProfileGroupBackend.groups_cache = LRUCache(10, 60)
+
+        patcher = patch.object(
+            ProfileGroupBackend, '_django_group_permissions',
+            side_effect=lambda names: {'news.delete_article'}
+            if 'Editors' in names else set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """
+        Restore the profile server
+        """
+        unmock_profile_server()
+        ProfileGroupBackend.groups_cache = None
+
+    @staticmethod
+    def user(username='bob', is_active=True):
+        """
+        A user for checking the permissions of.
+        """
+        return SimpleNamespace(username=username, is_active=is_active,
+                               is_anonymous=False)
+
+    def test_permissions(self):
+        """
+        Test the permissions of the groups are granted.
+        """
+
+        user = self.user()
+
+        self.assertEqual(self.backend.get_all_permissions(user), {
+            'news.add_article',
+            'news.change_article',
+            'news.delete_article',
+        })
+        self.assertTrue(self.backend.has_perm(user, 'news.add_article'))
+        self.assertFalse(self.backend.has_perm(user, 'events.add_event'))
+        self.assertTrue(self.backend.has_module_perms(user, 'news'))
+        self.assertFalse(self.backend.has_module_perms(user, 'events'))
+
+        self.assertFalse(self.backend.has_perm(self.user(is_active=False),
+                                               'news.add_article'))
+        self.assertFalse(self.backend.has_perm(self.user('alice'),
+                                               'news.add_article'))
+
+    def test_cached(self):
+        """
+        Test the profile server is called once per user, not per check.
+        """
+
+        with self.assertNumProfileServerCalls(1):
+            for _ in range(3):
+                user = self.user()
+                self.backend.has_perm(user, 'news.add_article')
+                self.backend.has_perm(user, 'events.add_event')
+
+    def test_changed(self):
+        """
+        Test the groups of a user changed through the client are forgotten.
+        """
+
+        self.assertFalse(self.backend.has_perm(self.user(),
+                                               'events.add_event'))
+
+        webservice.profile_server.add_groups({'username': 'bob'},
+                                             ['volunteer'])
+
+        with self.assertNumProfileServerCalls(1):
+            self.assertTrue(self.backend.has_perm(self.user(),
+                                                  'events.add_event'))
+
+    def test_failure(self):
+        """
+        Test no permissions are granted, or cached, if the profile server
+        fails.
+        """
+
+        with patch.object(webservice.profile_server, 'groups_for',
+                          side_effect=ProfileServerUnavailable("Down")):
+            with self.assertLogs('ixprofile_client.backends', 'WARNING'):
+                self.assertFalse(self.backend.has_perm(self.user(),
+                                                       'news.add_article'))
+
+        self.assertTrue(self.backend.has_perm(self.user(),
+                                              'news.add_article'))
+
+
+class DiscoveryCacheTestCase(TestCase):
+    """
+    Test caching the OpenID discovery results.
+    """
+
+    def setUp(self):
+        """
+        Mock the discovery of the profile server
+        """
+
+        service = OpenIDServiceEndpoint()
+        service.server_url = 'https://ps/id/endpoint/'
+        service.type_uris = ['http://specs.openid.net/auth/2.0/server']
+        service.used_yadis = True
+
+        patcher = patch('ixprofile_client.backends.discover',
+                        return_value=('https://ps/id/xrds/', [service]))
+        self.discover = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.timer = FakeTimer()
+
+    def test_cached(self):
+        """
+        Test the discovery is only repeated after the TTL.
+        """
+
+        cache = DiscoveryCache(60, timer=self.timer)
+
+        for _ in range(2):
+            claimed_id, services = cache.discover('https://ps/id/xrds/')
+            self.assertEqual(claimed_id, 'https://ps/id/xrds/')
+            self.assertEqual(services[0].server_url, 'https://ps/id/endpoint/')
+            self.assertTrue(services[0].isOPIdentifier())
+        self.assertEqual(self.discover.call_count, 1)
+
+        # Every caller gets its own services
+        self.assertIsNot(cache.discover('https://ps/id/xrds/')[1][0],
+                         services[0])
+
+        self.timer.now = 60
+        cache.discover('https://ps/id/xrds/')
+        self.assertEqual(self.discover.call_count, 2)
+
+    def test_shared(self):
+        """
+        Test the discovery results are shared between processes.
+        """
+
+        django_cache.clear()
+        for _ in range(2):
+            cache = DiscoveryCache(60, shared_cache=SharedCache(ttl=60))
+            _, services = cache.discover('https://ps/id/xrds/')
+            self.assertEqual(services[0].server_url, 'https://ps/id/endpoint/')
+        self.assertEqual(self.discover.call_count, 1)
+
+    def test_no_services(self):
+        """
+        Test results without any services are not cached.
+        """
+
+        self.discover.return_value = ('https://ps/id/xrds/', [])
+        cache = DiscoveryCache(60, timer=self.timer)
+
+        for _ in range(2):
+            self.assertEqual(cache.discover('https://ps/id/xrds/'),
+                             ('https://ps/id/xrds/', []))
+        self.assertEqual(self.discover.call_count, 2)
+
+    def test_backend(self):
+        """
+        Test the backend's consumer discovers through the cache.
+        """
+
+        strategy = SimpleNamespace(openid_session_dict=lambda name: {},
+                                   request_data=dict,
+                                   absolute_uri=lambda uri=None: uri)
+        with patch.object(IXProfile, 'discovery_cache',
+                          DiscoveryCache(60, timer=self.timer)):
+            consumer = IXProfile(strategy).create_consumer()
+            # pylint:disable=protected-access
+            self.assertEqual(consumer._discover,
+                             IXProfile.discovery_cache.discover)
+            self.assertEqual(consumer.consumer._discover,
+                             IXProfile.discovery_cache.discover)
@@ -0,0 +1,191 @@
+"""
+Tests for the profile server record caches
+"""
+from unittest import TestCase
+
+from django.core.cache import cache
+
+from ixprofile_client.cache import COMPRESSED, LRUCache, SharedCache
+
+
+class FakeTimer:
+    """
+    A clock advanced by hand.
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(TestCase):
+    """
+    Tests for the in-process LRU cache
+    """
+
+    def setUp(self):
+        """
+        Create a small cache
+        """
+        self.timer = FakeTimer()
+        self.cache = LRUCache(2, 10, timer=self.timer)
+
+    def test_get(self):
+        """
+        Test getting cached values.
+        """
+
+        self.cache.set('a', 1)
+
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expiry(self):
+        """
+        Test values expire after the TTL.
+        """
+
+        self.cache.set('a', 1)
+        self.timer.now = 10
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_eviction(self):
+        """
+        Test the least recently used value is evicted.
+        """
+
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_pop(self):
+        """
+        Test removing values.
+        """
+
+        self.cache.set('a', 1)
+
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertIsNone(self.cache.pop('a'))
+        self.assertIsNone(self.cache.get('a'))
+
+
+class SharedCacheTestCase(TestCase):
+    """
+    Tests for the cache shared between processes
+    """
+
+    def setUp(self):
+        """
+        Create two caches, as if in different processes
+        """
+        cache.clear()
+        self.cache = SharedCache()
+        self.other_cache = SharedCache()
+        self.fetches = []
+
+    def fetch(self, value):
+        """
+        A fetch function recording its calls.
+        """
+
+        def fetch():
+            """
+            Return the value.
+            """
+            self.fetches.append(value)
+            return value
+
+        return fetch
+
+    def test_get_or_fetch(self):
+        """
+        Test records are fetched once for all processes.
+        """
+
+        self.assertEqual(
+            self.cache.get_or_fetch('user', 'bob', self.fetch({'a': 1})),
+            {'a': 1})
+        self.assertEqual(
+            self.other_cache.get_or_fetch('user', 'bob', self.fetch(None)),
+            {'a': 1})
+        self.assertEqual(self.fetches, [{'a': 1}])
+
+    def test_none_not_cached(self):
+        """
+        Test None isn't cached.
+        """
+
+        self.cache.get_or_fetch('user', 'bob', self.fetch(None))
+        self.cache.get_or_fetch('user', 'bob', self.fetch(None))
+
+        self.assertEqual(self.fetches, [None, None])
+
+    def test_variants(self):
+        """
+        Test the subject records are invalidated together.
+        """
+
+        self.cache.get_or_fetch('group', 'g', self.fetch([1]), variant=1)
+        self.cache.get_or_fetch('group', 'g', self.fetch([2]), variant=2)
+        self.other_cache.invalidate('group', 'g')
+        self.cache.get_or_fetch('group', 'g', self.fetch([1]), variant=1)
+        self.cache.get_or_fetch('group', 'g', self.fetch([2]), variant=2)
+
+        self.assertEqual(self.fetches, [[1], [2], [1], [2]])
+
+    def test_invalidate_namespace(self):
+        """
+        Test invalidating all the records in a namespace.
+        """
+
+        self.cache.get_or_fetch('preferences', 'a', self.fetch([1]))
+        self.cache.get_or_fetch('user', 'a', self.fetch({}))
+        self.other_cache.invalidate_namespace('preferences')
+        self.cache.get_or_fetch('preferences', 'a', self.fetch([1]))
+        self.cache.get_or_fetch('user', 'a', self.fetch({}))
+
+        self.assertEqual(self.fetches, [[1], {}, [1]])
+
+    def test_invalidated_while_fetching(self):
+        """
+        Test a record invalidated while it is being fetched isn't used.
+        """
+
+        def fetch():
+            """
+            Simulate another process changing the record.
+            """
+            self.other_cache.invalidate('user', 'bob')
+            return 'old'
+
+        self.cache.get_or_fetch('user', 'bob', fetch)
+
+        self.assertEqual(
+            self.cache.get_or_fetch('user', 'bob', self.fetch('new')),
+            'new')
+
+    def test_compression(self):
+        """
+        Test large records are compressed.
+        """
+
+        users = [{'email': 'user%d@example.com' % i} for i in range(100)]
+
+        data = self.cache.dumps(users)
+
+        self.assertEqual(data[:1], COMPRESSED)
+        self.assertEqual(self.cache.loads(data), users)
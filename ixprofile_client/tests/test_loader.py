@@ -0,0 +1,71 @@
+"""
+Tests for the batched user details loader
+"""
+from unittest import TestCase
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from mock import patch
+
+from ixprofile_client.loader import ProfileLoader, current_loader
+from ixprofile_client.middleware import ProfileLoaderMiddleware
+from ixprofile_client.mock import MockProfileServer
+
+
+class ProfileLoaderTestCase(TestCase):
+    """
+    Tests for the batched user details loader
+    """
+
+    def setUp(self):
+        """
+        Create a loader using a mock profile server
+        """
+        self.mock_ps = MockProfileServer()
+        for username in ('bob', 'corvax'):
+            self.mock_ps.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+            })
+
+        self.loader = ProfileLoader(self.mock_ps)
+
+    def test_batching(self):
+        """
+        Test all the requested users are loaded at once.
+        """
+
+        with patch.object(self.mock_ps, 'find_by_usernames',
+                          wraps=self.mock_ps.find_by_usernames) as find:
+            bob = self.loader.find_by_username('bob')
+            corvax = self.loader.find_by_username('corvax')
+            sylvia = self.loader.find_by_username('sylvia')
+
+            self.assertEqual(find.call_count, 0)
+
+            self.assertEqual(bob['email'], 'bob@gov.gl')
+            self.assertEqual(corvax['email'], 'corvax@gov.gl')
+            self.assertFalse(sylvia)
+            self.assertIsNone(sylvia.details)
+            self.assertEqual(
+                self.loader.find_by_username('bob').get('email'),
+                'bob@gov.gl')
+
+        find.assert_called_once_with({'bob', 'corvax', 'sylvia'})
+
+    def test_middleware(self):
+        """
+        Test the middleware gives each request a loader.
+        """
+
+        def view(request):
+            """
+            Check the request has the current loader.
+            """
+            self.assertIsInstance(request.profile_loader, ProfileLoader)
+            self.assertIs(current_loader(), request.profile_loader)
+            return HttpResponse()
+
+        ProfileLoaderMiddleware(view)(RequestFactory().get('/'))
+
+        self.assertIsNone(current_loader())
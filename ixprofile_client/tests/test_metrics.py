@@ -0,0 +1,288 @@
+"""
+Tests for the profile server request metrics
+"""
+from types import SimpleNamespace
+from unittest import TestCase
+
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, override_settings
+from mock import patch
+
+from ixprofile_client import views, webservice
+from ixprofile_client.metrics import CallRecorder, PrometheusMetrics
+from ixprofile_client.middleware import ProfileServerTimingMiddleware
+from ixprofile_client.mock import (
+    MockProfileAdapter,
+    MockProfileServer,
+    ProfileServerCallsMixin,
+)
+from ixprofile_client.resilience import RetryPolicy
+from ixprofile_client.webservice import UserWebService
+
+
+class PrometheusMetricsTestCase(TestCase):
+    """
+    Tests for the Prometheus metrics
+    """
+
+    def test_render(self):
+        """
+        Test rendering the metrics in the text format.
+        """
+
+        metrics = PrometheusMetrics(buckets=(0.1, 1))
+        metrics.record('list', 200, 0.05, 0, 100, 0)
+        metrics.record('list', 200, 0.5, 0, 200, 1)
+        metrics.record('set_details', 'error', 5, 30, 0, 0)
+
+        lines = metrics.render().splitlines()
+
+        for line in (
+                'ixprofile_request_duration_seconds_bucket'
+                '{le="0.1",operation="list"} 1',
+                'ixprofile_request_duration_seconds_bucket'
+                '{le="1",operation="list"} 2',
+                'ixprofile_request_duration_seconds_bucket'
+                '{le="+Inf",operation="list"} 2',
+                'ixprofile_request_duration_seconds_count'
+                '{operation="list"} 2',
+                'ixprofile_request_duration_seconds_bucket'
+                '{le="1",operation="set_details"} 0',
+                'ixprofile_requests_total'
+                '{operation="list",status="200"} 2',
+                'ixprofile_requests_total'
+                '{operation="set_details",status="error"} 1',
+                'ixprofile_request_bytes_total{operation="set_details"} 30',
+                'ixprofile_response_bytes_total{operation="list"} 300',
+                'ixprofile_retries_total{operation="list"} 1',
+        ):
+            self.assertIn(line, lines)
+
+        metrics.clear()
+        self.assertNotIn('operation', metrics.render())
+
+
+class WebServiceMetricsTestCase(TestCase):
+    """
+    Test the Web service records the metrics of its requests.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.adapter.server.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+        })
+        self.metrics = PrometheusMetrics()
+        self.webservice = UserWebService(
+            adapter=self.adapter,
+            retry_policy=RetryPolicy(retries=2,
+                                     sleep_function=lambda delay: None),
+            metrics=self.metrics)
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_operations(self):
+        """
+        Test requests are recorded by operation.
+        """
+
+        self.adapter.fail_next(503)
+        self.webservice.find_by_username('bob')
+        self.webservice.find_by_username('alice')
+        self.webservice.set_details(SimpleNamespace(username='bob'),
+                                    first_name='Bob')
+
+        lines = self.metrics.render().splitlines()
+        for line in (
+                'ixprofile_requests_total'
+                '{operation="find_by_username",status="200"} 1',
+                'ixprofile_requests_total'
+                '{operation="find_by_username",status="404"} 1',
+                'ixprofile_requests_total'
+                '{operation="set_details",status="202"} 1',
+                'ixprofile_retries_total{operation="find_by_username"} 1',
+                'ixprofile_request_duration_seconds_count'
+                '{operation="find_by_username"} 2',
+        ):
+            self.assertIn(line, lines)
+
+        self.assertIn('ixprofile_request_bytes_total'
+                      '{operation="find_by_username"} 0', lines)
+        self.assertNotIn('ixprofile_request_bytes_total'
+                         '{operation="set_details"} 0', lines)
+
+    @override_settings(PROFILE_SERVER_METRICS_SINK=None)
+    def test_disabled(self):
+        """
+        Test metrics can be disabled.
+        """
+        self.assertIsNone(UserWebService().metrics)
+
+
+class MetricsViewTestCase(TestCase):
+    """
+    Tests for the metrics view
+    """
+
+    def setUp(self):
+        """
+        Create a request for the metrics
+        """
+        self.request = RequestFactory().get('/ixlogin/metrics/')
+
+    @override_settings(PROFILE_SERVER_METRICS_VIEW=True)
+    def test_metrics(self):
+        """
+        Test the metrics of the profile server are rendered.
+        """
+
+        metrics = PrometheusMetrics()
+        metrics.record('list', 200, 0.05, 0, 100, 0)
+
+        with patch.object(webservice.profile_server, 'metrics', metrics):
+            response = views.metrics(self.request)
+
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4')
+        self.assertEqual(response.content.decode(), metrics.render())
+
+    def test_disabled(self):
+        """
+        Test the metrics are not exposed unless enabled.
+        """
+
+        with self.assertRaises(Http404):
+            views.metrics(self.request)
+
+
+class ServerTimingTestCase(TestCase):
+    """
+    Tests for recording the profile server calls of a request
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        for username in ('alice', 'bob', 'carol'):
+            self.adapter.server.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+            })
+        self.webservice = UserWebService(adapter=self.adapter)
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_call_recorder(self):
+        """
+        Test the calls are recorded, including from the thread pools.
+        """
+
+        with CallRecorder() as outer:
+            self.webservice.find_by_username('alice')
+            with CallRecorder() as inner:
+                self.webservice.find_by_usernames(['bob', 'carol'])
+
+        self.webservice.find_by_username('alice')
+
+        self.assertEqual(outer.count, 3)
+        self.assertEqual(inner.count, 2)
+        self.assertEqual(outer.operations(), {'find_by_username': 3})
+
+    def view(self, request):  # pylint:disable=unused-argument
+        """
+        A view looking up users.
+        """
+        for username in ('alice', 'bob', 'carol'):
+            self.webservice.find_by_username(username)
+        return HttpResponse()
+
+    def test_middleware(self):
+        """
+        Test the calls are reported in the response and the log.
+        """
+
+        middleware = ProfileServerTimingMiddleware(self.view)
+
+        with self.assertLogs('ixprofile_client.middleware', 'INFO') as logs:
+            response = middleware(RequestFactory().get('/users/'))
+
+        self.assertRegex(response['Server-Timing'],
+                         r'^profile-server;dur=[0-9.]+;desc="3 calls"$')
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual(logs.records[0].profile_server_calls, 3)
+        self.assertEqual(logs.records[0].profile_server_operations,
+                         {'find_by_username': 3})
+
+    @override_settings(PROFILE_SERVER_CALL_BUDGET=2)
+    def test_budget(self):
+        """
+        Test a warning is logged when the call budget is exceeded.
+        """
+
+        middleware = ProfileServerTimingMiddleware(self.view)
+
+        with self.assertLogs('ixprofile_client.middleware', 'INFO') as logs:
+            middleware(RequestFactory().get('/users/'))
+
+        self.assertEqual(logs.records[0].levelname, 'WARNING')
+        self.assertIn('(budget 2)', logs.output[0])
+
+
+class ProfileServerCallsTestCase(ProfileServerCallsMixin, TestCase):
+    """
+    Tests for checking the number of profile server calls
+    """
+
+    def setUp(self):
+        """
+        Create a mock profile server and a Web service using it
+        """
+        self.server = MockProfileServer()
+        for username in ('alice', 'bob'):
+            self.server.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+            })
+        self.webservice = UserWebService(
+            adapter=MockProfileAdapter(self.server))
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_mock_server(self):
+        """
+        Test counting the calls to the mock profile server.
+        """
+
+        with self.assertNumProfileServerCalls(3):
+            self.server.find_by_usernames(['alice', 'bob'])
+            self.server.find_by_email('alice@gov.gl')
+
+        self.assertNumProfileServerCalls(
+            1, self.server.add_group, {'username': 'bob'}, 'staff')
+
+    def test_web_service(self):
+        """
+        Test counting the requests of the Web service.
+        """
+
+        with self.assertNumProfileServerCalls(2):
+            self.webservice.find_by_usernames(['alice', 'bob'])
+
+    def test_failure(self):
+        """
+        Test the calls made are listed when the number is wrong.
+        """
+
+        with self.assertRaises(AssertionError) as context:
+            with self.assertNumProfileServerCalls(1):
+                self.webservice.find_by_username('alice')
+                self.webservice.find_by_email('bob@gov.gl')
+                self.webservice.find_by_email('alice@gov.gl')
+
+        self.assertEqual(str(context.exception),
+                         "3 profile server calls were made, 1 expected:\n"
+                         "  find_by_username: 1\n"
+                         "  list: 2")
@@ -0,0 +1,107 @@
+"""
+Tests for the cache-backed OpenID store
+"""
+from io import StringIO
+from time import time
+from unittest import TestCase
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+from openid.association import Association
+
+from ixprofile_client.management.commands.benchmark_openid_store import (
+    Command,
+)
+from ixprofile_client.openid_store import CacheOpenIDStore
+
+SERVER_URL = 'https://profile.test/id/endpoint/'
+
+
+class CacheOpenIDStoreTestCase(TestCase):
+    """
+    Tests for the cache-backed OpenID store
+    """
+
+    def setUp(self):
+        """
+        Create a store in an empty cache
+        """
+        cache.clear()
+        self.store = CacheOpenIDStore()
+
+    @staticmethod
+    def association(handle, expires_in=3600):
+        """
+        An association with the handle.
+        """
+        return Association.fromExpiresIn(expires_in, handle, b'secret' * 4,
+                                         'HMAC-SHA1')
+
+    def test_associations(self):
+        """
+        Test storing, getting and removing associations.
+        """
+
+        self.assertIsNone(self.store.getAssociation(SERVER_URL))
+
+        self.store.storeAssociation(SERVER_URL, self.association('first'))
+        self.store.storeAssociation(SERVER_URL, self.association('second'))
+
+        self.assertEqual(self.store.getAssociation(SERVER_URL).handle,
+                         'second')
+        self.assertEqual(
+            self.store.getAssociation(SERVER_URL, 'first').secret,
+            b'secret' * 4)
+        self.assertIsNone(self.store.getAssociation('https://other/'))
+
+        self.assertTrue(self.store.removeAssociation(SERVER_URL, 'second'))
+        self.assertFalse(self.store.removeAssociation(SERVER_URL, 'second'))
+        self.assertIsNone(self.store.getAssociation(SERVER_URL))
+        self.assertIsNotNone(self.store.getAssociation(SERVER_URL, 'first'))
+
+    def test_expired(self):
+        """
+        Test expired associations are not stored.
+        """
+
+        association = self.association('old', expires_in=3600)
+        association.issued -= 7200
+
+        self.store.storeAssociation(SERVER_URL, association)
+
+        self.assertIsNone(self.store.getAssociation(SERVER_URL, 'old'))
+
+    def test_nonces(self):
+        """
+        Test nonces are only used once, and only when recent.
+        """
+
+        now = int(time())
+
+        self.assertTrue(self.store.useNonce(SERVER_URL, now, 'salt'))
+        self.assertFalse(self.store.useNonce(SERVER_URL, now, 'salt'))
+        self.assertTrue(self.store.useNonce(SERVER_URL, now, 'pepper'))
+        self.assertFalse(self.store.useNonce(SERVER_URL, now - 86400, 'old'))
+
+    def test_from_settings(self):
+        """
+        Test the store is only used when configured.
+        """
+
+        self.assertIsNone(CacheOpenIDStore.from_settings())
+
+        with override_settings(PROFILE_SERVER_OPENID_STORE_CACHE='default'):
+            self.assertIsInstance(CacheOpenIDStore.from_settings(),
+                                  CacheOpenIDStore)
+
+    def test_benchmark(self):
+        """
+        Test the benchmark command.
+        """
+
+        stdout = StringIO()
+        call_command(Command(), '--stores=cache', '--logins=10',
+                     stdout=stdout)
+
+        self.assertRegex(stdout.getvalue(), r'^cache: 10 logins in ')
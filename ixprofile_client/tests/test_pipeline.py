@@ -0,0 +1,362 @@
+"""
+Tests for the social auth pipeline
+"""
+from threading import Thread
+from time import monotonic, sleep
+from types import SimpleNamespace
+from unittest import TestCase
+
+from django.contrib.auth.models import User
+from django.http import HttpResponseRedirect
+from django.test import override_settings
+from mock import patch
+
+from ixprofile_client import pipeline, webservice
+from ixprofile_client.cache import LRUCache
+from ixprofile_client.mock import (
+    MockProfileAdapter,
+    ProfileServerCallsMixin,
+    mock_profile_server,
+    unmock_profile_server,
+)
+from ixprofile_client.pipeline import (
+    PROFILE_DETAILS_SESSION_KEY,
+    SubscriptionCache,
+    match_user,
+    profile_details,
+    user_details,
+)
+from ixprofile_client.tests.test_cache import FakeTimer
+from ixprofile_client.webservice import UserWebService
+
+
+class MatchUserTestCase(ProfileServerCallsMixin, TestCase):
+    """
+    Test matching the users logging in.
+    """
+
+    def setUp(self):
+        """
+        Mock the profile server and the users
+        """
+        mock_profile_server()
+        for username in ('alice', 'bob'):
+            webservice.profile_server.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+            })
+        webservice.profile_server.unsubscribe({'username': 'bob'})
+        pipeline._SUBSCRIPTIONS.clear()  # pylint:disable=protected-access
+
+        self.session = {}
+        self.strategy = SimpleNamespace(session_set=self.session.__setitem__)
+
+        patcher = patch.object(
+            pipeline, '_find_user',
+            side_effect=lambda username: 'user' if username == 'alice'
+            else None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """
+        Restore the profile server
+        """
+        unmock_profile_server()
+
+    def match(self, username):
+        """
+        Match the user logging in with the username.
+        """
+        return match_user(self.strategy, {}, {},
+                          'https://profile.test/id/u/%s' % username)
+
+    def test_match(self):
+        """
+        Test subscribed users are matched.
+        """
+
+        with override_settings(PROFILE_SERVER='https://profile.test/'):
+            result = self.match('alice')
+            self.assertEqual(result['user'], 'user')
+            self.assertEqual(result['profile_details']['email'],
+                             'alice@gov.gl')
+            self.assertIsInstance(self.match('bob'), HttpResponseRedirect)
+            self.assertIsInstance(self.match('carol'), HttpResponseRedirect)
+
+    def test_cached(self):
+        """
+        Test the subscription status is cached when enabled.
+        """
+
+        with override_settings(PROFILE_SERVER='https://profile.test/',
+                               PROFILE_SERVER_SUBSCRIPTION_TTL=60):
+            with self.assertNumProfileServerCalls(1, all_threads=True):
+                for _ in range(3):
+                    self.assertEqual(self.match('alice')['user'], 'user')
+
+    def test_profile_details(self):
+        """
+        Test the details kept in the session at login are used afterwards.
+        """
+
+        with override_settings(PROFILE_SERVER='https://profile.test/'):
+            self.match('alice')
+
+        kept = self.session[PROFILE_DETAILS_SESSION_KEY]
+        self.assertEqual(set(kept['details']),
+                         {'username', 'email', 'first_name', 'last_name',
+                          'subscribed', 'groups'})
+
+        request = SimpleNamespace(user=SimpleNamespace(username='alice'),
+                                  session=self.session)
+        with self.assertNumProfileServerCalls(0):
+            self.assertEqual(profile_details(request)['email'],
+                             'alice@gov.gl')
+
+        kept['expires'] = 0
+        with self.assertNumProfileServerCalls(1):
+            self.assertEqual(profile_details(request)['email'],
+                             'alice@gov.gl')
+        self.assertGreater(self.session[PROFILE_DETAILS_SESSION_KEY]
+                           ['expires'], 0)
+
+        request.user.username = 'bob'
+        with self.assertNumProfileServerCalls(1):
+            self.assertEqual(profile_details(request)['email'],
+                             'bob@gov.gl')
+
+    def test_unsubscribed(self):
+        """
+        Test a user unsubscribed through the client can't log in with the
+        cached status.
+        """
+
+        client = UserWebService(
+            adapter=MockProfileAdapter(webservice.profile_server))
+        client.profile_server = 'https://ps/'
+
+        with override_settings(PROFILE_SERVER='https://profile.test/',
+                               PROFILE_SERVER_SUBSCRIPTION_TTL=60):
+            self.assertEqual(self.match('alice')['user'], 'user')
+            client.unsubscribe(SimpleNamespace(username='alice'))
+            self.assertIsInstance(self.match('alice'), HttpResponseRedirect)
+
+    def test_concurrent_logins(self):
+        """
+        Test the profile server is asked while the user is looked up, and
+        cold logins don't queue for each other.
+        """
+
+        fetch = SubscriptionCache.fetch
+
+        def slow_fetch(username):
+            """
+            Ask the profile server slowly.
+            """
+            sleep(0.2)
+            return fetch(username)
+
+        def slow_find_user(username):
+            """
+            Look the user up slowly.
+            """
+            sleep(0.2)
+            return 'user'
+
+        def login(results):
+            """
+            Log Alice in, keeping the result.
+            """
+            results.append(self.match('alice'))
+
+        with patch.object(SubscriptionCache, 'fetch',
+                          staticmethod(slow_fetch)), \
+                patch.object(pipeline, '_find_user', slow_find_user):
+            for ttl in (0, 60):
+                with override_settings(PROFILE_SERVER='https://profile.test/',
+                                       PROFILE_SERVER_SUBSCRIPTION_TTL=ttl):
+                    results = []
+                    threads = [Thread(target=login, args=(results,))
+                               for _ in range(8)]
+                    started = monotonic()
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    self.assertLess(monotonic() - started, 0.35)
+                    self.assertEqual([result['user'] for result in results],
+                                     ['user'] * 8)
+
+
+class SubscriptionCacheTestCase(ProfileServerCallsMixin, TestCase):
+    """
+    Test serving the subscription status stale while it's revalidated.
+    """
+
+    def setUp(self):
+        """
+        Mock the profile server and create a cache
+        """
+        mock_profile_server()
+        webservice.profile_server.register({
+            'email': 'alice@gov.gl',
+            'username': 'alice',
+        })
+
+        self.timer = FakeTimer()
+        self.cache = SubscriptionCache(10, 100, timer=self.timer)
+
+    def tearDown(self):
+        """
+        Restore the profile server
+        """
+        self.cache.refresh_executor.shutdown()
+        unmock_profile_server()
+
+    def set_subscribed(self, subscribed):
+        """
+        Change the subscription of the user on the profile server.
+        """
+        if subscribed:
+            webservice.profile_server.subscribe({'username': 'alice'})
+        else:
+            webservice.profile_server.unsubscribe({'username': 'alice'})
+
+    def test_fresh(self):
+        """
+        Test a fresh status is served without asking the profile server.
+        """
+
+        self.assertTrue(self.cache.details('alice').result()['subscribed'])
+        self.set_subscribed(False)
+        self.timer.now = 5
+
+        with self.assertNumProfileServerCalls(0, all_threads=True):
+            self.assertTrue(self.cache.details('alice').result()['subscribed'])
+
+    def test_stale(self):
+        """
+        Test a stale status is served while it's refreshed in the background.
+        """
+
+        self.assertTrue(self.cache.details('alice').result()['subscribed'])
+        self.set_subscribed(False)
+        self.timer.now = 50
+
+        self.assertTrue(self.cache.details('alice').result()['subscribed'])
+        self.cache.refresh_executor.shutdown()
+
+        self.assertFalse(self.cache.details('alice').result()['subscribed'])
+
+    def test_invalidated_while_fetching(self):
+        """
+        Test a status fetched while the user is changed isn't kept.
+        """
+
+        fetch = SubscriptionCache.fetch
+
+        def fetch_and_change(username):
+            """
+            Fetch the status, then change the user.
+            """
+            details = fetch(username)
+            self.cache.invalidate(username)
+            return details
+
+        with patch.object(SubscriptionCache, 'fetch',
+                          staticmethod(fetch_and_change)):
+            self.assertTrue(self.cache.details('alice').result()['subscribed'])
+
+        with self.assertNumProfileServerCalls(1):
+            self.cache.details('alice').result()
+
+    def test_max_staleness(self):
+        """
+        Test a status older than the maximum staleness is not served.
+        """
+
+        self.assertTrue(self.cache.details('alice').result()['subscribed'])
+        self.set_subscribed(False)
+        self.timer.now = 150
+
+        self.assertFalse(self.cache.details('alice').result()['subscribed'])
+
+    def test_client_cache_bypassed(self):
+        """
+        Test the status is fetched past the cache of the client, so it's
+        never older than the maximum staleness.
+        """
+
+        server = webservice.profile_server
+        client = UserWebService(cache=LRUCache(maxsize=10, ttl=3600),
+                                adapter=MockProfileAdapter(server))
+        client.profile_server = 'https://ps/'
+
+        with patch.object(webservice, 'profile_server', client):
+            self.assertTrue(client.find_by_username('alice')['subscribed'])
+            server.unsubscribe({'username': 'alice'})
+
+            self.assertFalse(
+                self.cache.details('alice').result()['subscribed'])
+
+
+class UserDetailsTestCase(TestCase):
+    """
+    Test updating the users with their details.
+    """
+
+    def setUp(self):
+        """
+        Create a user and a strategy
+        """
+        self.user = User(username='alice', email='alice@gov.gl',
+                         first_name='Alice', last_name='Smith')
+        self.settings = {}
+        self.strategy = SimpleNamespace(
+            setting=lambda name, default=None, backend=None:
+            self.settings.get(name, default))
+
+    def update(self, **details):
+        """
+        Update the user with the details, returning the fields saved.
+        """
+
+        with patch.object(User, 'save') as save:
+            user_details(self.strategy, details, None, user=self.user)
+
+        if not save.called:
+            return None
+        return save.call_args[1]['update_fields']
+
+    def test_changed(self):
+        """
+        Test only the changed fields are saved.
+        """
+
+        self.assertEqual(self.update(first_name='Alice', last_name='Jones',
+                                     fullname='Alice Jones'),
+                         ['last_name'])
+        self.assertEqual(self.user.last_name, 'Jones')
+
+    def test_unchanged(self):
+        """
+        Test the user isn't saved if nothing changed.
+        """
+
+        self.assertIsNone(self.update(username='bob', email='bob@gov.gl',
+                                      first_name='Alice', last_name=None))
+        self.assertEqual(self.user.username, 'alice')
+
+    def test_settings(self):
+        """
+        Test the protected and immutable fields are honoured.
+        """
+
+        self.settings['PROTECTED_USER_FIELDS'] = ['first_name']
+        self.settings['IMMUTABLE_USER_FIELDS'] = ['last_name']
+
+        self.assertIsNone(self.update(first_name='Bob', last_name='Jones'))
+
+        self.settings['NO_DEFAULT_PROTECTED_USER_FIELDS'] = True
+        self.assertEqual(self.update(email='alice@example.com'), ['email'])
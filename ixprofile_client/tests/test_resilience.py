@@ -0,0 +1,342 @@
+"""
+Tests for retrying and circuit breaking
+"""
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import TestCase
+
+from django.test import override_settings
+from mock import patch
+from requests import (
+    ConnectionError as RequestsConnectionError,
+    Timeout as RequestsTimeout,
+)
+
+from ixprofile_client.exceptions import (
+    ProfileServerFailure,
+    ProfileServerTimeout,
+    ProfileServerUnavailable,
+)
+from ixprofile_client.mock import MockProfileAdapter
+from ixprofile_client.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    current_deadline,
+    deadline,
+    remaining_time,
+    with_current_deadline,
+)
+from ixprofile_client.webservice import UserWebService
+
+from .test_cache import FakeTimer
+
+
+class RetryPolicyTestCase(TestCase):
+    """
+    Tests for the retry policy
+    """
+
+    def test_should_retry(self):
+        """
+        Test only idempotent requests failing temporarily are retried.
+        """
+
+        policy = RetryPolicy(retries=2)
+
+        class Response:
+            """
+            A response with a status code.
+            """
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+        self.assertTrue(policy.should_retry('GET', 0))
+        self.assertTrue(policy.should_retry('GET', 1, Response(503)))
+        self.assertFalse(policy.should_retry('GET', 2, Response(503)))
+        self.assertFalse(policy.should_retry('GET', 0, Response(404)))
+        self.assertFalse(policy.should_retry('POST', 0, Response(503)))
+        self.assertFalse(policy.should_retry('PATCH', 0))
+
+    def test_delay(self):
+        """
+        Test the delay is capped.
+        """
+
+        policy = RetryPolicy(backoff=1, max_backoff=5)
+
+        for attempt in range(10):
+            self.assertLessEqual(policy.delay(attempt),
+                                 min(5, 2 ** attempt))
+
+
+class CircuitBreakerTestCase(TestCase):
+    """
+    Tests for the circuit breaker
+    """
+
+    def setUp(self):
+        """
+        Create a circuit breaker
+        """
+        self.timer = FakeTimer()
+        self.breaker = CircuitBreaker(failure_threshold=0.5, minimum_calls=4,
+                                      window=10, reset_timeout=5,
+                                      timer=self.timer)
+
+    def test_open(self):
+        """
+        Test the breaker opens when the error rate is too high.
+        """
+
+        for success in (True, False, True):
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_window(self):
+        """
+        Test old calls are not counted.
+        """
+
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.timer.now = 10
+        self.breaker.record(False)
+        self.breaker.record(True)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open(self):
+        """
+        Test a single request is let through after the reset timeout.
+        """
+
+        for _ in range(4):
+            self.breaker.record(False)
+
+        self.timer.now = 5
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.timer.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+class DeadlineTestCase(TestCase):
+    """
+    Tests for the deadlines
+    """
+
+    def test_deadline(self):
+        """
+        Test nested deadlines can only shorten the time left.
+        """
+
+        self.assertIsNone(remaining_time())
+
+        with deadline(10):
+            self.assertLessEqual(remaining_time(), 10)
+
+            with deadline(60):
+                self.assertLessEqual(remaining_time(), 10)
+
+            with deadline(1):
+                self.assertLessEqual(remaining_time(), 1)
+
+            self.assertGreater(remaining_time(), 1)
+
+        self.assertIsNone(current_deadline())
+
+    def test_with_current_deadline(self):
+        """
+        Test the deadline is carried to other threads.
+        """
+
+        with deadline(10):
+            expires = current_deadline()
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                self.assertIsNone(executor.submit(current_deadline).result())
+                self.assertEqual(
+                    executor.submit(
+                        with_current_deadline(current_deadline)).result(),
+                    expires)
+
+
+class ResilientWebServiceTestCase(TestCase):
+    """
+    Test the Web service against a failing profile server.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.adapter.server.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+        })
+
+        with override_settings(PROFILE_SERVER_CIRCUIT_BREAKER={
+                'minimum_calls': 4,
+                'reset_timeout': 60,
+        }):
+            self.webservice = UserWebService(
+                adapter=self.adapter,
+                retry_policy=RetryPolicy(retries=2,
+                                         sleep_function=lambda delay: None))
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_retry(self):
+        """
+        Test temporary failures are retried.
+        """
+
+        self.adapter.fail_next(503)
+        self.adapter.fail_next(RequestsConnectionError())
+
+        self.assertEqual(self.webservice.find_by_username('bob')['username'],
+                         'bob')
+        self.assertEqual(len(self.adapter.requests), 3)
+
+    def test_give_up(self):
+        """
+        Test failures are reported after the last retry.
+        """
+
+        self.adapter.fail_next(503, 3)
+
+        with self.assertRaises(ProfileServerFailure):
+            self.webservice.find_by_username('bob')
+        self.assertEqual(len(self.adapter.requests), 3)
+
+    def test_no_retry(self):
+        """
+        Test requests that are not idempotent are not retried.
+        """
+
+        self.adapter.fail_next(503)
+
+        with self.assertRaises(ProfileServerFailure):
+            self.webservice.set_details(SimpleNamespace(username='bob'),
+                                        first_name='Bob')
+        self.assertEqual(len(self.adapter.requests), 1)
+
+    def test_circuit_breaker(self):
+        """
+        Test requests fail immediately when the server keeps failing.
+        """
+
+        self.adapter.fail_next(500, 6)
+
+        for _ in range(2):
+            with self.assertRaises(ProfileServerFailure):
+                self.webservice.find_by_username('bob')
+        self.assertEqual(len(self.adapter.requests), 4)
+
+        with self.assertRaises(ProfileServerUnavailable):
+            self.webservice.find_by_username('bob')
+        self.assertEqual(len(self.adapter.requests), 4)
+
+        self.assertEqual(
+            self.webservice.circuit_breaker('https://ps/').state,
+            CircuitBreaker.OPEN)
+
+    def test_circuit_breaker_probe_error(self):
+        """
+        Test a probe failing with any error reopens the breaker, rather than
+        leaving it waiting for the probe.
+        """
+
+        breaker = CircuitBreaker(minimum_calls=1, reset_timeout=60,
+                                 timer=lambda: self.now)
+        self.now = 0
+        breaker.record(False)
+        self.now = 60
+        self.webservice.circuit_breakers['ps'] = breaker
+
+        with patch.object(self.webservice.session, 'request',
+                          side_effect=ValueError("Broken")):
+            with self.assertRaises(ValueError):
+                self.webservice.find_by_username('bob')
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        self.now = 120
+        self.assertIsNotNone(self.webservice.find_by_username('bob'))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @override_settings(PROFILE_SERVER_TIMEOUTS={
+        'default': 5,
+        'find_by_username': (1, 2),
+    })
+    def test_timeouts(self):
+        """
+        Test requests time out according to their operation.
+        """
+
+        with patch.object(self.adapter, 'send',
+                          wraps=self.adapter.send) as send:
+            self.webservice.find_by_username('bob')
+            self.webservice.list()
+
+        self.assertEqual([call[1]['timeout'] for call in send.call_args_list],
+                         [(1, 2), 5])
+
+    def test_timeout(self):
+        """
+        Test timeouts are reported after the last retry.
+        """
+
+        self.adapter.fail_next(RequestsTimeout(), 3)
+
+        with self.assertRaises(ProfileServerTimeout):
+            self.webservice.find_by_username('bob')
+        self.assertEqual(len(self.adapter.requests), 3)
+
+    def test_deadline(self):
+        """
+        Test requests don't wait past the deadline.
+        """
+
+        with patch.object(self.adapter, 'send',
+                          wraps=self.adapter.send) as send:
+            with deadline(1):
+                self.webservice.find_by_username('bob')
+
+        for value in send.call_args[1]['timeout']:
+            self.assertLessEqual(value, 1)
+
+    def test_deadline_expired(self):
+        """
+        Test no requests are sent once the deadline has expired.
+        """
+
+        with deadline(0):
+            with self.assertRaises(ProfileServerTimeout):
+                self.webservice.connect(SimpleNamespace(username='bob'))
+        self.assertEqual(len(self.adapter.requests), 0)
+
+    def test_deadline_retry(self):
+        """
+        Test requests are not retried past the deadline.
+        """
+
+        self.adapter.fail_next(503)
+
+        with patch.object(self.webservice.retry_policy, 'delay',
+                          return_value=10):
+            with deadline(1):
+                with self.assertRaises(ProfileServerTimeout):
+                    self.webservice.find_by_username('bob')
+        self.assertEqual(len(self.adapter.requests), 1)
@@ -0,0 +1,219 @@
+"""
+Tests for synchronising the groups of users
+"""
+import json
+import os
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest import TestCase
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import override_settings
+
+from ixprofile_client import webservice
+from ixprofile_client.management.commands.sync_profile_groups import Command
+from ixprofile_client.mock import (
+    MockProfileAdapter,
+    mock_profile_server,
+    unmock_profile_server,
+)
+from ixprofile_client.webservice import UserWebService
+
+
+class SyncGroupMembershipsTestCase(TestCase):
+    """
+    Test synchronising the groups of users.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.mock_ps = self.adapter.server
+        for username, groups in (
+                ('alice', ['staff']),
+                ('bob', ['staff', 'admin']),
+                ('carol', ['volunteer']),
+        ):
+            self.mock_ps.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+                'groups': groups,
+            })
+
+        with override_settings(PROFILE_SERVER_VALIDATED_RESPONSES=10):
+            self.webservice = UserWebService(adapter=self.adapter)
+        self.webservice.profile_server = 'https://ps/'
+
+    def groups(self, username):
+        """
+        The groups of a user on the mock profile server.
+        """
+        return sorted(self.mock_ps.find_by_username(username)['groups'])
+
+    def test_sync(self):
+        """
+        Test only the users whose groups differ are changed.
+        """
+
+        progress = []
+        result = self.webservice.sync_group_memberships({
+            'alice': ['staff'],
+            'bob': ['staff'],
+            'carol': ['staff', 'volunteer'],
+            'dave': ['staff'],
+        }, progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(sorted(result['changed']), ['bob', 'carol'])
+        self.assertEqual(result['unchanged'], ['alice'])
+        self.assertEqual(result['missing'], ['dave'])
+        self.assertEqual(result['failed'], {})
+        self.assertEqual(progress, [(1, 4), (2, 4), (3, 4), (4, 4)])
+
+        self.assertEqual(self.groups('bob'), ['staff'])
+        self.assertEqual(self.groups('carol'), ['staff', 'volunteer'])
+
+        # A GET for every user, and a PATCH for the changed ones
+        self.assertEqual(len(self.adapter.requests), 6)
+
+    def test_managed_groups(self):
+        """
+        Test only the managed groups are changed.
+        """
+
+        result = self.webservice.sync_group_memberships({
+            'bob': ['hr'],
+            'carol': [],
+        }, managed_groups=['staff', 'hr'])
+
+        self.assertEqual(sorted(result['changed']), ['bob'])
+        self.assertEqual(self.groups('bob'), ['admin', 'hr'])
+        self.assertEqual(self.groups('carol'), ['volunteer'])
+
+    def test_dry_run(self):
+        """
+        Test nothing is changed in a dry run.
+        """
+
+        result = self.webservice.sync_group_memberships({'bob': ['staff']},
+                                                        dry_run=True)
+
+        self.assertEqual(result['changed'], ['bob'])
+        self.assertEqual(self.groups('bob'), ['admin', 'staff'])
+
+    def test_invalid(self):
+        """
+        Test groups that aren't lists of group names are rejected.
+        """
+
+        for groups in ('staff', ['staff', 1]):
+            with self.assertRaises(ValueError):
+                self.webservice.sync_group_memberships({
+                    'alice': ['staff'],
+                    'bob': groups,
+                })
+
+        self.assertEqual(self.groups('bob'), ['admin', 'staff'])
+        self.assertEqual(len(self.adapter.requests), 0)
+
+    def test_failure(self):
+        """
+        Test failures are reported without stopping the synchronisation.
+        """
+
+        self.webservice.retry_policy = None
+        self.adapter.fail_next(500)
+
+        result = self.webservice.sync_group_memberships({'bob': ['staff']})
+
+        self.assertEqual(list(result['failed']), ['bob'])
+
+
+class SyncProfileGroupsCommandTestCase(TestCase):
+    """
+    Test the sync_profile_groups command.
+    """
+
+    def setUp(self):
+        """
+        Mock the profile server
+        """
+        mock_profile_server()
+        for username, groups in (
+                ('alice', ['staff']),
+                ('bob', ['staff', 'admin']),
+        ):
+            webservice.profile_server.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+                'groups': groups,
+            })
+
+    def tearDown(self):
+        """
+        Restore the profile server
+        """
+        unmock_profile_server()
+
+    def run_command(self, content, suffix, *args):
+        """
+        Run the command on a file with the content.
+        """
+
+        with NamedTemporaryFile('w', suffix=suffix, delete=False) as stream:
+            stream.write(content)
+        self.addCleanup(os.unlink, stream.name)
+
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command(Command(), stream.name, *args,
+                     stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_json(self):
+        """
+        Test synchronising from a JSON file.
+        """
+
+        stdout, stderr = self.run_command(json.dumps({
+            'alice': ['staff', 'hr'],
+            'bob': ['admin', 'staff'],
+            'carol': ['staff'],
+        }), '.json')
+
+        self.assertIn("Synchronised 3 users", stdout)
+        self.assertIn("1 changed, 1 unchanged, 1 not found, 0 failed.",
+                      stdout)
+        self.assertIn("Not found: carol", stderr)
+        self.assertEqual(
+            webservice.profile_server.find_by_username('alice')['groups'],
+            ['hr', 'staff'])
+
+    def test_csv(self):
+        """
+        Test synchronising from a CSV file.
+        """
+
+        stdout, _ = self.run_command(
+            "alice\nbob,staff\n", '.csv',
+            '--managed-groups=staff,hr', '--dry-run')
+
+        self.assertIn("Checked 2 users", stdout)
+        self.assertIn("1 to change, 1 unchanged", stdout)
+        self.assertEqual(
+            webservice.profile_server.find_by_username('alice')['groups'],
+            ['staff'])
+
+    def test_invalid(self):
+        """
+        Test invalid files are reported.
+        """
+
+        with self.assertRaises(CommandError):
+            self.run_command("[]", '.json')
+        with self.assertRaises(CommandError):
+            self.run_command('{"bob": "staff"}', '.json')
+        bob = webservice.profile_server.find_by_username('bob')
+        self.assertEqual(sorted(bob['groups']), ['admin', 'staff'])
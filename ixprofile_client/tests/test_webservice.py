@@ -0,0 +1,993 @@
+"""
+Tests for the profile server Web service client
+"""
+
+import asyncio
+import json
+from threading import Event, Thread
+from time import monotonic, sleep
+from unittest import TestCase, skipIf
+
+from django.core.cache import cache
+from django.test import override_settings
+from mock import MagicMock, patch
+from requests import Response
+
+from ixprofile_client.cache import LRUCache, SharedCache
+from ixprofile_client.exceptions import (
+    ProfileServerFailure,
+    ProfileServerTimeout,
+)
+from ixprofile_client.mock import MockProfileAdapter
+from ixprofile_client.resilience import deadline, remaining_time
+from ixprofile_client.webservice import (
+    AsyncUserWebService,
+    Flight,
+    UserWebService,
+    httpx,
+)
+
+
+class TransportTestCase(TestCase):
+    """
+    Test the pooled HTTP transport of the Web service.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service to test
+        """
+        self.webservice = UserWebService()
+        self.webservice.profile_server = 'https://ps/'
+
+    def tearDown(self):
+        """
+        Release the connections
+        """
+        self.webservice.close()
+
+    def test_session_reused(self):
+        """
+        Test the same session is used for all calls from a thread.
+        """
+        self.assertIs(self.webservice.session, self.webservice.session)
+
+    def test_session_per_thread(self):
+        """
+        Test threads get their own sessions sharing one connection pool.
+        """
+
+        sessions = []
+        thread = Thread(
+            target=lambda: sessions.append(self.webservice.session))
+        thread.start()
+        thread.join()
+
+        session = self.webservice.session
+        self.assertIsNot(sessions[0], session)
+        self.assertIs(sessions[0].get_adapter('https://ps/'),
+                      session.get_adapter('https://ps/'))
+
+    @override_settings(PROFILE_SERVER_POOL_MAXSIZE=42)
+    def test_pool_size(self):
+        """
+        Test the pool size is taken from the settings.
+        """
+
+        adapter = self.webservice.session.get_adapter('https://ps/')
+        # pylint:disable=protected-access
+        self.assertEqual(adapter._pool_maxsize, 42)
+
+    def test_new_pool_after_fork(self):
+        """
+        Test the connection pool is not shared with a forked process.
+        """
+
+        adapter = self.webservice.session.get_adapter('https://ps/')
+
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(
+                self.webservice.session.get_adapter('https://ps/'),
+                adapter)
+
+    def test_request(self):
+        """
+        Test requests are made through the session.
+        """
+
+        session = self.webservice.session
+        with patch.object(session, 'request',
+                          return_value=MagicMock(status_code=200)) as request:
+            self.webservice.reset_password(MagicMock(username='bob'))
+
+        request.assert_called_once_with(
+            'POST',
+            'https://ps/api/v2/user/bob/reset-password/',
+            auth=('mock_app', 'dummy_secret'),
+            verify=None,
+            timeout=(3.05, 10),
+            headers={'Content-Type': 'application/json'},
+        )
+
+
+def response(status_code=200, data=None):
+    """
+    A profile server response with the given status and JSON body.
+    """
+
+    result = Response()
+    result.status_code = status_code
+    # pylint:disable=protected-access
+    result._content = json.dumps(data or {}).encode()
+    return result
+
+
+class CacheTestCase(TestCase):
+    """
+    Test caching user records in the Web service.
+    """
+
+    bob = {
+        'username': 'bob',
+        'email': 'Bob@gov.gl',
+        'groups': ['group1'],
+    }
+
+    def setUp(self):
+        """
+        Create a Web service with a cache
+        """
+        self.webservice = UserWebService(cache=LRUCache(10, 60))
+        self.webservice.profile_server = 'https://ps/'
+
+        patcher = patch.object(self.webservice, '_request')
+        self.request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_find_by_username(self):
+        """
+        Test users are fetched once by username and email.
+        """
+
+        self.request.return_value = response(data=self.bob)
+
+        self.assertEqual(self.webservice.find_by_username('bob'), self.bob)
+        self.assertEqual(self.webservice.find_by_username('bob'), self.bob)
+        self.assertEqual(self.webservice.find_by_email('bob@gov.GL'),
+                         self.bob)
+
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(self.webservice.cache.stats()['hits'], 2)
+
+    def test_copies(self):
+        """
+        Test modifying returned records doesn't change the cache.
+        """
+
+        self.request.return_value = response(data=self.bob)
+
+        self.webservice.find_by_username('bob')['groups'].append('group2')
+
+        self.assertEqual(self.webservice.find_by_username('bob')['groups'],
+                         ['group1'])
+
+    def test_invalidation(self):
+        """
+        Test writes through the Web service remove the cached records.
+        """
+
+        user = MagicMock(username='bob', email='bob@gov.gl',
+                         first_name='Bob', last_name='')
+
+        for write in (
+                lambda: self.webservice.subscribe(user),
+                lambda: self.webservice.unsubscribe(user),
+                lambda: self.webservice.set_details(user, first_name='Bob'),
+                lambda: self.webservice.add_groups(user, ['group2']),
+                lambda: self.webservice.remove_groups(user, ['group1']),
+                lambda: self.webservice.register(user),
+        ):
+            self.request.return_value = response(data=self.bob)
+            self.webservice.find_by_username('bob')
+            self.assertEqual(len(self.webservice.cache), 2)
+
+            write()
+
+            # Changing groups updates the cached groups of the user
+            self.webservice.cache.pop(('groups_for', 'bob'))
+            self.assertEqual(len(self.webservice.cache), 0)
+
+    def test_find_by_usernames(self):
+        """
+        Test only the users not cached are looked up.
+        """
+
+        def request(method, url, **kwargs):
+            """
+            Return the user with the username in the URL, if any.
+            """
+            username = url.split('/')[-2]
+            if username == 'nobody':
+                return response(404)
+            return response(data={'username': username})
+
+        self.request.side_effect = request
+        self.webservice.find_by_username('alice')
+
+        users = self.webservice.find_by_usernames(
+            ['alice', 'bob', 'carol', 'bob', 'nobody'])
+
+        self.assertEqual(users, {
+            'alice': {'username': 'alice'},
+            'bob': {'username': 'bob'},
+            'carol': {'username': 'carol'},
+            'nobody': None,
+        })
+        self.assertEqual(
+            sorted(call[0][1] for call in self.request.call_args_list),
+            [
+                'https://ps/api/v2/user/alice/',
+                'https://ps/api/v2/user/bob/',
+                'https://ps/api/v2/user/carol/',
+                'https://ps/api/v2/user/nobody/',
+            ])
+
+
+class CoalescingTestCase(TestCase):
+    """
+    Test concurrent identical requests are coalesced.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service with a slow profile server
+        """
+        self.webservice = UserWebService()
+        self.webservice.profile_server = 'https://ps/'
+        self.release = Event()
+
+        def send(method, url, **kwargs):
+            """
+            Respond once released.
+            """
+            self.release.wait()
+            return response(data={'username': 'bob', 'groups': []})
+
+        patcher = patch.object(self.webservice, '_send', side_effect=send)
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.waiting = []
+        real_wait = Flight.wait
+
+        def wait(flight, timeout=None):
+            """
+            Record the thread is waiting for the request in flight.
+            """
+            self.waiting.append(flight)
+            return real_wait(flight, timeout)
+
+        patcher = patch.object(Flight, 'wait', wait)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_coalescing(self):
+        """
+        Test the request is sent once and the results are private copies.
+        """
+
+        results = []
+
+        def find():
+            """
+            Find the user.
+            """
+            results.append(self.webservice.find_by_username('bob'))
+
+        threads = [Thread(target=find) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+
+        for _ in range(100):
+            if len(self.waiting) == 4:
+                break
+            sleep(0.01)
+        self.release.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.send.call_count, 1)
+        self.assertEqual(len(results), 5)
+        results[0]['groups'].append('group1')
+        self.assertEqual(results[1]['groups'], [])
+
+    def test_deadline(self):
+        """
+        Test a thread waiting for a request in flight honours its deadline.
+        """
+
+        leader = Thread(target=self.webservice.find_by_username, args=('bob',))
+        leader.start()
+        self.addCleanup(leader.join)
+        self.addCleanup(self.release.set)
+
+        for _ in range(100):
+            if self.send.called:
+                break
+            sleep(0.01)
+
+        started = monotonic()
+        with deadline(0.1):
+            with self.assertRaises(ProfileServerTimeout):
+                self.webservice.find_by_username('bob')
+        self.assertLess(monotonic() - started, 1)
+        self.assertEqual(len(self.waiting), 1)
+
+    def test_leader_deadline(self):
+        """
+        Test a request abandoned on the deadline of the thread sending it is
+        sent again for the threads waiting for it.
+        """
+
+        send = self.send.side_effect
+
+        def send_until_deadline(method, url, **kwargs):
+            """
+            Respond once released, unless the deadline has expired.
+            """
+            details = send(method, url, **kwargs)
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise ProfileServerTimeout("Deadline expired")
+            return details
+
+        self.send.side_effect = send_until_deadline
+
+        errors = []
+        results = []
+
+        def lead():
+            """
+            Find the user with no time left.
+            """
+            with deadline(0):
+                try:
+                    self.webservice.find_by_username('bob')
+                except ProfileServerTimeout as error:
+                    errors.append(error)
+
+        leader = Thread(target=lead)
+        follower = Thread(target=lambda: results.append(
+            self.webservice.find_by_username('bob')))
+        leader.start()
+        for _ in range(100):
+            if self.send.called:
+                break
+            sleep(0.01)
+
+        follower.start()
+        for _ in range(100):
+            if self.waiting:
+                break
+            sleep(0.01)
+        self.release.set()
+
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.send.call_count, 2)
+        self.assertEqual(results, [{'username': 'bob', 'groups': []}])
+
+    def test_error(self):
+        """
+        Test a failed request is not left in flight.
+        """
+
+        self.send.side_effect = ValueError("Broken")
+
+        with self.assertRaises(ValueError):
+            self.webservice.find_by_username('bob')
+
+        # pylint:disable=protected-access
+        self.assertEqual(self.webservice._flights, {})
+
+
+class ConditionalGetTestCase(TestCase):
+    """
+    Test revalidating responses with conditional requests.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.mock_ps = self.adapter.server
+        self.mock_ps.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+            'first_name': 'Bob',
+        })
+
+        with override_settings(PROFILE_SERVER_VALIDATED_RESPONSES=10):
+            self.webservice = UserWebService(adapter=self.adapter)
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_not_modified(self):
+        """
+        Test unmodified resources are not fetched again.
+        """
+
+        details = self.webservice.find_by_username('bob')
+        self.assertEqual(details['first_name'], 'Bob')
+
+        self.assertEqual(self.webservice.find_by_username('bob'), details)
+
+        request = self.adapter.requests[-1]
+        self.assertEqual(request.headers['If-None-Match'],
+                         self.adapter.etag(details))
+
+    def test_modified(self):
+        """
+        Test modified resources are fetched again.
+        """
+
+        self.webservice.find_by_username('bob')
+        self.mock_ps.set_details({'username': 'bob'}, first_name='Robert')
+
+        self.assertEqual(
+            self.webservice.find_by_username('bob')['first_name'],
+            'Robert')
+        self.assertEqual(
+            self.webservice.find_by_username('bob')['first_name'],
+            'Robert')
+
+    def test_group(self):
+        """
+        Test revalidating group listings.
+        """
+
+        self.mock_ps.add_groups({'username': 'bob'}, ['group1'])
+
+        self.assertEqual(len(self.webservice.get_group('group1')), 1)
+        self.assertEqual(len(self.webservice.get_group('group1')), 1)
+        self.assertIn('If-None-Match', self.adapter.requests[-1].headers)
+
+    def test_pages_not_kept(self):
+        """
+        Test pages of groups and user lists are not kept for revalidation.
+        """
+
+        for index in range(50):
+            self.mock_ps.register({
+                'email': 'user%d@gov.gl' % index,
+                'username': 'user%d' % index,
+                'groups': ['group1'],
+            })
+
+        self.assertEqual(
+            len(list(self.webservice.iter_group('group1', page_size=5))), 50)
+        self.webservice.find_by_email('user1@gov.gl')
+        self.assertEqual(len(self.webservice.validated_responses), 0)
+
+
+class UpdateGroupsTestCase(TestCase):
+    """
+    Test changing the groups of a user.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.mock_ps = self.adapter.server
+        self.mock_ps.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+            'groups': ['group1', 'group2'],
+        })
+        self.user = MagicMock(username='bob', email='bob@gov.gl')
+
+        with override_settings(PROFILE_SERVER_VALIDATED_RESPONSES=10):
+            self.webservice = UserWebService(adapter=self.adapter)
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_update_groups(self):
+        """
+        Test the user is revalidated before changing the groups.
+        """
+
+        details = self.webservice.find_by_username('bob')
+
+        self.assertEqual(
+            self.webservice.update_groups(self.user, add=['group3'],
+                                          remove=['group1']),
+            ['group2', 'group3'])
+        self.assertEqual([request.method
+                          for request in self.adapter.requests],
+                         ['GET', 'GET', 'PATCH'])
+        self.assertEqual(self.adapter.requests[1].headers['If-None-Match'],
+                         self.adapter.etag(details))
+        self.assertEqual(self.adapter.requests[-1].headers['If-Match'],
+                         self.adapter.etag(details))
+
+        self.assertEqual(self.mock_ps.find_by_username('bob')['groups'],
+                         ['group2', 'group3'])
+
+    @override_settings(PROFILE_SERVER_HONOURS_IF_MATCH=True)
+    def test_if_match_honoured(self):
+        """
+        Test groups are changed in a single request once the user is known,
+        if the server honours If-Match.
+        """
+
+        details = self.webservice.find_by_username('bob')
+
+        self.assertEqual(
+            self.webservice.update_groups(self.user, add=['group3'],
+                                          remove=['group1']),
+            ['group2', 'group3'])
+        self.assertEqual(len(self.adapter.requests), 2)
+        self.assertEqual(self.adapter.requests[-1].method, 'PATCH')
+        self.assertEqual(self.adapter.requests[-1].headers['If-Match'],
+                         self.adapter.etag(details))
+
+        # The response to the change is known as well
+        self.assertEqual(self.webservice.add_groups(self.user, ['group4']),
+                         ['group2', 'group3', 'group4'])
+        self.assertEqual(len(self.adapter.requests), 3)
+
+        self.assertEqual(self.mock_ps.find_by_username('bob')['groups'],
+                         ['group2', 'group3', 'group4'])
+
+    @override_settings(PROFILE_SERVER_HONOURS_IF_MATCH=True)
+    def test_concurrent_change(self):
+        """
+        Test the user is fetched again if it changed since it was known.
+        """
+
+        self.webservice.find_by_username('bob')
+        self.mock_ps.add_groups({'username': 'bob'}, ['group3'])
+
+        self.assertEqual(self.webservice.remove_groups(self.user, ['group1']),
+                         ['group2', 'group3'])
+        self.assertEqual([request.method
+                          for request in self.adapter.requests],
+                         ['GET', 'PATCH', 'GET', 'PATCH'])
+
+    def test_unknown_user(self):
+        """
+        Test the user is fetched if it is not known.
+        """
+
+        self.assertEqual(self.webservice.add_groups(self.user, ['group3']),
+                         ['group1', 'group2', 'group3'])
+        self.assertEqual([request.method
+                          for request in self.adapter.requests],
+                         ['GET', 'PATCH'])
+
+    def test_missing_user(self):
+        """
+        Test changing the groups of a missing user fails.
+        """
+
+        for method in (self.webservice.add_groups,
+                       self.webservice.remove_groups):
+            with self.assertRaises(ProfileServerFailure):
+                method(MagicMock(username='alice'), ['group1'])
+
+
+class GroupsTestCase(TestCase):
+    """
+    Test listing the users in groups.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.mock_ps = self.adapter.server
+        for index in range(5):
+            self.mock_ps.register({
+                'email': 'user%d@gov.gl' % index,
+                'username': 'user%d' % index,
+                'groups': ['group1'] if index < 3 else ['group1', 'group2'],
+            })
+
+        with override_settings(PROFILE_SERVER_CACHE_SIZE=10):
+            self.webservice = UserWebService(adapter=self.adapter)
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_iter_group(self):
+        """
+        Test iterating over a group a page at a time.
+        """
+
+        self.assertEqual(
+            [user['username']
+             for user in self.webservice.iter_group('group1', page_size=2)],
+            ['user0', 'user1', 'user2', 'user3', 'user4'])
+        self.assertEqual(len(self.adapter.requests), 3)
+
+        self.assertEqual(
+            [user['username']
+             for user in self.webservice.iter_group('group2', page_size=2)],
+            ['user3', 'user4'])
+        self.assertEqual(len(self.adapter.requests), 5)
+
+        # The pages are not cached
+        self.assertEqual(len(self.webservice.cache), 0)
+
+        with self.assertRaises(ValueError):
+            self.webservice.iter_group('group1', page_size=0)
+
+    def test_no_limit(self):
+        """
+        Test a limit of 0 lists all the users of a group.
+        """
+        self.assertEqual(len(self.webservice.get_group('group1', limit=0)), 5)
+
+    def test_get_groups(self):
+        """
+        Test getting several groups at once.
+        """
+
+        groups = self.webservice.get_groups(['group1', 'group2', 'group3'])
+
+        self.assertEqual({group: len(users)
+                          for group, users in groups.items()},
+                         {'group1': 5, 'group2': 2, 'group3': 0})
+
+    def test_cache(self):
+        """
+        Test group listings are cached until changed through the client.
+        """
+
+        self.assertEqual(len(self.webservice.get_group('group2')), 2)
+        self.assertEqual(len(self.webservice.get_group('group2')), 2)
+        self.assertEqual(len(self.adapter.requests), 1)
+
+        self.webservice.add_groups(MagicMock(username='user0'), ['group2'])
+        requests = len(self.adapter.requests)
+
+        self.assertEqual(len(self.webservice.get_group('group2')), 3)
+        self.assertEqual(len(self.adapter.requests), requests + 1)
+
+    def test_invalidated_while_fetching(self):
+        """
+        Test a listing invalidated while it's fetched isn't cached.
+        """
+
+        shared = self.webservice._shared  # pylint:disable=protected-access
+
+        def fetch_and_change(*args, **kwargs):
+            """
+            Fetch the listing, then change the group.
+            """
+            users = shared(*args, **kwargs)
+            self.mock_ps.add_group({'username': 'user0'}, 'group2')
+            # pylint:disable=protected-access
+            self.webservice._invalidate_groups(['group2'])
+            return users
+
+        with patch.object(self.webservice, '_shared',
+                          side_effect=fetch_and_change):
+            self.assertEqual(len(self.webservice.get_group('group2')), 2)
+
+        self.assertEqual(len(self.webservice.get_group('group2')), 3)
+
+
+class MembershipTestCase(TestCase):
+    """
+    Test checking group memberships.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service connected to a mock profile server
+        """
+        self.adapter = MockProfileAdapter()
+        self.mock_ps = self.adapter.server
+        for username, groups in (('alice', ['group1']),
+                                 ('bob', ['group1', 'group2'])):
+            self.mock_ps.register({
+                'email': '%s@gov.gl' % username,
+                'username': username,
+                'groups': groups,
+            })
+        self.alice = MagicMock(username='alice', email='alice@gov.gl')
+        self.bob = MagicMock(username='bob', email='bob@gov.gl')
+
+        with override_settings(PROFILE_SERVER_CACHE_SIZE=10):
+            self.webservice = UserWebService(adapter=self.adapter)
+        self.webservice.profile_server = 'https://ps/'
+
+    def test_groups_for(self):
+        """
+        Test the groups of a user are looked up once.
+        """
+
+        self.assertEqual(self.webservice.groups_for(self.bob),
+                         {'group1', 'group2'})
+        self.assertTrue(self.webservice.is_member(self.bob, 'group2'))
+        self.assertFalse(self.webservice.is_member(self.bob, 'group3'))
+        self.assertEqual(len(self.adapter.requests), 1)
+
+        self.assertEqual(
+            self.webservice.groups_for(MagicMock(username='carol')), set())
+
+    def test_group_members(self):
+        """
+        Test the members of a group are used for checks once known.
+        """
+
+        self.assertEqual(self.webservice.group_members('group2'), {'bob'})
+        self.assertTrue(self.webservice.is_member(self.bob, 'group2'))
+        self.assertFalse(self.webservice.is_member(self.alice, 'group2'))
+        self.assertEqual(len(self.adapter.requests), 1)
+
+    def test_changes(self):
+        """
+        Test the checks follow the changes made through the client.
+        """
+
+        self.webservice.group_members('group2')
+        self.webservice.groups_for(self.alice)
+
+        self.webservice.update_groups(self.alice, add=['group2'],
+                                      remove=['group1'])
+        requests = len(self.adapter.requests)
+
+        self.assertTrue(self.webservice.is_member(self.alice, 'group2'))
+        self.assertFalse(self.webservice.is_member(self.alice, 'group1'))
+        self.assertEqual(self.webservice.group_members('group2'),
+                         {'alice', 'bob'})
+        self.assertEqual(len(self.adapter.requests), requests)
+
+        self.webservice.remove_groups(self.bob, ['group2'])
+        self.assertEqual(self.webservice.group_members('group2'), {'alice'})
+
+    def test_set_details(self):
+        """
+        Test the checks follow the groups set with the other details.
+        """
+
+        self.assertEqual(self.webservice.group_members('group2'), {'bob'})
+        self.assertEqual(len(self.webservice.get_group('group1')), 2)
+
+        self.webservice.set_details(self.bob, groups=['group3'])
+
+        self.assertFalse(self.webservice.is_member(self.bob, 'group2'))
+        self.assertTrue(self.webservice.is_member(self.bob, 'group3'))
+        self.assertEqual(self.webservice.group_members('group2'), set())
+        self.assertEqual([user['username']
+                          for user in self.webservice.get_group('group1')],
+                         ['alice'])
+
+
+class SharedCacheTestCase(TestCase):
+    """
+    Test caching records in the Web service shared between processes.
+    """
+
+    def setUp(self):
+        """
+        Create two Web services, as if in different processes
+        """
+        cache.clear()
+
+        self.webservice = UserWebService(shared_cache=SharedCache())
+        self.other_webservice = UserWebService(shared_cache=SharedCache())
+
+        for webservice in (self.webservice, self.other_webservice):
+            webservice.profile_server = 'https://ps/'
+            patcher = patch.object(webservice, '_request')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # pylint:disable=protected-access,no-member
+        self.request = self.webservice._request
+        self.other_request = self.other_webservice._request
+
+    def test_group_invalidation(self):
+        """
+        Test group changes in one process are seen by the others.
+        """
+
+        user = MagicMock(username='bob', email='bob@gov.gl')
+        self.request.return_value = response(data={'users': []})
+        self.other_request.return_value = response(data={
+            'username': 'bob',
+            'groups': [],
+        })
+
+        self.assertEqual(self.webservice.get_group('group1'), [])
+        self.assertEqual(self.webservice.get_group('group1'), [])
+        self.assertEqual(self.request.call_count, 1)
+
+        self.other_webservice.add_groups(user, ['group1'])
+
+        self.request.return_value = response(data={'users': [{
+            'username': 'bob',
+        }]})
+        self.assertEqual(self.webservice.get_group('group1'),
+                         [{'username': 'bob'}])
+
+    def test_user_data(self):
+        """
+        Test user data is cached.
+        """
+
+        user = MagicMock(username='bob')
+        self.request.return_value = response(data={'objects': [{'id': 1}]})
+        self.other_request.return_value = response(data={'id': 2})
+
+        self.webservice.get_user_data(user)
+        self.assertEqual(self.other_webservice.get_user_data(user),
+                         [{'id': 1}])
+
+        self.other_webservice.set_user_data(user, 'key', 'value')
+        self.webservice.get_user_data(user)
+        self.assertEqual(self.request.call_count, 2)
+
+
+class TwoLevelCacheTestCase(TestCase):
+    """
+    Test the in-process caches of Web services sharing a cache.
+    """
+
+    def setUp(self):
+        """
+        Create two Web services, as if in different processes, with their own
+        in-process caches, sharing a cache and a mock profile server
+        """
+        cache.clear()
+
+        self.adapter = MockProfileAdapter()
+        self.mock_ps = self.adapter.server
+        self.mock_ps.register({
+            'email': 'bob@gov.gl',
+            'username': 'bob',
+            'groups': ['group1'],
+            'subscribed': True,
+        })
+        self.user = MagicMock(username='bob', email='bob@gov.gl')
+
+        self.webservice, self.other_webservice = (
+            UserWebService(cache=LRUCache(maxsize=10, ttl=60),
+                           shared_cache=SharedCache(ttl=60),
+                           adapter=MockProfileAdapter(self.mock_ps))
+            for _ in range(2))
+        self.webservice.profile_server = 'https://ps/'
+        self.other_webservice.profile_server = 'https://ps/'
+
+    def test_user_invalidation(self):
+        """
+        Test user changes in one process are seen by the others.
+        """
+
+        self.assertTrue(
+            self.webservice.find_by_username('bob')['subscribed'])
+        self.assertTrue(
+            self.webservice.find_by_email('bob@gov.gl')['subscribed'])
+        self.assertEqual(self.webservice.groups_for(self.user), {'group1'})
+
+        self.other_webservice.unsubscribe(self.user)
+        self.other_webservice.add_groups(self.user, ['group2'])
+
+        self.assertFalse(
+            self.webservice.find_by_username('bob')['subscribed'])
+        self.assertFalse(
+            self.webservice.find_by_email('bob@gov.gl')['subscribed'])
+        self.assertEqual(self.webservice.groups_for(self.user),
+                         {'group1', 'group2'})
+
+    def test_group_invalidation(self):
+        """
+        Test group changes in one process are seen by the others.
+        """
+
+        self.assertEqual(self.webservice.group_members('group2'), set())
+        self.assertFalse(self.webservice.is_member(self.user, 'group2'))
+
+        self.other_webservice.add_groups(self.user, ['group2'])
+
+        self.assertEqual(self.webservice.group_members('group2'), {'bob'})
+        self.assertTrue(self.webservice.is_member(self.user, 'group2'))
+
+
+def run(coroutine):
+    """
+    Run a coroutine to completion in a new event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@skipIf(httpx is None, "httpx is not installed")
+class AsyncWebServiceTestCase(TestCase):
+    """
+    Test the asynchronous Web service.
+    """
+
+    def setUp(self):
+        """
+        Create a Web service with a fake transport
+        """
+        self.requests = []
+        self.responses = {}
+        self.webservice = AsyncUserWebService()
+        self.webservice.profile_server = 'https://ps/'
+
+    def handle(self, request):
+        """
+        Record the request and return the prepared response.
+        """
+        self.requests.append(request)
+        status, data = self.responses.get(
+            (request.method, request.url.path), (404, {}))
+        return httpx.Response(status, json=data)
+
+    async def call(self, method, *args, **kwargs):
+        """
+        Call a Web service method with the fake transport.
+        """
+        # pylint:disable=protected-access
+        self.webservice._clients[asyncio.get_event_loop()] = \
+            httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        try:
+            return await getattr(self.webservice, method)(*args, **kwargs)
+        finally:
+            await self.webservice.aclose()
+
+    def test_find_by_username(self):
+        """
+        Test finding a user by username.
+        """
+
+        self.responses['GET', '/api/v2/user/bob/'] = \
+            (200, {'username': 'bob'})
+
+        self.assertEqual(run(self.call('find_by_username', 'bob')),
+                         {'username': 'bob'})
+        self.assertIsNone(run(self.call('find_by_username', 'alice')))
+
+    def test_add_groups(self):
+        """
+        Test adding groups to a user.
+        """
+
+        self.responses['GET', '/api/v2/user/bob/'] = \
+            (200, {'username': 'bob', 'groups': ['a']})
+        self.responses['PATCH', '/api/v2/user/bob/'] = \
+            (202, {'username': 'bob', 'groups': ['a', 'b']})
+
+        groups = run(self.call('add_groups', MagicMock(username='bob'),
+                               ['b']))
+
+        self.assertEqual(groups, ['a', 'b'])
+        patch_request = self.requests[-1]
+        self.assertEqual(patch_request.headers['Content-Type'],
+                         'application/json')
+        self.assertEqual(sorted(json.loads(patch_request.content)['groups']),
+                         ['a', 'b'])
+
+    def test_failure(self):
+        """
+        Test server errors raise ProfileServerFailure.
+        """
+
+        self.responses['GET', '/api/v2/user/'] = (500, {})
+
+        with self.assertRaises(ProfileServerFailure) as context:
+            run(self.call('list'))
+
+        self.assertEqual(str(context.exception),
+                         "Profile server failure: 500 Internal Server Error.")
@@ -5,10 +5,13 @@ Route configuration for the IX Profile client
 from django.conf.urls import include, url
 from django.views.generic import TemplateView
 
+from ixprofile_client import views
+
 # pylint:disable=invalid-name,no-value-for-parameter
 # The name 'urlpatterns' is a part of the API
 # 'cls' is a bogus parameter
 urlpatterns = [
     url(r'', include('social_django.urls', namespace='social')),
     url(r'^ixlogin/unbox/', TemplateView.as_view(template_name='unbox.html')),
+    url(r'^ixlogin/metrics/$', views.metrics, name='ixprofile_metrics'),
 ]
@@ -1,3 +1,26 @@
 """
 Views for the profile server client.
 """
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+from ixprofile_client import webservice
+
+
+def metrics(request):  # pylint:disable=unused-argument
+    """
+    The metrics of the requests to the profile server, in the Prometheus
+    text format.
+
+    Only available if PROFILE_SERVER_METRICS_VIEW is True and the metrics
+    are kept by a PrometheusMetrics sink.
+    """
+
+    sink = webservice.profile_server.metrics
+    if not getattr(settings, 'PROFILE_SERVER_METRICS_VIEW', False) or \
+            not hasattr(sink, 'render'):
+        raise Http404("Metrics are not enabled.")
+
+    return HttpResponse(sink.render(),
+                        content_type='text/plain; version=0.0.4')
@@ -8,161 +8,2066 @@ standard_library.install_aliases()
 from future.builtins import *
 # pylint:enable=redefined-builtin,unused-wildcard-import
 
+import asyncio
+import copy
+import itertools
 import json
+import os
+import threading
 import warnings
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging import getLogger
-from urllib.parse import urljoin  # pylint:disable=import-error
+from time import monotonic
+from types import SimpleNamespace
+# pylint:disable=import-error
+from urllib.parse import parse_qs, urljoin, urlparse
+# pylint:enable=import-error
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None  # pylint:disable=invalid-name
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.http import urlencode
+from django.utils.module_loading import import_string
+
+from ixprofile_client import exceptions
+from ixprofile_client.cache import LRUCache, SharedCache
+from ixprofile_client.metrics import record_call, with_current_recorders
+from ixprofile_client.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    remaining_time,
+    with_current_deadline,
+)
+from ixprofile_client.signals import profile_user_changed
+# pylint:enable=wrong-import-position
+
+
+LOG = getLogger(__name__)
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_ASYNC_MAX_CONNECTIONS = 100
+DEFAULT_CACHE_TTL = 60
+DEFAULT_SHARED_CACHE_TTL = 300
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_LOOKUPS_IN_FLIGHT = 8
+DEFAULT_VALIDATED_RESPONSES_TTL = 3600
+# (connect, read) in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_METRICS_SINK = 'ixprofile_client.metrics.REGISTRY'
+
+# Versions of the cached group listings, never reused
+_GROUP_VERSIONS = itertools.count(1)
+
+# The operations whose responses are kept to revalidate them; lists and pages
+# of groups are too large to keep
+REVALIDATED_OPERATIONS = frozenset(('find_by_username', 'get_group',
+                                    'get_user_data'))
+
+
+class BaseUserWebService:
+    """
+    Parts of the profile server Web service shared by the blocking and the
+    asynchronous clients: URLs, request payloads and response handling.
+    """
+
+    USER_LIST_URI = "/api/v2/user/"
+    USER_URI = "/api/v2/user/%s/"
+    GROUP_URI = "/api/v2/group/%s/"
+    USER_PREFERENCE_LIST_URI = "/api/v2/user-preference/"
+    USER_PREFERENCE_URI = "/api/v2/user-preference/%d/"
+
+    # How many times to try changing the groups of a user modified
+    # concurrently
+    update_groups_attempts = 3
+
+    register_email_template = None
+    register_email_subject = None
+
+    def __init__(self):
+        """
+        Create a new instance of a Web service.
+        """
+        self.profile_server = settings.PROFILE_SERVER
+
+    def _list_uri(self, **kwargs):
+        """
+        The URL for the user list.
+        """
+        if kwargs:
+            query_string = '?' + urlencode(kwargs, doseq=True)
+        else:
+            query_string = ''
+
+        return urljoin(self.profile_server, self.USER_LIST_URI) + query_string
+
+    def _detail_uri(self, username):
+        """
+        The URL for the user details.
+        """
+        return urljoin(self.profile_server, self.USER_URI % username)
+
+    def _reset_password_uri(self, username):
+        """
+        The URL to request a password reset for a user.
+        """
+        return urljoin(self._detail_uri(username), 'reset-password/')
+
+    def _group_uri(self, group):
+        """
+        The URL for the users of a group.
+        """
+        return urljoin(self.profile_server, self.GROUP_URI % group)
+
+    def _user_data_uri(self, username):
+        """
+        The URL for the user data (preferences) of a user.
+        """
+        return self._detail_uri(username) + 'preferences/'
+
+    def _user_data_list_uri(self):
+        """
+        The URL to create user data.
+        """
+        return urljoin(self.profile_server, self.USER_PREFERENCE_LIST_URI)
+
+    def _user_data_detail_uri(self, id_):
+        """
+        The URL of a single user data record.
+        """
+        return urljoin(self.profile_server, self.USER_PREFERENCE_URI % id_)
+
+    @staticmethod
+    def _auth():
+        """
+        The credentials to authenticate to the profile server with.
+        """
+        return (
+            settings.PROFILE_SERVER_KEY,
+            settings.PROFILE_SERVER_SECRET
+        )
+
+    @staticmethod
+    def _headers(method, kwargs):
+        """
+        Set the headers required for the request method in the request
+        keyword arguments.
+        """
+        if method != 'GET':
+            kwargs.setdefault('headers', {}).\
+                setdefault('Content-Type', 'application/json')
+
+    @staticmethod
+    def _raise_for_failure(response):
+        """
+        Raise an appropriate exception on a Web service response
+        """
+        if 400 <= response.status_code < 600:
+            raise exceptions.ProfileServerFailure(response)
+
+    @staticmethod
+    def _check_details(details):
+        """
+        Check the user details exist before modifying them.
+        """
+        if not details:
+            raise exceptions.ProfileServerFailure("User could not be found.")
+
+    @staticmethod
+    def _check_details_arguments(email, username):
+        """
+        Validate the arguments of the deprecated details method.
+        """
+
+        warnings.warn("Please user 'find_by_username' or 'find_by_email'.",
+                      DeprecationWarning, stacklevel=3)
+
+        if username is not None and email is not None:
+            raise ValueError("Exactly one of 'username' or 'email' must be "
+                             "specified in the arguments.")
+
+        if username is None and email is None:
+            raise ValueError("Exactly one of 'username' or 'email' must be "
+                             "specified in the arguments.")
+
+    @staticmethod
+    def _email_search_result(users, email):
+        """
+        The single user found by an email search.
+
+        If the email address is not unique, raise a EmailNotUnique exception.
+        """
+
+        count = users['meta']['total_count']
+        if count == 0:
+            return None
+
+        if count > 1:
+            raise exceptions.EmailNotUnique(None, email)
+
+        return users['objects'][0]
+
+    @staticmethod
+    def _next_page_offset(users):
+        """
+        The offset of the next page of a user list, or None if this is the
+        last page.
+        """
+
+        meta = users['meta']
+        if not meta.get('next') or not users['objects']:
+            return None
+
+        query = parse_qs(urlparse(meta['next']).query)
+        try:
+            return int(query['offset'][0])
+        except (KeyError, ValueError):
+            return meta['offset'] + len(users['objects'])
+
+    @staticmethod
+    def _remaining_page_offsets(users):
+        """
+        The offsets of all the pages of a user list after the given one.
+        """
+
+        meta = users['meta']
+        limit = meta['limit'] or len(users['objects'])
+        if not limit:
+            return range(0)
+
+        return range(meta['offset'] + limit, meta['total_count'], limit)
+
+    def _register_data(self, user):
+        """
+        The request payload to register a new user.
+        """
+        data = {
+            'email': user.email,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+        }
+
+        if user.username:
+            data['username'] = user.username
+
+        if self.register_email_template is not None:
+            data['email_template'] = self.register_email_template
+        if self.register_email_subject is not None:
+            data['email_subject'] = self.register_email_subject
+
+        return data
+
+    @staticmethod
+    def _update_connected_user(user, details, registered):
+        """
+        Update a Django user from the details of the connected profile server
+        user.
+        """
+        if not registered:
+            user.first_name = details['first_name']
+            user.last_name = details['last_name']
+        user.username = details['username']
+        user.set_password(None)
+
+    @staticmethod
+    def _details_data(details):
+        """
+        The request payload to set the details of a user.
+        """
+
+        # If `subscribed' is not set but we are changing the status of
+        # the current app, `subscribed' must be set
+        if 'subscribed' not in details and 'subscriptions' in details \
+                and settings.PROFILE_SERVER_KEY in details['subscriptions']:
+            details['subscribed'] = \
+                details['subscriptions'][settings.PROFILE_SERVER_KEY]
+
+        for field in ('date_joined', 'last_login'):
+            if details.get(field):
+                details[field] = details[field].isoformat()
+
+        return details
+
+    @staticmethod
+    def _user_data_params(key):
+        """
+        The query parameters to get the user data.
+        """
+
+        params = {'limit': 0}
+
+        if key:
+            params['type'] = key
+
+        return params
+
+    @staticmethod
+    def _user_data_result(response):
+        """
+        The user data records from the profile server response.
+        """
+
+        try:
+            return response.json()['objects']
+        except (ValueError, KeyError):
+            return []
+
+    def _set_user_data_payload(self, user, key, value):
+        """
+        The request payload to set a user data record.
+        """
+
+        return {
+            'user': self.USER_URI % user.username,
+            'type': key,
+            'data': value,
+        }
+
+    @staticmethod
+    def _update_groups_data(details, add, remove):
+        """
+        The request payload to add a user to some groups and remove them from
+        others.
+        """
+        return {
+            'groups': sorted((set(details['groups']) | set(add)) -
+                             set(remove)),
+        }
+
+    @staticmethod
+    def _groups_diff(current, groups, managed_groups=None):
+        """
+        The groups to add a user to and remove them from to change their
+        current groups to the given ones, only changing managed_groups if
+        given.
+        """
+
+        add = set(groups) - set(current)
+        remove = set(current) - set(groups)
+        if managed_groups is not None:
+            add &= set(managed_groups)
+            remove &= set(managed_groups)
+
+        return add, remove
+
+    @staticmethod
+    def _check_group_mapping(mapping):
+        """
+        Check the groups of the users keyed by username are lists of group
+        names, raising ValueError otherwise.
+        """
+
+        for username, groups in mapping.items():
+            if not isinstance(groups, (list, tuple)) or \
+                    not all(isinstance(group, str) for group in groups):
+                raise ValueError(
+                    "The groups of %s must be a list of group names, not %r."
+                    % (username, groups))
+
+    @staticmethod
+    def _if_match(response):
+        """
+        The headers making a change conditional on the resource in the
+        response not having changed since.
+        """
+
+        etag = response.headers.get('ETag')
+        if etag is None:
+            return {}
+
+        return {'If-Match': etag}
+
+
+class Flight:
+    """
+    A request in flight, the response of which is shared with the threads
+    waiting for it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """
+        Wait for the response and return a copy of it, or raise the error
+        the request failed with. Return None if it isn't done within timeout
+        seconds, or if it was abandoned on the deadline of the thread sending
+        it.
+
+        The copy shares the body, but each of the waiting threads decodes it
+        separately, so the results can be modified without affecting the
+        others.
+        """
+
+        if not self.done.wait(timeout):
+            return None
+
+        if self.error is not None:
+            raise self.error
+
+        if self.response is None:
+            return None
+
+        response = copy.copy(self.response)
+        response.headers = self.response.headers.copy()
+        return response
+
+
+class UserWebService(BaseUserWebService):
+    """
+    Web service to interact with the profile server user records
+    """
+
+    cache = None
+    shared_cache = None
+    validated_responses = None
+    metrics = None
+
+    coalesce_requests = True
+
+    def _request(self, method, url, operation=None, **kwargs):
+        """
+        Make a request to the profile server for the named operation.
+
+        Identical GET requests made concurrently by several threads are
+        coalesced: only the first one is sent, and the others wait for and
+        share its response.
+        """
+
+        if method == 'GET' and self.coalesce_requests:
+            return self._coalesced_get(url, operation=operation, **kwargs)
+
+        return self._send(method, url, operation=operation, **kwargs)
+
+    def _coalesced_get(self, url, operation=None, **kwargs):
+        """
+        Make a GET request to the profile server, or wait for the same request
+        already in flight.
+        """
+
+        key = self._request_key(url, kwargs)
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            # Wait no longer than the deadline of this thread
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise exceptions.ProfileServerTimeout(
+                    "Deadline expired before requesting %s" % url)
+            response = flight.wait(remaining)
+            if response is not None:
+                return response
+            if not flight.done.is_set():
+                raise exceptions.ProfileServerTimeout(
+                    "Deadline expired waiting for %s" % url)
+
+            # The request was abandoned on the deadline of the thread sending
+            # it, which isn't this one's: request it again
+            return self._coalesced_get(url, operation=operation, **kwargs)
+
+        try:
+            flight.response = self._conditional_get(url, operation=operation,
+                                                    **kwargs)
+            return flight.response
+        except exceptions.ProfileServerTimeout:
+            # Not shared: the waiting threads can have more time
+            raise
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @staticmethod
+    def _request_key(url, kwargs):
+        """
+        A key identifying a GET request.
+        """
+        return (url, json.dumps(kwargs, sort_keys=True, default=str))
+
+    def _conditional_get(self, url, operation=None, **kwargs):
+        """
+        Make a GET request to the profile server.
+
+        If an earlier response to the same request had an ETag or a
+        Last-Modified header, ask for the resource only if it was modified
+        since, and reuse the earlier response if it wasn't. Only the responses
+        to REVALIDATED_OPERATIONS are kept.
+        """
+
+        if self.validated_responses is None or \
+                operation not in REVALIDATED_OPERATIONS:
+            return self._send('GET', url, operation=operation, **kwargs)
+
+        key = self._request_key(url, kwargs)
+        previous = self.validated_responses.get(key)
+
+        if previous is not None:
+            headers = dict(kwargs.get('headers') or {})
+            if 'ETag' in previous.headers:
+                headers['If-None-Match'] = previous.headers['ETag']
+            if 'Last-Modified' in previous.headers:
+                headers['If-Modified-Since'] = \
+                    previous.headers['Last-Modified']
+            kwargs = dict(kwargs, headers=headers)
+
+        response = self._send('GET', url, operation=operation, **kwargs)
+
+        # pylint:disable=no-member
+        if response.status_code == requests.codes.not_modified \
+                and previous is not None:
+            LOG.debug("Not modified: '%s'", url)
+            response = copy.copy(previous)
+            response.headers = previous.headers.copy()
+        elif response.status_code == requests.codes.ok and (
+                'ETag' in response.headers or
+                'Last-Modified' in response.headers):
+            self.validated_responses.set(key, response)
+        else:
+            self.validated_responses.pop(key)
+
+        return response
+
+    def _send(self, method, url, operation=None, **kwargs):
+        """
+        Send a request to the profile server.
+
+        Failed idempotent requests are retried according to the retry policy.
+        While the circuit breaker for the server is open, requests fail
+        immediately with ProfileServerUnavailable.
+
+        Requests time out according to the timeouts of the operation, and
+        never wait past the current deadline; both raise
+        ProfileServerTimeout.
+
+        The outcome, duration and retries of the request are recorded in the
+        metrics sink, if any, and the call in the active call recorders.
+        """
+
+        self._headers(method, kwargs)
+        breaker = self.circuit_breaker(url)
+
+        started = monotonic()
+        attempt = 0
+        status = 'timeout'
+        response = None
+        try:
+            while True:
+                try:
+                    result = self._attempt(method, url, breaker,
+                                           self._timeout(operation, url),
+                                           **kwargs)
+                except exceptions.ProfileServerUnavailable:
+                    status = 'unavailable'
+                    raise
+
+                if isinstance(result, requests.RequestException):
+                    response = None
+                    status = 'timeout' \
+                        if isinstance(result, requests.Timeout) else 'error'
+                    if not self._should_retry(method, attempt):
+                        if isinstance(result, requests.Timeout):
+                            raise exceptions.ProfileServerTimeout(
+                                "%s timed out" % url) from result
+                        raise result
+                else:
+                    response = result
+                    status = response.status_code
+                    if not self._should_retry(method, attempt, response):
+                        return response
+
+                delay = self.retry_policy.delay(attempt)
+                remaining = remaining_time()
+                if remaining is not None and delay >= remaining:
+                    raise exceptions.ProfileServerTimeout(
+                        "Deadline expired retrying %s" % url)
+
+                LOG.warning("Retrying %s '%s' after a failure", method, url)
+                self.retry_policy.sleep(delay)
+                attempt += 1
+        finally:
+            duration = monotonic() - started
+            record_call(operation or 'other', duration)
+            if self.metrics is not None:
+                self._record_metrics(operation, status, duration,
+                                     kwargs.get('data'), response, attempt)
+
+    def _attempt(self, method, url, breaker, timeout, **kwargs):
+        """
+        Send a request once, if the circuit breaker, if any, lets it through,
+        and record its outcome in the breaker.
+
+        Return the response, or the requests exception the request failed
+        with. Any other error is recorded as a failure too, so a half-open
+        breaker isn't left waiting for its probe forever.
+        """
+
+        if breaker is not None and not breaker.allow():
+            raise exceptions.ProfileServerUnavailable(
+                "%s is unavailable" % urlparse(url).netloc)
+
+        success = False
+        try:
+            response = self.session.request(
+                method,
+                url,
+                auth=self._auth(),
+                verify=settings.SSL_CA_FILE,
+                timeout=timeout,
+                **kwargs
+            )
+            success = response.status_code < 500
+            return response
+        except requests.RequestException as error:
+            return error
+        finally:
+            if breaker is not None:
+                breaker.record(success)
+
+    # pylint:disable=too-many-arguments
+    def _record_metrics(self, operation, status, duration, data, response,
+                        retries):
+        """
+        Record a request in the metrics sink.
+        """
+
+        if isinstance(data, str):
+            data = data.encode()
+
+        self.metrics.record(
+            operation or 'other',
+            status,
+            duration,
+            len(data or b''),
+            len(response.content) if response is not None else 0,
+            retries,
+        )
+
+    @staticmethod
+    def _timeout(operation, url):
+        """
+        The (connect, read) timeout for a request of the operation, shortened
+        to the time left until the current deadline, if any.
+
+        Timeouts are configured in PROFILE_SERVER_TIMEOUTS by operation name
+        (e.g. 'find_by_username'), falling back to 'default'.
+        """
+
+        timeouts = getattr(settings, 'PROFILE_SERVER_TIMEOUTS', {})
+        timeout = timeouts.get(operation,
+                               timeouts.get('default', DEFAULT_TIMEOUT))
+
+        remaining = remaining_time()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise exceptions.ProfileServerTimeout(
+                "Deadline expired before requesting %s" % url)
+
+        if not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        return tuple(remaining if value is None else min(value, remaining)
+                     for value in timeout)
+
+    def _should_retry(self, method, attempt, response=None):
+        """
+        Whether to retry a failed request.
+        """
+        return self.retry_policy is not None and \
+            self.retry_policy.should_retry(method, attempt, response)
+
+    @staticmethod
+    def _in_context(function):
+        """
+        Wrap the function to run in another thread under the deadline and
+        call recorders of the calling thread.
+        """
+        return with_current_deadline(with_current_recorders(function))
+
+    def circuit_breaker(self, url):
+        """
+        The circuit breaker for the server of the URL, if circuit breaking is
+        enabled.
+        """
+
+        if self.circuit_breaker_options is None:
+            return None
+
+        host = urlparse(url).netloc
+        with self._transport_lock:
+            try:
+                return self.circuit_breakers[host]
+            except KeyError:
+                breaker = self.circuit_breakers[host] = \
+                    CircuitBreaker(**self.circuit_breaker_options)
+                return breaker
+
+    # pylint:disable=too-many-arguments
+    def __init__(self, cache=None, shared_cache=None, adapter=None,
+                 retry_policy=None, metrics=None):
+        """
+        Create a new instance of a Web service.
+
+        User records are cached in the given cache. If none is given and
+        PROFILE_SERVER_CACHE_SIZE is set, they are cached in an LRUCache of
+        that size for PROFILE_SERVER_CACHE_TTL seconds.
+
+        User records, group listings and user data are also cached in the
+        given shared_cache, or, if PROFILE_SERVER_SHARED_CACHE is set, in a
+        SharedCache using that Django cache alias, for
+        PROFILE_SERVER_SHARED_CACHE_TTL seconds.
+
+        If the user record cache is enabled, up to the same number of
+        responses with an ETag or Last-Modified header (or
+        PROFILE_SERVER_VALIDATED_RESPONSES, if set) are kept for
+        PROFILE_SERVER_VALIDATED_RESPONSES_TTL seconds, to revalidate them
+        instead of fetching them again.
+
+        Requests are sent through the given transport adapter, or a
+        connection pool.
+
+        Failed requests are retried according to the given retry policy, or
+        one created with the PROFILE_SERVER_RETRIES options (set it to None
+        to disable retries). Circuit breakers are created for each server
+        with the PROFILE_SERVER_CIRCUIT_BREAKER options (set it to None to
+        disable them).
+
+        The metrics of the requests are recorded in the given sink, or the
+        one at the dotted path in PROFILE_SERVER_METRICS_SINK, by default
+        ixprofile_client.metrics.REGISTRY (set it to None to disable
+        metrics).
+        """
+        super(UserWebService, self).__init__()
+
+        if cache is None:
+            cache = self._make_cache()
+        self.cache = cache
+
+        if shared_cache is None:
+            shared_cache = self._make_shared_cache()
+        self.shared_cache = shared_cache
+
+        self.validated_responses = self._make_validated_responses()
+
+        if retry_policy is None:
+            retry_policy = self._make_retry_policy()
+        self.retry_policy = retry_policy
+
+        if metrics is None:
+            metrics = self._make_metrics()
+        self.metrics = metrics
+
+        self.circuit_breaker_options = getattr(
+            settings, 'PROFILE_SERVER_CIRCUIT_BREAKER', {})
+        self.circuit_breakers = {}
+
+        self._given_adapter = adapter
+        self._transport_lock = threading.Lock()
+        self._transport_pid = None
+        self._adapter = None
+        self._local = threading.local()
+
+        self._flights_lock = threading.Lock()
+        self._flights = {}
+
+    @staticmethod
+    def _make_cache():
+        """
+        Create the user record cache configured in the settings, if any.
+        """
+
+        size = getattr(settings, 'PROFILE_SERVER_CACHE_SIZE', 0)
+        if not size:
+            return None
+
+        return LRUCache(size, getattr(settings, 'PROFILE_SERVER_CACHE_TTL',
+                                      DEFAULT_CACHE_TTL))
+
+    @staticmethod
+    def _make_retry_policy():
+        """
+        Create the retry policy configured in the settings, if any.
+        """
+
+        options = getattr(settings, 'PROFILE_SERVER_RETRIES', {})
+        if options is None:
+            return None
+
+        return RetryPolicy(**options)
+
+    @staticmethod
+    def _make_metrics():
+        """
+        Get the metrics sink configured in the settings, if any.
+        """
+
+        path = getattr(settings, 'PROFILE_SERVER_METRICS_SINK',
+                       DEFAULT_METRICS_SINK)
+        if path is None:
+            return None
+
+        return import_string(path)
+
+    @staticmethod
+    def _make_validated_responses():
+        """
+        Create the store of responses to revalidate, if enabled.
+        """
+
+        size = getattr(settings, 'PROFILE_SERVER_VALIDATED_RESPONSES',
+                       getattr(settings, 'PROFILE_SERVER_CACHE_SIZE', 0))
+        if not size:
+            return None
+
+        return LRUCache(size, getattr(settings,
+                                      'PROFILE_SERVER_VALIDATED_RESPONSES_TTL',
+                                      DEFAULT_VALIDATED_RESPONSES_TTL))
+
+    @staticmethod
+    def _make_shared_cache():
+        """
+        Create the shared cache configured in the settings, if any.
+        """
+
+        alias = getattr(settings, 'PROFILE_SERVER_SHARED_CACHE', None)
+        if alias is None:
+            return None
+
+        return SharedCache(alias,
+                           getattr(settings, 'PROFILE_SERVER_SHARED_CACHE_TTL',
+                                   DEFAULT_SHARED_CACHE_TTL))
+
+    @staticmethod
+    def _make_adapter():
+        """
+        Create the connection pool adapter for the profile server.
+
+        PROFILE_SERVER_POOL_CONNECTIONS is the number of per-host pools kept,
+        PROFILE_SERVER_POOL_MAXSIZE is the number of keep-alive connections
+        kept per host.
+        """
+        return HTTPAdapter(
+            pool_connections=getattr(settings,
+                                     'PROFILE_SERVER_POOL_CONNECTIONS',
+                                     DEFAULT_POOL_CONNECTIONS),
+            pool_maxsize=getattr(settings,
+                                 'PROFILE_SERVER_POOL_MAXSIZE',
+                                 DEFAULT_POOL_MAXSIZE),
+        )
+
+    @property
+    def session(self):
+        """
+        The HTTP session to use for requests from the current thread.
+
+        requests.Session is not guaranteed to be thread-safe, so every thread
+        gets its own session; all of them share a single connection pool, so
+        keep-alive connections to the profile server are reused across calls
+        and threads. The pool is rebuilt in a forked process, as sockets must
+        not be shared with the parent.
+        """
+
+        pid = os.getpid()
+        if self._transport_pid != pid:
+            with self._transport_lock:
+                if self._transport_pid != pid:
+                    self._adapter = self._given_adapter or \
+                        self._make_adapter()
+                    self._local = threading.local()
+                    self._transport_pid = pid
+
+        local = self._local
+        try:
+            return local.session
+        except AttributeError:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            local.session = session
+            return session
+
+    def close(self):
+        """
+        Close the keep-alive connections to the profile server.
+        """
+        with self._transport_lock:
+            if self._adapter is not None:
+                self._adapter.close()
+            self._adapter = None
+            self._local = threading.local()
+            self._transport_pid = None
+
+    def _shared_tag(self, namespace, subject):
+        """
+        The tag of a record about to be fetched for the in-process cache:
+        the versions of its subject in the shared cache, if there is one.
+
+        The tag is read before fetching, so a record invalidated meanwhile,
+        by any process, is seen as out of date.
+        """
+
+        if self.shared_cache is None:
+            return None
+
+        return (namespace, subject,
+                self.shared_cache.versions(namespace, subject))
+
+    def _is_current(self, tag):
+        """
+        Whether a record cached in-process with the tag is still current.
+        """
+        return tag is None or \
+            tag[2] == self.shared_cache.versions(tag[0], tag[1])
+
+    def _cached_user(self, key):
+        """
+        A copy of the user record cached under the key, if any and current.
+        """
+
+        if self.cache is None:
+            return None
+
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+
+        tag, details = entry
+        if not self._is_current(tag):
+            return None
+
+        return copy.deepcopy(details)
+
+    def _cache_user(self, details, tag):
+        """
+        Cache a user record by username and email, with the tag read before
+        fetching it.
+        """
+
+        if self.cache is None or not details:
+            return
+
+        entry = (tag, copy.deepcopy(details))
+        self.cache.set(('username', details['username']), entry)
+        if details.get('email'):
+            self.cache.set(('email', details['email'].lower()), entry)
+
+    def _group_version(self, group):
+        """
+        The version of the cached listings of a group, read before fetching
+        a listing to cache.
+
+        Invalidating a group, in this process or, with a shared cache, in any
+        other, changes its version, so the listings cached under the old one,
+        or being fetched, are ignored.
+        """
+
+        version = self.cache.get(('group_version', group))
+        if version is None:
+            version = next(_GROUP_VERSIONS)
+            self.cache.set(('group_version', group), version)
+
+        if self.shared_cache is not None:
+            return (version, self.shared_cache.versions('group', group))
+        return version
+
+    def _cached_group(self, group, version, variant):
+        """
+        A copy of the listing of a group cached for the version and the
+        variant, if any.
+        """
+
+        users = self.cache.get(('group', group, version, variant))
+        if users is None:
+            return None
+
+        return copy.deepcopy(users)
+
+    def _cache_group(self, group, version, variant, users):
+        """
+        Cache the listing of a group for the version and the variant.
+        """
+        self.cache.set(('group', group, version, variant),
+                       copy.deepcopy(users))
+
+    def _shared(self, namespace, subject, fetch, variant=None):
+        """
+        Get a record through the shared cache, if there is one.
+        """
+
+        if self.shared_cache is None:
+            return fetch()
+
+        return self.shared_cache.get_or_fetch(namespace, subject, fetch,
+                                              variant=variant)
+
+    def _invalidate_user(self, user, *emails):
+        """
+        Remove the cached records of a user modified through this client.
+
+        Extra emails (e.g. one the user is changing to) are removed as well,
+        and profile_user_changed is sent for the other copies in the process.
+        """
+
+        emails = list(emails)
+        emails.append(getattr(user, 'email', None))
+
+        username = getattr(user, 'username', None)
+        if username and self.cache is not None:
+            entry = self.cache.pop(('username', username))
+            if entry is not None:
+                emails.append(entry[1].get('email'))
+            self.cache.pop(('groups_for', username))
+
+        emails = set(email.lower() for email in emails if email)
+
+        if self.cache is not None:
+            for email in emails:
+                self.cache.pop(('email', email))
+
+        if self.shared_cache is not None:
+            if username:
+                self.shared_cache.invalidate('user', username)
+            for email in emails:
+                self.shared_cache.invalidate('email', email)
+
+        if username:
+            profile_user_changed.send(sender=self.__class__,
+                                      username=username)
+
+    def _invalidate_groups(self, groups):
+        """
+        Remove the cached listings of groups modified through this client.
+        """
+
+        if self.cache is not None:
+            for group in groups:
+                self.cache.pop(('group_version', group))
+
+        if self.shared_cache is not None:
+            for group in groups:
+                self.shared_cache.invalidate('group', group)
+
+    def _set_subscription_status(self, user, status):
+        """
+        Set the subscription status of a user.
+        """
+        data = {'subscribed': status}
+        response = self._request('PATCH', self._detail_uri(user.username),
+                                 operation='subscribe' if status
+                                 else 'unsubscribe',
+                                 data=json.dumps(data))
+        self._invalidate_user(user)
+        self._raise_for_failure(response)
+
+    def subscribe(self, user):
+        """
+        Subscribe the user to the current application on the profile server
+        """
+        self._set_subscription_status(user, True)
+
+    def unsubscribe(self, user):
+        """
+        Unsubscribe the user from the current application on the profile server
+        """
+        self._set_subscription_status(user, False)
+
+    def details(self, email=None, username=None):
+        """
+        Get the user details from the profile server.
+
+        Either 'username' or 'email' must be explicitly passed as kwargs,
+        so the old calls passing 'username' stop working.
+        """
+
+        self._check_details_arguments(email, username)
+
+        if username is not None:
+            return self.find_by_username(username)
+
+        return self.find_by_email(email)
+
+    def _fetch_user_response(self, username):
+        """
+        Get the response with a user from the profile server, bypassing the
+        cache, or None if the user is not found.
+        """
+
+        response = self._request('GET', self._detail_uri(username),
+                                 operation='find_by_username')
+        if response.status_code == requests.codes.not_found:
+            return None
+
+        self._raise_for_failure(response)
+        return response
+
+    def _fetch_user(self, username):
+        """
+        Get a user by username from the profile server, bypassing the cache.
+        """
+
+        response = self._fetch_user_response(username)
+        if response is None:
+            return None
+
+        return response.json()
+
+    def _validated_user_key(self, username):
+        """
+        The key of the response with a user in the validated responses.
+        """
+        return self._request_key(self._detail_uri(username), {})
+
+    def _validated_user_response(self, username):
+        """
+        The last response with a user and its ETag, if kept for revalidation.
+        """
+
+        if self.validated_responses is None:
+            return None
+
+        response = self.validated_responses.get(
+            self._validated_user_key(username))
+        if response is None or 'ETag' not in response.headers:
+            return None
+
+        return response
+
+    def _keep_validated_user_response(self, username, response):
+        """
+        Keep the response to a change of a user, which has the new details,
+        to revalidate the user instead of fetching it again.
+        """
+
+        if self.validated_responses is None:
+            return
+
+        key = self._validated_user_key(username)
+        if response.ok and 'ETag' in response.headers:
+            kept = copy.copy(response)
+            kept.headers = response.headers.copy()
+            kept.status_code = requests.codes.ok
+            self.validated_responses.set(key, kept)
+        else:
+            self.validated_responses.pop(key)
+
+    def find_by_username(self, username):
+        """
+        Find a user by username.
+        """
+
+        details = self._cached_user(('username', username))
+        if details is None:
+            tag = self._shared_tag('user', username)
+            details = self._shared('user', username,
+                                   lambda: self._fetch_user(username))
+            self._cache_user(details, tag)
+
+        return details
+
+    def find_by_email(self, email):
+        """
+        Find a user by email.
+
+        If the email address is not unique, raise a EmailNotUnique exception.
+        """
+
+        details = self._cached_user(('email', email.lower()))
+        if details is None:
+            tag = self._shared_tag('email', email.lower())
+            details = self._shared(
+                'email', email.lower(),
+                lambda: self._email_search_result(self.list(email=email),
+                                                  email))
+            self._cache_user(details, tag)
+
+        return details
+
+    def _find_many(self, find, cache_keys, lookups_in_flight):
+        """
+        Look up several users with the find function, keyed by the lookup
+        values.
+
+        Users in the cache are returned directly; the rest are looked up
+        concurrently, up to lookups_in_flight at a time.
+        """
+
+        result = {}
+        missing = []
+        for value, cache_key in cache_keys:
+            if value in result:
+                continue
+            result[value] = self._cached_user(cache_key)
+            if result[value] is None:
+                missing.append(value)
+
+        if len(missing) == 1 or lookups_in_flight <= 1:
+            result.update((value, find(value)) for value in missing)
+        elif missing:
+            with ThreadPoolExecutor(
+                    max_workers=min(lookups_in_flight, len(missing))
+            ) as executor:
+                result.update(zip(missing,
+                                  executor.map(self._in_context(find),
+                                               missing)))
+
+        return result
+
+    def find_by_usernames(self, usernames,
+                          lookups_in_flight=DEFAULT_LOOKUPS_IN_FLIGHT):
+        """
+        Find users by username.
+
+        Return a dict of the user details (or None if a user is not found)
+        keyed by username. The users not cached are looked up concurrently.
+        """
+
+        return self._find_many(
+            self.find_by_username,
+            ((username, ('username', username)) for username in usernames),
+            lookups_in_flight)
+
+    def find_by_emails(self, emails,
+                       lookups_in_flight=DEFAULT_LOOKUPS_IN_FLIGHT):
+        """
+        Find users by email.
+
+        Return a dict of the user details (or None if a user is not found)
+        keyed by email. The users not cached are looked up concurrently.
+
+        If any of the email addresses is not unique, raise a EmailNotUnique
+        exception.
+        """
+
+        return self._find_many(
+            self.find_by_email,
+            ((email, ('email', email.lower())) for email in emails),
+            lookups_in_flight)
+
+    def list(self, **kwargs):
+        """
+        List all the users subscribed to the application.
+
+        Kwargs are turned into a query string and
+        sent to profile server's /user/ endpoint.
+        """
+
+        response = self._request('GET', self._list_uri(**kwargs),
+                                 operation='list')
+        self._raise_for_failure(response)
+        return response.json()
+
+    def iter_users(self, page_size=DEFAULT_PAGE_SIZE, pages_in_flight=1,
+                   **kwargs):
+        """
+        Iterate over all the users in the list, fetching a page of page_size
+        users at a time.
+
+        If pages_in_flight is more than 1, the pages after the first one are
+        fetched concurrently, up to pages_in_flight at a time; the users are
+        still returned in order.
+
+        Kwargs are the same as for list(); the iteration starts at the given
+        offset, if any.
+        """
+
+        kwargs['limit'] = page_size
+        offset = kwargs.pop('offset', 0)
+
+        if pages_in_flight > 1:
+            return self._iter_users_concurrently(offset, pages_in_flight,
+                                                 kwargs)
+
+        return self._iter_users_sequentially(offset, kwargs)
+
+    def _iter_users_sequentially(self, offset, kwargs):
+        """
+        Iterate over the user list following the links to the next pages.
+        """
+
+        while offset is not None:
+            users = self.list(offset=offset, **kwargs)
+            for user in users['objects']:
+                yield user
+
+            offset = self._next_page_offset(users)
+
+    def _iter_users_concurrently(self, offset, pages_in_flight, kwargs):
+        """
+        Iterate over the user list fetching the pages after the first one in
+        a thread pool.
+        """
+
+        users = self.list(offset=offset, **kwargs)
+        offsets = iter(self._remaining_page_offsets(users))
+        pages = deque()
+        list_page = self._in_context(self.list)
+
+        with ThreadPoolExecutor(max_workers=pages_in_flight) as executor:
+
+            def fill():
+                """
+                Start fetching pages until pages_in_flight are in flight.
+                """
+                for page_offset in offsets:
+                    pages.append(executor.submit(list_page,
+                                                 offset=page_offset,
+                                                 **kwargs))
+                    if len(pages) >= pages_in_flight:
+                        break
+
+            try:
+                fill()
+                for user in users['objects']:
+                    yield user
+
+                while pages:
+                    users = pages.popleft().result()
+                    fill()
+                    for user in users['objects']:
+                        yield user
+            finally:
+                # Stop fetching if the iteration is abandoned
+                for page in pages:
+                    page.cancel()
+
+    def register(self, user):
+        """
+        Register a new user on the profile server
+        """
+        response = self._request('POST', self._list_uri(),
+                                 operation='register',
+                                 data=json.dumps(self._register_data(user)))
+        self._invalidate_user(user)
+        self._raise_for_failure(response)
+        return response.json()
+
+    def connect(self, user, commit=True):
+        """
+        Ensure a user with given user's email exists on the profile server,
+        update the details as needed and save the user if commit is True.
+        """
+        if user.username:
+            details = self.find_by_username(user.username)
+        else:
+            details = self.find_by_email(user.email)
+            if details:
+                user.username = details['username']
+
+        registered = details is None
+        if registered:
+            details = self.register(user)
+        else:
+            self.subscribe(user)
+        self._update_connected_user(user, details, registered)
+        if commit:
+            user.save()
+        return user
+
+    def reset_password(self, user):
+        """
+        Send the user a password reset email.
+        """
+
+        response = self._request(
+            'POST',
+            self._reset_password_uri(user.username),
+            operation='reset_password',
+        )
+        self._raise_for_failure(response)
+
+    def get_group(self, group, **kwargs):
+        """
+        Request the users in a profile server group
+
+        Profile server groups are typically referred to by a URI resource name
+        i.e. http://iss3/service/1234/ -- the names are considered meaningful
+        to the applications.
+        """
+        return self._get_group(group, True, **kwargs)
+
+    def _get_group(self, group, cached, **kwargs):
+        """
+        Request the users in a profile server group, through the caches if
+        cached is True.
+        """
+
+        def fetch():
+            """
+            Get the group users from the profile server.
+            """
+
+            url = self._group_uri(group)
+
+            LOG.debug("Requesting users for group '%s'", url)
+
+            response = self._request('GET', url,
+                                     operation='get_group' if cached
+                                     else 'iter_group',
+                                     params=kwargs)
+
+            # pylint:disable=no-member
+            # Instance of 'LookupDict' has no 'not_found' member
+            if response.status_code == requests.codes.not_found:
+                return []
+
+            self._raise_for_failure(response)
+            return response.json()['users']
+
+        if not cached:
+            return fetch()
+
+        if self.cache is None:
+            return self._shared('group', group, fetch,
+                                variant=sorted(kwargs.items()))
+
+        version = self._group_version(group)
+        variant = json.dumps(sorted(kwargs.items()), default=str)
+        users = self._cached_group(group, version, variant)
+        if users is None:
+            users = self._shared('group', group, fetch,
+                                 variant=sorted(kwargs.items()))
+            self._cache_group(group, version, variant, users)
+
+        return users
+
+    def iter_group(self, group, page_size=DEFAULT_PAGE_SIZE, **kwargs):
+        """
+        Iterate over the users in a profile server group, fetching a page of
+        page_size users at a time.
+
+        Kwargs are the same as for get_group(); the iteration starts at the
+        given offset, if any. The pages are not cached, so only one is held
+        in memory at a time.
+        """
+
+        if page_size < 1:
+            raise ValueError("The page size must be at least 1.")
+
+        offset = kwargs.pop('offset', 0)
+
+        def pages():
+            """
+            Iterate over the users, a page at a time.
+            """
+
+            current = offset
+            while True:
+                users = self._get_group(group, False, limit=page_size,
+                                        offset=current, **kwargs)
+                for user in users:
+                    yield user
+
+                # A short page is the last one; so is a long one, if the
+                # server ignored the limit
+                if len(users) != page_size:
+                    return
+                current += page_size
+
+        return pages()
+
+    def get_groups(self, groups, lookups_in_flight=DEFAULT_LOOKUPS_IN_FLIGHT,
+                   **kwargs):
+        """
+        Request the users in several profile server groups.
+
+        Return a dict of the lists of users keyed by group. The groups are
+        requested concurrently, up to lookups_in_flight at a time; kwargs
+        are the same as for get_group().
+        """
+
+        groups = list(OrderedDict.fromkeys(groups))
+
+        def get_group(group):
+            """
+            Request the users in a group.
+            """
+            return self.get_group(group, **kwargs)
+
+        if len(groups) <= 1 or lookups_in_flight <= 1:
+            return {group: get_group(group) for group in groups}
+
+        with ThreadPoolExecutor(
+                max_workers=min(lookups_in_flight, len(groups))
+        ) as executor:
+            return dict(zip(groups,
+                            executor.map(self._in_context(get_group),
+                                         groups)))
+
+    def add_group(self, user, group):
+        """
+        Add a user to the named group
+        """
+        return self.add_groups(user, [group])
+
+    def add_groups(self, user, groups):
+        """
+        Add a user to the list of named groups
+        """
+        return self.update_groups(user, add=groups)
+
+    def remove_group(self, user, group):
+        """
+        Remove a user from the named group
+        """
+        return self.remove_groups(user, [group])
+
+    def remove_groups(self, user, groups):
+        """
+        Remove a user from multiple groups
+        """
+        return self.update_groups(user, remove=groups)
+
+    def update_groups(self, user, add=(), remove=()):
+        """
+        Add a user to the groups in add and remove them from the groups in
+        remove, in a single request when possible.
+
+        The user is fetched first, and the change sent with If-Match so it
+        is made again if the user has changed since. If
+        PROFILE_SERVER_HONOURS_IF_MATCH is set, the change is computed from
+        the last response with the user instead, if it was kept for
+        revalidation, relying on the server to reject it if the response is
+        outdated. The new groups of the user are returned.
+        """
+
+        known = None
+        if getattr(settings, 'PROFILE_SERVER_HONOURS_IF_MATCH', False):
+            known = self._validated_user_response(user.username)
+        return self._update_groups(user, add, remove, known)
+
+    def _update_groups(self, user, add, remove, known):
+        """
+        Change the groups of a user, based on the known response with the
+        user, if any.
+        """
+
+        for _ in range(self.update_groups_attempts):
+            if known is None:
+                known = self._fetch_user_response(user.username)
+                self._check_details(known)
+
+            response = self._request(
+                'PATCH',
+                self._detail_uri(user.username),
+                operation='update_groups',
+                headers=self._if_match(known),
+                data=json.dumps(self._update_groups_data(known.json(),
+                                                         add, remove)),
+            )
+            # pylint:disable=no-member
+            if response.status_code != requests.codes.precondition_failed:
+                break
+
+            LOG.debug("User '%s' changed, fetching it again", user.username)
+            known = None
+
+        self._invalidate_user(user)
+        self._invalidate_groups(set(add) | set(remove))
+        self._raise_for_failure(response)
+        self._keep_validated_user_response(user.username, response)
+
+        groups = response.json()['groups']
+        self._update_membership_index(user.username, set(add) | set(remove),
+                                      groups)
+        return groups
+
+    def _update_membership_index(self, username, changed, groups):
+        """
+        Update the cached groups of a user and members of the changed groups
+        after the groups of the user were changed through this client.
+
+        With a shared cache, the members of the changed groups are forgotten
+        instead, as they might have been changed by other processes.
+        """
+
+        if self.cache is None:
+            return
+
+        self.cache.set(('groups_for', username),
+                       (self._shared_tag('user', username), frozenset(groups)))
+
+        for group in changed:
+            entry = self.cache.pop(('members', group))
+            if entry is not None and self.shared_cache is None:
+                _, members = entry
+                if group in groups:
+                    members = members | {username}
+                else:
+                    members = members - {username}
+                self.cache.set(('members', group),
+                               (self._group_version(group), members))
+
+    def _cached_groups_for(self, username):
+        """
+        The cached groups of a user, if any and current.
+        """
+
+        entry = self.cache.get(('groups_for', username))
+        if entry is None:
+            return None
+
+        tag, groups = entry
+        if not self._is_current(tag):
+            return None
+        return groups
+
+    def _cached_members(self, group, version):
+        """
+        The cached members of a group, if any and cached for the version.
+        """
+
+        entry = self.cache.get(('members', group))
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def groups_for(self, user):
+        """
+        The names of the groups the user is in, as a frozenset; empty if the
+        user is not found.
+        """
+
+        if self.cache is not None:
+            groups = self._cached_groups_for(user.username)
+            if groups is not None:
+                return groups
+
+        tag = self._shared_tag('user', user.username)
+        details = self.find_by_username(user.username)
+        if details is None:
+            return frozenset()
+
+        groups = frozenset(details['groups'])
+        if self.cache is not None:
+            self.cache.set(('groups_for', user.username), (tag, groups))
+
+        return groups
+
+    def group_members(self, group):
+        """
+        The usernames of the users in a group, as a frozenset.
+        """
+
+        version = None
+        if self.cache is not None:
+            version = self._group_version(group)
+            members = self._cached_members(group, version)
+            if members is not None:
+                return members
+
+        members = frozenset(user['username'] for user in self.get_group(group))
+        if self.cache is not None:
+            self.cache.set(('members', group), (version, members))
+
+        return members
+
+    def is_member(self, user, group):
+        """
+        Whether the user is in the group.
+
+        The check uses the cached groups of the user or members of the group,
+        if either is known; otherwise the user is looked up.
+        """
+
+        if self.cache is not None:
+            groups = self._cached_groups_for(user.username)
+            if groups is not None:
+                return group in groups
 
-from ixprofile_client import exceptions
-# pylint:enable=wrong-import-position
+            members = self._cached_members(group,
+                                           self._group_version(group))
+            if members is not None:
+                return user.username in members
 
+        return group in self.groups_for(user)
 
-LOG = getLogger(__name__)
+    # pylint:disable=too-many-arguments
+    def _sync_user_groups(self, username, groups, managed_groups, dry_run):
+        """
+        Change the groups of a user to the given ones.
 
+        Return 'changed', 'unchanged' or 'missing' if the user is not found.
+        """
 
-class UserWebService:
-    """
-    Web service to interact with the profile server user records
-    """
+        known = self._fetch_user_response(username)
+        if known is None:
+            return 'missing'
 
-    USER_LIST_URI = "/api/v2/user/"
-    USER_URI = "/api/v2/user/%s/"
-    GROUP_URI = "/api/v2/group/%s/"
+        add, remove = self._groups_diff(known.json()['groups'], groups,
+                                        managed_groups)
+        if not add and not remove:
+            return 'unchanged'
 
-    register_email_template = None
-    register_email_subject = None
+        if not dry_run:
+            self._update_groups(SimpleNamespace(username=username),
+                                add, remove, known)
+        return 'changed'
 
-    def _list_uri(self, **kwargs):
+    # pylint:disable=too-many-arguments
+    def sync_group_memberships(self, mapping, managed_groups=None,
+                               lookups_in_flight=DEFAULT_LOOKUPS_IN_FLIGHT,
+                               dry_run=False, progress=None):
         """
-        The URL for the user list.
+        Change the groups of many users to the ones given in a dict keyed by
+        username.
+
+        Only the users whose groups differ are changed, with the minimal
+        additions and removals; up to lookups_in_flight users are
+        synchronised concurrently. If managed_groups is given, only those
+        groups are added or removed, and the other groups of the users are
+        kept. With dry_run, the changes are worked out but not made.
+
+        progress, if given, is called with the number of users done and the
+        total after every user.
+
+        Return a dict with the usernames 'changed', 'unchanged' and
+        'missing' from the profile server, and the errors of the users that
+        'failed' keyed by username.
+
+        Raise ValueError, before changing anything, if the groups of any user
+        are not a list of group names.
         """
-        if kwargs:
-            query_string = '?' + urlencode(kwargs, doseq=True)
-        else:
-            query_string = ''
 
-        return urljoin(self.profile_server, self.USER_LIST_URI) + query_string
+        self._check_group_mapping(mapping)
+        if managed_groups is not None:
+            managed_groups = set(managed_groups)
 
-    def _detail_uri(self, username):
+        result = {
+            'changed': [],
+            'unchanged': [],
+            'missing': [],
+            'failed': {},
+        }
+        sync = self._in_context(self._sync_user_groups)
+
+        with ThreadPoolExecutor(max_workers=max(1, lookups_in_flight)) \
+                as executor:
+            futures = {
+                executor.submit(sync, username, groups, managed_groups,
+                                dry_run): username
+                for username, groups in mapping.items()
+            }
+
+            for done, future in enumerate(as_completed(futures), 1):
+                username = futures[future]
+                try:
+                    result[future.result()].append(username)
+                except (exceptions.ProfileServerException,
+                        requests.RequestException) as error:
+                    LOG.warning("Failed to synchronise the groups of '%s': %s",
+                                username, error)
+                    result['failed'][username] = error
+
+                if progress is not None:
+                    progress(done, len(futures))
+
+        return result
+
+    def set_details(self, user, **details):
         """
-        The URL for the user details.
+        Set the details for the user
+
+        Setting the groups changes the cached listings of the groups the user
+        joins or leaves, so the groups the user is in are fetched first.
         """
-        return urljoin(self.profile_server, self.USER_URI % username)
 
-    def _request(self, method, url, **kwargs):
+        changed = None
+        if 'groups' in details:
+            known = self._fetch_user(user.username)
+            changed = set(details['groups'] or ())
+            if known is not None:
+                changed |= set(known['groups'])
+
+        response = self._request('PATCH',
+                                 self._detail_uri(user.username),
+                                 operation='set_details',
+                                 data=json.dumps(self._details_data(details)))
+        self._invalidate_user(user, details.get('email'))
+        if changed is not None:
+            self._invalidate_groups(changed)
+        self._raise_for_failure(response)
+
+        result = response.json()
+        if changed is not None:
+            self._update_membership_index(user.username, changed,
+                                          result['groups'])
+        return result
+
+    def get_user_data(self, user, key=None):
         """
-        Make a request to the profile server.
+        Get the user data for the user, including an optional key
         """
 
-        if method != 'GET':
-            kwargs.setdefault('headers', {}).\
-                setdefault('Content-Type', 'application/json')
+        def fetch():
+            """
+            Get the user data from the profile server.
+            """
 
-        return requests.request(
-            method,
-            url,
-            auth=(
-                settings.PROFILE_SERVER_KEY,
-                settings.PROFILE_SERVER_SECRET
-            ),
-            verify=settings.SSL_CA_FILE,
-            **kwargs
-        )
+            response = self._request('GET',
+                                     self._user_data_uri(user.username),
+                                     operation='get_user_data',
+                                     params=self._user_data_params(key))
+
+            if not response.ok:
+                # Don't cache failures
+                return None
+
+            return self._user_data_result(response)
+
+        data = self._shared('preferences', user.username, fetch, variant=key)
+        if data is None:
+            return []
+
+        return data
+
+    def set_user_data(self, user, key, value):
+        """
+        Set user data for the user. This data is stored as a key-value
+        pair inside the profile server
+        """
+
+        data = self._set_user_data_payload(user, key, value)
+
+        response = self._request('POST',
+                                 self._user_data_list_uri(),
+                                 operation='set_user_data',
+                                 data=json.dumps(data))
+        if self.shared_cache is not None:
+            self.shared_cache.invalidate('preferences', user.username)
+        self._raise_for_failure(response)
+
+        return response.json()
+
+    def delete_user_data(self, id_):
+        """
+        Delete user data by id
+        """
+
+        response = self._request('DELETE', self._user_data_detail_uri(id_),
+                                 operation='delete_user_data')
+        if self.shared_cache is not None:
+            # The owner of the record is unknown
+            self.shared_cache.invalidate_namespace('preferences')
+        self._raise_for_failure(response)
+
+
+class AsyncUserWebService(BaseUserWebService):
+    """
+    Asynchronous Web service to interact with the profile server user records
+
+    All the methods of UserWebService are available as coroutines. Requires
+    the httpx package.
+    """
 
     def __init__(self):
         """
         Create a new instance of a Web service.
         """
-        self.profile_server = settings.PROFILE_SERVER
+        super(AsyncUserWebService, self).__init__()
+
+        # httpx clients can't be shared between event loops
+        self._clients = weakref.WeakKeyDictionary()
 
     @staticmethod
-    def _raise_for_failure(response):
+    def _make_client():
         """
-        Raise an appropriate exception on a Web service response
+        Create the HTTP client for the profile server.
+
+        The number of keep-alive connections is configured by
+        PROFILE_SERVER_POOL_MAXSIZE, as for UserWebService; the number of
+        concurrent connections by PROFILE_SERVER_ASYNC_MAX_CONNECTIONS. The
+        default timeout of PROFILE_SERVER_TIMEOUTS applies to all the
+        requests.
         """
-        if 400 <= response.status_code < 600:
-            raise exceptions.ProfileServerFailure(response)
 
-    def _set_subscription_status(self, user, status):
+        if httpx is None:
+            raise ImproperlyConfigured(
+                "The httpx package is required for AsyncUserWebService."
+            )
+
+        verify = settings.SSL_CA_FILE
+        if verify is None:
+            verify = True
+
+        timeout = getattr(settings, 'PROFILE_SERVER_TIMEOUTS', {}).get(
+            'default', DEFAULT_TIMEOUT)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+
+        return httpx.AsyncClient(
+            auth=BaseUserWebService._auth(),
+            verify=verify,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=getattr(
+                    settings,
+                    'PROFILE_SERVER_ASYNC_MAX_CONNECTIONS',
+                    DEFAULT_ASYNC_MAX_CONNECTIONS),
+                max_keepalive_connections=getattr(
+                    settings,
+                    'PROFILE_SERVER_POOL_MAXSIZE',
+                    DEFAULT_POOL_MAXSIZE),
+            ),
+        )
+
+    @property
+    def client(self):
+        """
+        The HTTP client to use for requests from the running event loop.
+        """
+
+        loop = asyncio.get_event_loop()
+        try:
+            return self._clients[loop]
+        except KeyError:
+            client = self._clients[loop] = self._make_client()
+            return client
+
+    async def aclose(self):
+        """
+        Close the keep-alive connections of the running event loop to the
+        profile server.
+        """
+
+        client = self._clients.pop(asyncio.get_event_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _request(self, method, url, data=None, **kwargs):
+        """
+        Make a request to the profile server.
+        """
+
+        self._headers(method, kwargs)
+
+        return await self.client.request(method, url, content=data, **kwargs)
+
+    async def _set_subscription_status(self, user, status):
         """
         Set the subscription status of a user.
         """
         data = {'subscribed': status}
-        response = self._request('PATCH', self._detail_uri(user.username),
-                                 data=json.dumps(data))
+        response = await self._request('PATCH',
+                                       self._detail_uri(user.username),
+                                       data=json.dumps(data))
         self._raise_for_failure(response)
 
-    def subscribe(self, user):
+    async def subscribe(self, user):
         """
         Subscribe the user to the current application on the profile server
         """
-        self._set_subscription_status(user, True)
+        await self._set_subscription_status(user, True)
 
-    def unsubscribe(self, user):
+    async def unsubscribe(self, user):
         """
         Unsubscribe the user from the current application on the profile server
         """
-        self._set_subscription_status(user, False)
+        await self._set_subscription_status(user, False)
 
-    def details(self, email=None, username=None):
+    async def details(self, email=None, username=None):
         """
         Get the user details from the profile server.
 
-        Either 'username' or 'email' must be explicitly passed as kwargs,
-        so the old calls passing 'username' stop working.
+        Either 'username' or 'email' must be explicitly passed as kwargs.
         """
 
-        warnings.warn("Please user 'find_by_username' or 'find_by_email'.",
-                      DeprecationWarning)
-
-        if username is not None and email is not None:
-            raise ValueError("Exactly one of 'username' or 'email' must be "
-                             "specified in the arguments.")
+        self._check_details_arguments(email, username)
 
         if username is not None:
-            return self.find_by_username(username)
+            return await self.find_by_username(username)
 
-        if email is not None:
-            return self.find_by_email(email)
+        return await self.find_by_email(email)
 
-        raise ValueError("Exactly one of 'username' or 'email' must be "
-                            "specified in the arguments.")
-
-    def find_by_username(self, username):
+    async def find_by_username(self, username):
         """
         Find a user by username.
         """
 
-        response = self._request('GET', self._detail_uri(username))
+        response = await self._request('GET', self._detail_uri(username))
         if response.status_code == requests.codes.not_found:
             return None
 
         self._raise_for_failure(response)
         return response.json()
 
-    def find_by_email(self, email):
+    async def find_by_email(self, email):
         """
         Find a user by email.
 
         If the email address is not unique, raise a EmailNotUnique exception.
         """
 
-        users = self.list(email=email)
-        count = users['meta']['total_count']
-        if count == 0:
-            return None
+        return self._email_search_result(await self.list(email=email), email)
 
-        if count > 1:
-            raise exceptions.EmailNotUnique(None, email)
+    @staticmethod
+    async def _find_many(find, values, lookups_in_flight):
+        """
+        Look up several users with the find coroutine, keyed by the lookup
+        values, up to lookups_in_flight at a time.
+        """
 
-        return users['objects'][0]
+        values = list(dict.fromkeys(values))
+        semaphore = asyncio.Semaphore(lookups_in_flight)
 
-    def list(self, **kwargs):
+        async def limited_find(value):
+            """
+            Look up a user when there are less than lookups_in_flight lookups
+            running.
+            """
+            async with semaphore:
+                return await find(value)
+
+        results = await asyncio.gather(*(
+            limited_find(value) for value in values
+        ))
+        return dict(zip(values, results))
+
+    async def find_by_usernames(self, usernames,
+                                lookups_in_flight=DEFAULT_LOOKUPS_IN_FLIGHT):
+        """
+        Find users by username.
+
+        Return a dict of the user details (or None if a user is not found)
+        keyed by username.
+        """
+
+        return await self._find_many(self.find_by_username, usernames,
+                                     lookups_in_flight)
+
+    async def find_by_emails(self, emails,
+                             lookups_in_flight=DEFAULT_LOOKUPS_IN_FLIGHT):
+        """
+        Find users by email.
+
+        Return a dict of the user details (or None if a user is not found)
+        keyed by email.
+
+        If any of the email addresses is not unique, raise a EmailNotUnique
+        exception.
+        """
+
+        return await self._find_many(self.find_by_email, emails,
+                                     lookups_in_flight)
+
+    async def list(self, **kwargs):
         """
         List all the users subscribed to the application.
 
@@ -170,217 +2075,248 @@ class UserWebService:
         sent to profile server's /user/ endpoint.
         """
 
-        response = self._request('GET', self._list_uri(**kwargs))
+        response = await self._request('GET', self._list_uri(**kwargs))
         self._raise_for_failure(response)
         return response.json()
 
-    def register(self, user):
+    def iter_users(self, page_size=DEFAULT_PAGE_SIZE, pages_in_flight=1,
+                   **kwargs):
         """
-        Register a new user on the profile server
+        An asynchronous iterator over all the users in the list, fetching a
+        page of page_size users at a time.
+
+        The pages after the first one are fetched concurrently, up to
+        pages_in_flight at a time; the users are still returned in order.
+
+        Kwargs are the same as for list(); the iteration starts at the given
+        offset, if any.
         """
-        data = {
-            'email': user.email,
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-        }
 
-        if user.username:
-            data['username'] = user.username
+        kwargs['limit'] = page_size
+        return AsyncUserIterator(self, pages_in_flight, kwargs)
 
-        if self.register_email_template is not None:
-            data['email_template'] = self.register_email_template
-        if self.register_email_subject is not None:
-            data['email_subject'] = self.register_email_subject
-        response = self._request('POST', self._list_uri(),
-                                 data=json.dumps(data))
+    async def register(self, user):
+        """
+        Register a new user on the profile server
+        """
+        response = await self._request(
+            'POST', self._list_uri(),
+            data=json.dumps(self._register_data(user)))
         self._raise_for_failure(response)
         return response.json()
 
-    def connect(self, user, commit=True):
+    async def connect(self, user, commit=True):
         """
         Ensure a user with given user's email exists on the profile server,
         update the details as needed and save the user if commit is True.
+
+        The user is saved in the default executor, as the ORM is blocking.
         """
         if user.username:
-            details = self.find_by_username(user.username)
+            details = await self.find_by_username(user.username)
         else:
-            details = self.find_by_email(user.email)
+            details = await self.find_by_email(user.email)
             if details:
                 user.username = details['username']
 
-        if details is None:
-            details = self.register(user)
+        registered = details is None
+        if registered:
+            details = await self.register(user)
         else:
-            self.subscribe(user)
-            user.first_name = details['first_name']
-            user.last_name = details['last_name']
-        user.username = details['username']
-        user.set_password(None)
+            await self.subscribe(user)
+        self._update_connected_user(user, details, registered)
         if commit:
-            user.save()
+            await asyncio.get_event_loop().run_in_executor(None, user.save)
         return user
 
-    def reset_password(self, user):
+    async def reset_password(self, user):
         """
         Send the user a password reset email.
         """
 
-        response = self._request(
+        response = await self._request(
             'POST',
-            urljoin(self._detail_uri(user.username), 'reset-password/'),
+            self._reset_password_uri(user.username),
         )
         self._raise_for_failure(response)
 
-    def get_group(self, group, **kwargs):
+    async def get_group(self, group, **kwargs):
         """
         Request the users in a profile server group
-
-        Profile server groups are typically referred to by a URI resource name
-        i.e. http://iss3/service/1234/ -- the names are considered meaningful
-        to the applications.
         """
 
-        url = urljoin(self.profile_server,
-                      self.GROUP_URI % group)
+        url = self._group_uri(group)
 
         LOG.debug("Requesting users for group '%s'", url)
 
-        response = self._request('GET', url,
-                                 params=kwargs)
+        response = await self._request('GET', url, params=kwargs)
 
-        # pylint:disable=no-member
-        # Instance of 'LookupDict' has no 'not_found' member
         if response.status_code == requests.codes.not_found:
             return []
 
         self._raise_for_failure(response)
         return response.json()['users']
 
-    def add_group(self, user, group):
+    async def add_group(self, user, group):
         """
         Add a user to the named group
         """
-        return self.add_groups(user, [group])
+        return await self.add_groups(user, [group])
 
-    def add_groups(self, user, groups):
+    async def add_groups(self, user, groups):
         """
         Add a user to the list of named groups
         """
-        user = self.find_by_username(user.username)
-
-        if not user:
-            raise exceptions.ProfileServerFailure("User could not be found.")
-
-        data = {
-            'groups': list(
-                set(user['groups'] + groups)
-            ),
-        }
-
-        response = self._request('PATCH',
-                                 self._detail_uri(user['username']),
-                                 data=json.dumps(data))
-        self._raise_for_failure(response)
-
-        return response.json()['groups']
+        return await self.update_groups(user, add=groups)
 
-    def remove_group(self, user, group):
+    async def remove_group(self, user, group):
         """
         Remove a user from the named group
         """
-        return self.remove_groups(user, [group])
+        return await self.remove_groups(user, [group])
 
-    def remove_groups(self, user, groups):
+    async def remove_groups(self, user, groups):
         """
         Remove a user from multiple groups
         """
+        return await self.update_groups(user, remove=groups)
 
-        current_groups = set(self.find_by_username(user.username)['groups'])
+    async def update_groups(self, user, add=(), remove=()):
+        """
+        Add a user to the groups in add and remove them from the groups in
+        remove.
 
-        data = {
-            'groups': list(current_groups - set(groups)),
-        }
+        The change is sent with If-Match, and the user fetched again if it
+        changed concurrently.
+        """
+
+        for _ in range(self.update_groups_attempts):
+            known = await self._request('GET',
+                                        self._detail_uri(user.username))
+            if known.status_code == requests.codes.not_found:
+                self._check_details(None)
+            self._raise_for_failure(known)
+
+            response = await self._request(
+                'PATCH',
+                self._detail_uri(user.username),
+                headers=self._if_match(known),
+                data=json.dumps(self._update_groups_data(known.json(),
+                                                         add, remove)),
+            )
+            # pylint:disable=no-member
+            if response.status_code != requests.codes.precondition_failed:
+                break
 
-        response = self._request('PATCH',
-                                 self._detail_uri(user.username),
-                                 data=json.dumps(data))
         self._raise_for_failure(response)
 
         return response.json()['groups']
 
-    def set_details(self, user, **details):
+    async def set_details(self, user, **details):
         """
         Set the details for the user
         """
 
-        # If `subscribed' is not set but we are changing the status of
-        # the current app, `subscribed' must be set
-        if 'subscribed' not in details and 'subscriptions' in details \
-                and settings.PROFILE_SERVER_KEY in details['subscriptions']:
-            details['subscribed'] = \
-                details['subscriptions'][settings.PROFILE_SERVER_KEY]
-
-        for field in ('date_joined', 'last_login'):
-            if details.get(field):
-                details[field] = details[field].isoformat()
-
-        response = self._request('PATCH',
-                                 self._detail_uri(user.username),
-                                 data=json.dumps(details))
+        response = await self._request(
+            'PATCH',
+            self._detail_uri(user.username),
+            data=json.dumps(self._details_data(details)))
         self._raise_for_failure(response)
 
         return response.json()
 
-    def get_user_data(self, user, key=None):
+    async def get_user_data(self, user, key=None):
         """
         Get the user data for the user, including an optional key
         """
 
-        url = self._detail_uri(user.username) + 'preferences/'
-        params = {'limit': 0}
-
-        if key:
-            params['type'] = key
-
-        response = self._request('GET', url, params=params)
-
-        try:
-            data = response.json()['objects']
-        except (ValueError, KeyError):
-            return []
+        response = await self._request('GET',
+                                       self._user_data_uri(user.username),
+                                       params=self._user_data_params(key))
 
-        return data
+        return self._user_data_result(response)
 
-    def set_user_data(self, user, key, value):
+    async def set_user_data(self, user, key, value):
         """
         Set user data for the user. This data is stored as a key-value
         pair inside the profile server
         """
 
-        data = {
-            'user': self.USER_URI % user.username,
-            'type': key,
-            'data': value,
-        }
+        data = self._set_user_data_payload(user, key, value)
 
-        response = self._request('POST',
-                                 urljoin(self.profile_server,
-                                         '/api/v2/user-preference/'),
-                                 data=json.dumps(data))
+        response = await self._request('POST',
+                                       self._user_data_list_uri(),
+                                       data=json.dumps(data))
         self._raise_for_failure(response)
 
         return response.json()
 
-    def delete_user_data(self, id_):
+    async def delete_user_data(self, id_):
         """
         Delete user data by id
         """
 
-        response = self._request('DELETE',
-                                 urljoin(self.profile_server,
-                                         '/api/v2/user-preference/%d/' % id_))
+        response = await self._request('DELETE',
+                                       self._user_data_detail_uri(id_))
         self._raise_for_failure(response)
 
 
+class AsyncUserIterator:
+    """
+    An asynchronous iterator over the user list, returned by
+    AsyncUserWebService.iter_users.
+    """
+
+    def __init__(self, webservice, pages_in_flight, kwargs):
+        self.webservice = webservice
+        self.pages_in_flight = pages_in_flight
+        self.kwargs = kwargs
+        self.offset = kwargs.pop('offset', 0)
+
+        self._offsets = None
+        self._pages = deque()
+        self._users = deque()
+
+    def __aiter__(self):
+        return self
+
+    def _fill(self):
+        """
+        Start fetching pages until pages_in_flight are in flight.
+        """
+        while len(self._pages) < self.pages_in_flight:
+            offset = next(self._offsets, None)
+            if offset is None:
+                break
+            self._pages.append(asyncio.ensure_future(
+                self.webservice.list(offset=offset, **self.kwargs)))
+
+    async def __anext__(self):
+        while not self._users:
+            if self._offsets is None:
+                users = await self.webservice.list(offset=self.offset,
+                                                   **self.kwargs)
+                # pylint:disable=protected-access
+                self._offsets = iter(
+                    self.webservice._remaining_page_offsets(users))
+            elif self._pages:
+                users = await self._pages.popleft()
+            else:
+                raise StopAsyncIteration
+
+            self._fill()
+            self._users.extend(users['objects'])
+
+        return self._users.popleft()
+
+    async def aclose(self):
+        """
+        Stop fetching the pages in flight.
+        """
+        while self._pages:
+            self._pages.popleft().cancel()
+
+
 # pylint:disable=invalid-name
 profile_server = UserWebService()
+async_profile_server = AsyncUserWebService()
@@ -20,4 +20,7 @@ with open('requirements.txt') as requirements, \
         long_description=open('README.md').read(),
         install_requires=requirements.read().splitlines(),
         test_requires=test_requirements.read().splitlines(),
+        extras_require={
+            'async': ['httpx'],
+        },
     )